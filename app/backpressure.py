@@ -0,0 +1,130 @@
+from celery import Celery
+from pydantic import BaseModel
+from typing import Callable, Dict, Optional
+import base64
+import json
+import math
+import time
+import urllib.parse
+import urllib.request
+
+
+class QueueStats(BaseModel):
+    queue: str
+    messages: int = 0  # задачи в очереди (без выполняемых)
+    consumers: int = 0
+    ack_rate: Optional[float] = None  # задач в секунду, если известно
+    wait: float = 0  # оценка времени ожидания новой задачи, секунды
+
+
+def management_fetcher(
+    url: str, username: str, password: str, timeout: float = 2
+) -> Callable[[str], dict]:
+    """Статистика очереди из RabbitMQ management API"""
+    credentials = base64.b64encode(f"{username}:{password}".encode())
+
+    def fetch(queue: str) -> dict:
+        request = urllib.request.Request(
+            f"{url}/api/queues/%2F/{urllib.parse.quote(queue, safe='')}",
+            headers={"Authorization": f"Basic {credentials.decode()}"},
+        )
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            data = json.load(response)
+        ack_details = data.get("message_stats", {}).get("ack_details", {})
+        return {
+            "messages": data.get("messages_ready", data.get("messages", 0)),
+            "consumers": data.get("consumers", 0),
+            "ack_rate": ack_details.get("rate"),
+        }
+
+    return fetch
+
+
+def amqp_fetcher(celery_app: Celery) -> Callable[[str], dict]:
+    """Статистика очереди через AMQP (без management плагина),
+    скорость обработки задач неизвестна"""
+
+    def fetch(queue: str) -> dict:
+        with celery_app.connection_for_write() as conn:
+            _, messages, consumers = conn.default_channel.queue_declare(
+                queue=queue, passive=True
+            )
+        return {"messages": messages, "consumers": consumers}
+
+    return fetch
+
+
+def static_fetcher(stats: Dict[str, dict]) -> Callable[[str], dict]:
+    """Заглушка с заданной статистикой очередей (для тестов)"""
+
+    def fetch(queue: str) -> dict:
+        return stats.get(queue, {})
+
+    return fetch
+
+
+class QueueFullError(Exception):
+    def __init__(self, stats: QueueStats):
+        super().__init__(f"queue {stats.queue} is full")
+        self.stats = stats
+
+    @property
+    def retry_after(self) -> int:
+        return max(math.ceil(self.stats.wait), 1)
+
+
+class Backpressure:
+    # Контроль приема задач по глубине очереди: при превышении порогов
+    # приоритет задачи понижается или задача отклоняется
+    def __init__(
+        self,
+        fetchers: list,  # используется первый сработавший источник
+        ttl: float = 5,
+        task_seconds: float = 600,
+        demote_depth: int = 0,
+        demoted_priority: int = 1,
+        reject_depth: int = 0,
+    ):
+        self.fetchers = fetchers
+        self.ttl = ttl
+        self.task_seconds = task_seconds
+        self.demote_depth = demote_depth
+        self.demoted_priority = demoted_priority
+        self.reject_depth = reject_depth
+        self._cache: Dict[str, tuple] = {}  # {queue: (time, stats)}
+
+    def get_stats(self, queue: str) -> QueueStats:
+        cached = self._cache.get(queue)
+        if (cached is not None) and (time.monotonic() - cached[0] < self.ttl):
+            return cached[1]
+        data = {}
+        for fetch in self.fetchers:
+            try:
+                data = fetch(queue)
+                break
+            except Exception as e:
+                print(f"Queue stats of {queue} are not available: {e}")
+        stats = QueueStats(queue=queue, **data)
+        stats.wait = self.estimate_wait(stats)
+        self._cache[queue] = (time.monotonic(), stats)
+        return stats
+
+    def estimate_wait(self, stats: QueueStats) -> float:
+        # По скорости подтверждения задач, иначе по средней длительности
+        # задачи и количеству обработчиков
+        if stats.ack_rate:
+            return stats.messages / stats.ack_rate
+        return stats.messages * self.task_seconds / max(stats.consumers, 1)
+
+    def admit(self, queue: str, priority: int, n_tasks: int = 1) -> int:
+        """Проверка приема n_tasks задач в очередь.
+        Возвращает приоритет задач, QueueFullError - если очередь полна"""
+        if not (self.demote_depth or self.reject_depth):
+            return priority
+        stats = self.get_stats(queue)
+        depth = stats.messages + n_tasks
+        if self.reject_depth and (depth > self.reject_depth):
+            raise QueueFullError(stats)
+        if self.demote_depth and (depth > self.demote_depth):
+            return min(priority, self.demoted_priority)
+        return priority
@@ -10,6 +10,23 @@ class Settings(BaseSettings):
     redis_password: str
     redis_hostname: str = "redis"
     flower_port: str = "5555"
+    # Queues of CPU-heavy SAR tasks and memory-heavy weather tasks
+    sar_queue: str = "sar"
+    weather_queue: str = "weather"
+    rabbitmq_management_port_number: str = "15672"
+    # Backpressure: queue statistics are cached for queue_stats_ttl seconds
+    queue_stats_ttl: float = 5
+    # Expected task duration (seconds) if the processing rate is unknown
+    expected_task_seconds: float = 600
+    # Above this queue depth priority is lowered to demoted_priority,
+    # above reject_depth tasks are rejected (429), 0 - disabled
+    demote_depth: int = 0
+    demoted_priority: int = 1
+    reject_depth: int = 0
+    # Threads (and broker connections) used to publish tasks
+    publish_threads: int = 4
+    # Wait for broker confirmation of each published task
+    publish_confirms: bool = True
 
     class Config:
         env_file = ".env"
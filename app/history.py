@@ -0,0 +1,188 @@
+from celery import states
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterable, List, Optional
+from worker import BatchItem, TaskItem
+import datetime
+import json
+import sqlite3
+
+# Результат начатой задачи удален из бэкенда celery (result_expires),
+# состояние задачи больше не известно
+EXPIRED = "EXPIRED"
+# Состояния, которые больше не меняются
+READY_STATES = states.READY_STATES | {EXPIRED}
+
+
+def get_date_range(item: TaskItem) -> tuple:
+    """Диапазон дат (%Y%m%d) задачи или батча"""
+    kwargs = item.kwargs
+    if "dataset_date" in kwargs:
+        return kwargs["dataset_date"], kwargs["dataset_date"]
+    date_from, date_to = kwargs.get("date_from"), kwargs.get("date_to")
+    if isinstance(date_from, datetime.date):
+        date_from = date_from.strftime("%Y%m%d")
+    if isinstance(date_to, datetime.date):
+        date_to = date_to.strftime("%Y%m%d")
+    return date_from, date_to
+
+
+class TaskHistory:
+    # История отправленных задач в SQLite (WAL). Файл общий для всех
+    # процессов uvicorn, каждая задача записывается сразу при отправке
+    def __init__(self, db_fp: Path):
+        self.db_fp = Path(db_fp)
+        self.db_fp.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS tasks (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    id TEXT NOT NULL UNIQUE,
+                    name TEXT NOT NULL,
+                    is_batch INTEGER NOT NULL,
+                    kwargs TEXT NOT NULL,
+                    date_from TEXT,
+                    date_to TEXT,
+                    state TEXT NOT NULL,
+                    submitted TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS tasks_name ON tasks (name, seq);
+                CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, seq);
+                CREATE INDEX IF NOT EXISTS tasks_date
+                    ON tasks (date_from, date_to);
+                """)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_fp, timeout=30)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        try:
+            with conn:  # commit или rollback
+                yield conn
+        finally:
+            conn.close()
+
+    def add(self, items: Iterable[TaskItem]) -> None:
+        """Добавить задачи (последняя в списке будет первой в истории)"""
+        submitted = datetime.datetime.utcnow().isoformat(timespec="seconds")
+        rows = [
+            (
+                item.id,
+                item.name,
+                int(isinstance(item, BatchItem)),
+                json.dumps(item.kwargs, default=str),
+                *get_date_range(item),
+                states.PENDING,
+                submitted,
+            )
+            for item in items
+        ]
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO tasks (id, name, is_batch, kwargs,"
+                + " date_from, date_to, state, submitted)"
+                + " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    def _where(
+        self,
+        name: Optional[str] = None,
+        date: Optional[str] = None,
+        state: Optional[str] = None,
+    ) -> tuple:
+        conditions, params = [], []
+        if name:
+            conditions.append("name = ?")
+            params.append(name)
+        if date:
+            conditions.append("date_from <= ? AND date_to >= ?")
+            params.extend([date, date])
+        if state:
+            conditions.append("state = ?")
+            params.append(state)
+        where = " WHERE " + " AND ".join(conditions) if conditions else ""
+        return where, params
+
+    def refresh_states(
+        self, name: Optional[str] = None, date: Optional[str] = None
+    ) -> None:
+        """Обновить сохраненные состояния незавершенных задач по данным
+        celery (нужно перед фильтрацией по состоянию). Опрашиваются все
+        незавершенные задачи, подходящие под фильтры name и date.
+        Задача, которую celery снова считает PENDING после того, как она
+        была начата, отмечается как EXPIRED: ее результат удален из бэкенда
+        (result_expires). Задачи в очереди остаются PENDING"""
+        where, params = self._where(name, date)
+        ready = ", ".join("?" * len(READY_STATES))
+        where += " AND" if where else " WHERE"
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id, name, is_batch, kwargs, state FROM tasks"
+                + where
+                + f" state NOT IN ({ready})",
+                [*params, *READY_STATES],
+            ).fetchall()
+        updates = []
+        for task_id, name, is_batch, kwargs, state in rows:
+            item = self._to_item(task_id, name, is_batch, kwargs)
+            new_state = item.state.name
+            if (new_state == states.PENDING) and (state != states.PENDING):
+                new_state = EXPIRED
+            if new_state != state:
+                updates.append((new_state, task_id))
+        if updates:
+            with self._connect() as conn:
+                conn.executemany(
+                    "UPDATE tasks SET state = ? WHERE id = ?", updates
+                )
+
+    @staticmethod
+    def _to_item(
+        task_id: str, name: str, is_batch: int, kwargs: str
+    ) -> TaskItem:
+        item_cls = BatchItem if is_batch else TaskItem
+        return item_cls(name=name, id=task_id, kwargs=json.loads(kwargs))
+
+    def query(
+        self,
+        page: int = 1,
+        per_page: int = 10,
+        name: Optional[str] = None,
+        date: Optional[str] = None,
+        state: Optional[str] = None,
+    ) -> List[TaskItem]:
+        """Страница истории (новые задачи первыми), фильтры:
+        name - имя задачи, date - дата (%Y%m%d) из диапазона дат задачи,
+        state - состояние задачи"""
+        if state:
+            self.refresh_states(name, date)
+        where, params = self._where(name, date, state)
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id, name, is_batch, kwargs FROM tasks"
+                + where
+                + " ORDER BY seq DESC LIMIT ? OFFSET ?",
+                [*params, per_page, (page - 1) * per_page],
+            ).fetchall()
+        return [self._to_item(*row) for row in rows]
+
+    def count(
+        self,
+        name: Optional[str] = None,
+        date: Optional[str] = None,
+        state: Optional[str] = None,
+    ) -> int:
+        where, params = self._where(name, date, state)
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT COUNT(*) FROM tasks" + where, params
+            ).fetchone()[0]
+
+    def names(self) -> List[str]:
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT DISTINCT name FROM tasks ORDER BY name"
+            ).fetchall()
+        return [row[0] for row in rows]
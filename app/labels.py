@@ -0,0 +1,73 @@
+from pathlib import Path
+from pydantic import BaseModel
+from typing import List, Optional
+import sqlite3
+
+
+class LabelMatch(BaseModel):
+    date: str
+    pol: str
+    scene: str
+    tile: Optional[int] = None  # номер тайла, None - весь снимок
+    y: Optional[int] = None  # смещение тайла в полном снимке
+    x: Optional[int] = None
+    valid_fraction: float  # доля валидных пикселей
+    fraction: float  # доля класса среди размеченных пикселей
+
+
+class LabelIndex:
+    # Чтение индекса долей классов льда, который пополняется воркерами при
+    # сборе датасетов (worker/label_index.py, схема таблиц - там же)
+    def __init__(self, db_fp: Path):
+        self.db_fp = Path(db_fp)
+
+    def query(
+        self,
+        param: str,
+        value: int,
+        min_fraction: float = 0,
+        pols: Optional[List[str]] = None,
+        date_from: Optional[str] = None,
+        date_to: Optional[str] = None,
+        min_valid_fraction: float = 0,
+        tiles: bool = False,
+        limit: int = 1000,
+    ) -> List[LabelMatch]:
+        """Снимки (или тайлы), в которых доля класса value параметра льда
+        param больше min_fraction. Даты в формате %Y%m%d"""
+        if not self.db_fp.exists():
+            return []
+        conditions = [
+            "f.param = ?",
+            "f.class = ?",
+            "f.fraction > ?",
+            "f.tile >= 0" if tiles else "f.tile = -1",
+            "COALESCE(t.valid_fraction, s.valid_fraction) >= ?",
+        ]
+        params = [param, value, min_fraction, min_valid_fraction]
+        if pols:
+            conditions.append(f"s.pol IN ({', '.join('?' * len(pols))})")
+            params.extend(pols)
+        if date_from:
+            conditions.append("s.date >= ?")
+            params.append(date_from)
+        if date_to:
+            conditions.append("s.date <= ?")
+            params.append(date_to)
+        conn = sqlite3.connect(f"file:{self.db_fp}?mode=ro", uri=True)
+        try:
+            rows = conn.execute(
+                "SELECT s.date, s.pol, s.scene, t.tile, t.y, t.x,"
+                + " COALESCE(t.valid_fraction, s.valid_fraction), f.fraction"
+                + " FROM fractions f JOIN scenes s ON s.id = f.scene_id"
+                + " LEFT JOIN tiles t"
+                + " ON t.scene_id = f.scene_id AND t.tile = f.tile"
+                + " WHERE "
+                + " AND ".join(conditions)
+                + " ORDER BY s.date, s.pol, s.scene, f.tile LIMIT ?",
+                [*params, limit],
+            ).fetchall()
+        finally:
+            conn.close()
+        fields = list(LabelMatch.__fields__)
+        return [LabelMatch(**dict(zip(fields, row))) for row in rows]
@@ -1,18 +1,35 @@
-from fastapi import FastAPI, Request, Depends, HTTPException
+from fastapi import FastAPI, Request, Depends, HTTPException, Query
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import JSONResponse, RedirectResponse
 from fastapi.templating import Jinja2Templates
 
-from worker import celery_app, TaskItem
+from history import TaskHistory
+from backpressure import QueueFullError, QueueStats
+from labels import LabelIndex, LabelMatch
+from starlette.concurrency import run_in_threadpool
+from worker import (
+    backpressure,
+    get_queues,
+    get_task_queue,
+    publish_executor,
+    send_batch_async,
+    send_task_async,
+    send_tasks_async,
+    BatchItem,
+    TaskItem,
+    TaskState,
+)
 import models
 import config
 
-from typing import Deque
-from collections import deque
+from typing import List, Optional
+from collections import Counter
 from functools import lru_cache
 from pydantic import BaseModel
 from pathlib import Path
 import traceback
+import datetime
+import math
 import pickle
 import os
 
@@ -26,21 +43,93 @@ def get_settings():
 
 class BindMounts(BaseModel):
     data: Path = Path("./data")
+    # Датасеты, собранные воркерами
+    output: Path = Path("./output")
 
 
 mounts = BindMounts()
 
-task_queue_web: Deque = deque(maxlen=10)  # Очередь для мониторинга в вебе
+# История задач для мониторинга в вебе
+task_history = TaskHistory(mounts.data.joinpath("task_history.sqlite3"))
+# Очередь из предыдущих версий, переносится в историю при запуске
 task_queue_web_file = mounts.data.joinpath("task_queue_web.pickle")
+# Индекс долей классов льда в собранных датасетах
+label_index = LabelIndex(mounts.output.joinpath("label_index.sqlite3"))
 
 templates = Jinja2Templates(directory="templates")
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 
+async def admit(task_name: str, priority: int, n_tasks: int = 1) -> int:
+    """Проверка глубины очереди задачи (см. backpressure.Backpressure).
+    Возвращает приоритет задачи, 429 - если очередь переполнена"""
+    try:
+        return await run_in_threadpool(
+            backpressure.admit, get_task_queue(task_name), priority, n_tasks
+        )
+    except QueueFullError as e:
+        raise HTTPException(
+            status_code=429,
+            detail=f"Очередь {e.stats.queue} переполнена",
+            headers={"Retry-After": str(e.retry_after)},
+        )
+
+
+def get_queue_stats() -> list:
+    return [backpressure.get_stats(queue) for queue in get_queues()]
+
+
 @app.get("/")
-async def home(request: Request):
+def home(
+    request: Request,
+    page: int = Query(1, ge=1),
+    name: Optional[str] = None,
+    date: Optional[str] = None,  # пустая строка из формы фильтров
+    state: Optional[str] = None,
+):
+    filters = {
+        "name": name,
+        "date": date.replace("-", "") if date else None,
+        "state": state,
+    }
+    tasks = task_history.query(page=page, per_page=10, **filters)
+    n_pages = max(math.ceil(task_history.count(**filters) / 10), 1)
     return templates.TemplateResponse(
-        "home.html", {"request": request, "tasks": task_queue_web}
+        "home.html",
+        {
+            "request": request,
+            "tasks": tasks,
+            "page": page,
+            "n_pages": n_pages,
+            "filters": {"name": name, "date": date, "state": state},
+            "task_names": task_history.names(),
+            "task_states": list(TaskState.icon_mapping),
+            "queues": get_queue_stats(),
+        },
+    )
+
+
+@app.get("/tasks", status_code=200, response_model=List[TaskItem])
+def tasks_history(
+    page: int = Query(1, ge=1),
+    per_page: int = Query(10, ge=1, le=100),
+    name: Optional[str] = None,
+    date: Optional[datetime.date] = None,
+    state: Optional[str] = None,
+) -> List[TaskItem]:
+    """
+    История задач (новые первыми):
+    - **page, per_page**: страница и количество задач на странице
+    - **name**: имя задачи (Sentinel SAR, Weather, ...)
+    - **date**: дата, входящая в диапазон дат задачи
+    - **state**: состояние задачи (PENDING, STARTED, SUCCESS, FAILURE)
+    """
+    return task_history.query(
+        page=page,
+        per_page=per_page,
+        name=name,
+        date=date.strftime("%Y%m%d") if date else None,
+        state=state,
     )
 
 
@@ -55,13 +144,15 @@ async def handle_args(
     - **age, concentrat, age_group**: характеристики льда, которые будут добавлены в датасет
     - **simple**: добавляемые текстурные характеристики из группы simple
     - **advanced**: добавляемые текстурные характеристики из группы advanced
+    - **patch_size, patch_stride, patch_min_label_fraction**: нарезка патчей для обучения (0 - не нарезать)
     """
+    priority = await admit("run_sar_script", args.task_priority)
     try:
         args_dict = args.dict()
-        task = celery_app.send_task(
+        task = await send_task_async(
             "run_sar_script",
             kwargs=args_dict,
-            priority=args.task_priority,
+            priority=priority,
         )
     except Exception:
         message = "Ошибка при отправке задачи"
@@ -71,7 +162,52 @@ async def handle_args(
 
     try:
         task_item = TaskItem(name="Sentinel SAR", id=task.id, kwargs=args_dict)
-        task_queue_web.appendleft(task_item)
+        task_history.add([task_item])
+    except Exception:
+        message = "Ошибка очереди веб-интерфейса"
+        print(message)
+        print(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=message)
+
+    print("-" * 100)
+    print(task_item)
+    print("-" * 100)
+
+    return task_item
+
+
+@app.post("/pipeline_script", status_code=201, response_model=TaskItem)
+async def handle_pipeline_args(
+    request: Request,
+    args: models.SarScriptArgs = Depends(models.SarScriptArgs.as_form),
+) -> TaskItem:
+    """
+    Выберите аргументы скрипта сборки датасета (датасет с погодой собирается за тот же проход по снимкам):
+    - **dataset_date**: дата, за которую будет собран датасет
+    - **age, concentrat, age_group**: характеристики льда, которые будут добавлены в датасет
+    - **simple**: добавляемые текстурные характеристики из группы simple
+    - **advanced**: добавляемые текстурные характеристики из группы advanced
+    - **patch_size, patch_stride, patch_min_label_fraction**: нарезка патчей для обучения (0 - не нарезать)
+    """
+    priority = await admit("run_pipeline_script", args.task_priority)
+    try:
+        args_dict = args.dict()
+        task = await send_task_async(
+            "run_pipeline_script",
+            kwargs=args_dict,
+            priority=priority,
+        )
+    except Exception:
+        message = "Ошибка при отправке задачи"
+        print(message)
+        print(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=message)
+
+    try:
+        task_item = TaskItem(
+            name="Sentinel SAR + Weather", id=task.id, kwargs=args_dict
+        )
+        task_history.add([task_item])
     except Exception:
         message = "Ошибка очереди веб-интерфейса"
         print(message)
@@ -94,12 +230,13 @@ async def handle_weather_args(
     Выберите аргументы скрипта сборки датасета с погодой:
     - **dataset_date**: дата, за которую будет собран датасет
     """
+    priority = await admit("run_weather_script", args.task_priority)
     try:
         args_dict = args.dict()
-        task = celery_app.send_task(
+        task = await send_task_async(
             "run_weather_script",
             kwargs=args_dict,
-            priority=args.task_priority,
+            priority=priority,
         )
     except Exception:
         message = "Ошибка при отправке задачи"
@@ -109,7 +246,7 @@ async def handle_weather_args(
 
     try:
         task_item = TaskItem(name="Weather", id=task.id, kwargs=args_dict)
-        task_queue_web.appendleft(task_item)
+        task_history.add([task_item])
     except Exception:
         message = "Ошибка очереди веб-интерфейса"
         print(message)
@@ -123,6 +260,204 @@ async def handle_weather_args(
     return task_item
 
 
+async def handle_range(
+    task_name: str,
+    item_name: str,
+    args: models.DateRangeParams,
+    task_kwargs: dict,
+) -> BatchItem:
+    dataset_dates = args.dataset_dates()
+    priority = await admit(
+        task_name,
+        args.task_priority,
+        n_tasks=math.ceil(len(dataset_dates) / args.dates_per_task),
+    )
+    try:
+        batch = await send_batch_async(
+            task_name,
+            dataset_dates,
+            args.dates_per_task,
+            task_kwargs,
+            priority=priority,
+        )
+    except Exception:
+        message = "Ошибка при отправке задачи"
+        print(message)
+        print(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=message)
+
+    try:
+        batch_item = BatchItem(name=item_name, id=batch.id, kwargs=args.dict())
+        task_history.add([batch_item])
+    except Exception:
+        message = "Ошибка очереди веб-интерфейса"
+        print(message)
+        print(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=message)
+
+    print("-" * 100)
+    print(batch_item)
+    print("-" * 100)
+
+    return batch_item
+
+
+@app.post("/sar_script_range", status_code=201, response_model=BatchItem)
+async def handle_range_args(
+    request: Request,
+    args: models.SarScriptRangeArgs = Depends(
+        models.SarScriptRangeArgs.as_form
+    ),
+) -> BatchItem:
+    """
+    Выберите аргументы скрипта сборки датасетов за диапазон дат:
+    - **date_from, date_to**: диапазон дат (включительно), за которые будут собраны датасеты
+    - **dates_per_task**: количество дат, обрабатываемых одной задачей
+    - **age, concentrat, age_group**: характеристики льда, которые будут добавлены в датасет
+    - **simple**: добавляемые текстурные характеристики из группы simple
+    - **advanced**: добавляемые текстурные характеристики из группы advanced
+    - **patch_size, patch_stride, patch_min_label_fraction**: нарезка патчей для обучения (0 - не нарезать)
+    """
+    task_kwargs = args.dict(exclude={"date_from", "date_to", "dates_per_task"})
+    return await handle_range(
+        "run_sar_script_batch", "Sentinel SAR batch", args, task_kwargs
+    )
+
+
+@app.post("/weather_script_range", status_code=201, response_model=BatchItem)
+async def handle_weather_range_args(
+    request: Request,
+    args: models.WeatherScriptRangeArgs = Depends(
+        models.WeatherScriptRangeArgs.as_form
+    ),
+) -> BatchItem:
+    """
+    Выберите аргументы скрипта сборки датасетов с погодой за диапазон дат:
+    - **date_from, date_to**: диапазон дат (включительно), за которые будут собраны датасеты
+    - **dates_per_task**: количество дат, обрабатываемых одной задачей
+    """
+    task_kwargs = args.dict(exclude={"date_from", "date_to", "dates_per_task"})
+    return await handle_range(
+        "run_weather_script_batch", "Weather batch", args, task_kwargs
+    )
+
+
+# Задачи, принимаемые bulk запросом: {поле запроса: (задача, имя в вебе)}
+bulk_tasks = {
+    "sar": ("run_sar_script", "Sentinel SAR"),
+    "pipeline": ("run_pipeline_script", "Sentinel SAR + Weather"),
+    "weather": ("run_weather_script", "Weather"),
+}
+
+
+@app.post("/bulk_script", status_code=201, response_model=List[TaskItem])
+async def handle_bulk_args(
+    request: Request, args: models.BulkScriptArgs
+) -> List[TaskItem]:
+    """
+    Отправка множества задач одним запросом (JSON):
+    - **sar**: список аргументов задач /sar_script
+    - **pipeline**: список аргументов задач /pipeline_script
+    - **weather**: список аргументов задач /weather_script
+    """
+    items = [
+        (field, task_args.dict())
+        for field in bulk_tasks
+        for task_args in getattr(args, field)
+    ]
+    # Все задачи запроса учитываются при проверке глубины их очереди
+    n_tasks = Counter(
+        get_task_queue(bulk_tasks[field][0]) for field, _ in items
+    )
+    send_args = []
+    for field, args_dict in items:
+        task_name = bulk_tasks[field][0]
+        priority = await admit(
+            task_name,
+            args_dict["task_priority"],
+            n_tasks=n_tasks[get_task_queue(task_name)],
+        )
+        send_args.append((task_name, args_dict, priority))
+    try:
+        tasks = await send_tasks_async(send_args)
+    except Exception:
+        message = "Ошибка при отправке задачи"
+        print(message)
+        print(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=message)
+
+    try:
+        task_items = [
+            TaskItem(name=bulk_tasks[field][1], id=task.id, kwargs=args_dict)
+            for (field, args_dict), task in zip(items, tasks)
+        ]
+        task_history.add(task_items)
+    except Exception:
+        message = "Ошибка очереди веб-интерфейса"
+        print(message)
+        print(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=message)
+
+    print("-" * 100)
+    print(f"{len(task_items)} tasks")
+    print("-" * 100)
+
+    return task_items
+
+
+@app.get("/queues", status_code=200, response_model=List[QueueStats])
+def queues() -> list:
+    """
+    Глубина очередей задач и оценка времени ожидания новой задачи (секунды)
+    """
+    return get_queue_stats()
+
+
+@app.get("/labels", status_code=200, response_model=List[LabelMatch])
+def labels(
+    param: str = Query(..., regex="^(age|age_group|concentrat)$"),
+    value: int = Query(...),
+    min_fraction: float = Query(0, ge=0, le=1),
+    pols: Optional[List[str]] = Query(None),
+    date_from: Optional[datetime.date] = None,
+    date_to: Optional[datetime.date] = None,
+    min_valid_fraction: float = Query(0, ge=0, le=1),
+    tiles: bool = False,
+    limit: int = Query(1000, ge=1, le=100000),
+) -> List[LabelMatch]:
+    """
+    Поиск собранных снимков (или их тайлов) по доле класса льда:
+    - **param, value**: параметр льда и его класс (например, age_group=3)
+    - **min_fraction**: доля класса среди размеченных пикселей больше этой
+    - **pols**: поляризации (например, HH и HV)
+    - **date_from, date_to**: диапазон дат снимков
+    - **min_valid_fraction**: минимальная доля валидных пикселей
+    - **tiles**: искать тайлы вместо снимков целиком
+    """
+    return label_index.query(
+        param,
+        value,
+        min_fraction=min_fraction,
+        pols=pols,
+        date_from=date_from.strftime("%Y%m%d") if date_from else None,
+        date_to=date_to.strftime("%Y%m%d") if date_to else None,
+        min_valid_fraction=min_valid_fraction,
+        tiles=tiles,
+        limit=limit,
+    )
+
+
+@app.get("/batch/{batch_id}", status_code=200)
+def batch_progress(batch_id: str) -> JSONResponse:
+    batch_item = BatchItem(name="batch", id=batch_id, kwargs={})
+    if batch_item.result is None:
+        raise HTTPException(status_code=404, detail="Батч не найден")
+    progress = batch_item.progress
+    return JSONResponse(
+        {"id": batch_id, "state": batch_item.state.name, **progress}
+    )
+
+
 @app.get("/flower", status_code=301)
 def flower_redirect(
     request: Request, settings: config.Settings = Depends(get_settings)
@@ -141,15 +476,15 @@ def health_check() -> JSONResponse:
 
 @app.on_event("startup")
 def startup_event():
-    global task_queue_web
     if not os.path.exists(task_queue_web_file):
         return
     with open(task_queue_web_file, "rb") as f:
         task_queue_web = pickle.load(f)
+    task_history.add(reversed(task_queue_web))
+    os.remove(task_queue_web_file)
 
 
 @app.on_event("shutdown")
 def shutdown_event():
-    os.makedirs(mounts.data, exist_ok=True)
-    with open(task_queue_web_file, "wb") as f:
-        pickle.dump(task_queue_web, f)
+    # Tasks that are being published are sent before exit
+    publish_executor.shutdown(wait=True)
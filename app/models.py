@@ -47,14 +47,16 @@ def fixed_length_normalizer(max_length: int) -> Callable:
     return normalize
 
 
-@as_form
-class SarScriptArgs(BaseModel):
-    dataset_date: datetime.date
+class SarScriptParams(BaseModel):
     age: bool = True
     concentrat: bool = True
     age_group: bool = True
     simple: Union[list[str], str] = []
     advanced: Union[list[str], str] = []
+    # Нарезка патчей для обучения, 0 - не нарезать
+    patch_size: int = 0
+    patch_stride: int = 0  # 0 - равен patch_size
+    patch_min_label_fraction: float = 0.0
     task_priority: int = 5
 
     # Количество харалик характеристик типа Simple = 8
@@ -66,12 +68,55 @@ class SarScriptArgs(BaseModel):
         fixed_length_normalizer(max_length=11)
     )
 
+    @validator("patch_size", "patch_stride")
+    def check_not_negative(cls, v: int) -> int:
+        if v < 0:
+            raise ValueError("must not be negative")
+        return v
+
+
+class DateRangeParams(BaseModel):
+    date_from: datetime.date
+    date_to: datetime.date
+    # Количество дат, обрабатываемых одной задачей на одном воркере
+    dates_per_task: int = 10
+
+    @validator("date_to")
+    def check_date_range(cls, v: datetime.date, values: dict) -> datetime.date:
+        if ("date_from" in values) and (v < values["date_from"]):
+            raise ValueError("date_to must not be earlier than date_from")
+        return v
+
+    @validator("dates_per_task")
+    def check_dates_per_task(cls, v: int) -> int:
+        if v < 1:
+            raise ValueError("dates_per_task must be positive")
+        return v
+
+    def dataset_dates(self) -> list[str]:
+        # %Y%m%d date format is required by scripts (worker)
+        n_days = (self.date_to - self.date_from).days + 1
+        return [
+            (self.date_from + datetime.timedelta(days=i)).strftime("%Y%m%d")
+            for i in range(n_days)
+        ]
+
+
+@as_form
+class SarScriptArgs(SarScriptParams):
+    dataset_date: datetime.date
+
     @validator("dataset_date")
     def format_dataset_date(cls, v: datetime.date) -> str:
         # %Y%m%d date format is required by sar script (worker)
         return v.strftime("%Y%m%d")
 
 
+@as_form
+class SarScriptRangeArgs(DateRangeParams, SarScriptParams):
+    pass
+
+
 @as_form
 class WeatherScriptArgs(BaseModel):
     dataset_date: datetime.date
@@ -81,3 +126,21 @@ class WeatherScriptArgs(BaseModel):
     def format_dataset_date(cls, v: datetime.date) -> str:
         # %Y%m%d date format is required by weather script (worker)
         return v.strftime("%Y%m%d")
+
+
+@as_form
+class WeatherScriptRangeArgs(DateRangeParams):
+    task_priority: int = 5
+
+
+class BulkScriptArgs(BaseModel):
+    # Задачи каждого типа, отправляемые одним запросом
+    sar: list[SarScriptArgs] = []
+    pipeline: list[SarScriptArgs] = []
+    weather: list[WeatherScriptArgs] = []
+
+    @validator("weather", always=True)
+    def check_not_empty(cls, v: list, values: dict) -> list:
+        if not (v or values.get("sar") or values.get("pipeline")):
+            raise ValueError("at least one task is required")
+        return v
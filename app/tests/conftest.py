@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Модули приложения импортируются как модули верхнего уровня (как в uvicorn)
+sys.path.insert(0, APP_DIR)
+# Обязательные настройки (config.Settings), брокер в тестах не используется
+for name in ["RABBITMQ_USERNAME", "RABBITMQ_PASSWORD", "REDIS_PASSWORD"]:
+    os.environ.setdefault(name, "test")
+
+
+@pytest.fixture(scope="session")
+def app_dir(tmp_path_factory):
+    """Рабочая папка приложения: данные (./data) создаются во временной
+    папке, шаблоны и статика берутся из приложения"""
+    work_dir = tmp_path_factory.mktemp("app")
+    for name in ["templates", "static"]:
+        work_dir.joinpath(name).symlink_to(os.path.join(APP_DIR, name))
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    yield work_dir
+    os.chdir(cwd)
@@ -0,0 +1,193 @@
+import types
+
+import pytest
+
+from backpressure import Backpressure, QueueFullError, static_fetcher
+
+
+def create_backpressure(stats, **kwargs):
+    return Backpressure([static_fetcher(stats)], ttl=0, **kwargs)
+
+
+def test_admit_without_limits():
+    backpressure = create_backpressure({"sar": {"messages": 100}})
+    assert backpressure.admit("sar", 5, n_tasks=10) == 5
+
+
+def test_admit_pass():
+    backpressure = create_backpressure(
+        {"sar": {"messages": 2}}, demote_depth=5, reject_depth=10
+    )
+    assert backpressure.admit("sar", 5, n_tasks=3) == 5
+
+
+def test_admit_demote():
+    backpressure = create_backpressure(
+        {"sar": {"messages": 4}},
+        demote_depth=5,
+        demoted_priority=1,
+        reject_depth=10,
+    )
+    assert backpressure.admit("sar", 5, n_tasks=2) == 1
+    # Приоритет ниже пониженного не повышается
+    assert backpressure.admit("sar", 0, n_tasks=2) == 0
+
+
+def test_admit_reject():
+    backpressure = create_backpressure(
+        {"sar": {"messages": 9, "ack_rate": 0.5}}, reject_depth=10
+    )
+    assert backpressure.admit("sar", 5, n_tasks=1) == 5
+    with pytest.raises(QueueFullError) as e:
+        backpressure.admit("sar", 5, n_tasks=2)
+    assert e.value.stats.queue == "sar"
+    # 9 задач по 0.5 задачи в секунду
+    assert e.value.retry_after == 18
+
+
+def test_wait_by_task_seconds():
+    backpressure = create_backpressure(
+        {"weather": {"messages": 6, "consumers": 3}}, task_seconds=100
+    )
+    assert backpressure.get_stats("weather").wait == 200
+    # Пустая очередь - ожидание не меньше секунды
+    assert QueueFullError(backpressure.get_stats("sar")).retry_after == 1
+
+
+def test_fetcher_fallback():
+    def broken(queue):
+        raise OSError("management API is not available")
+
+    backpressure = Backpressure(
+        [broken, static_fetcher({"sar": {"messages": 3}})], ttl=0
+    )
+    assert backpressure.get_stats("sar").messages == 3
+
+
+@pytest.fixture
+def client(app_dir, tmp_path, monkeypatch):
+    from fastapi.testclient import TestClient
+    from history import TaskHistory
+    import main
+
+    sent = []
+
+    async def send_task_async(task_name, kwargs, priority):
+        sent.append((task_name, priority))
+        return types.SimpleNamespace(id=f"task-{len(sent)}")
+
+    async def send_batch_async(
+        task_name, dataset_dates, dates_per_task, kwargs, priority
+    ):
+        sent.append((task_name, priority))
+        return types.SimpleNamespace(id=f"batch-{len(sent)}")
+
+    async def send_tasks_async(send_args):
+        sent.extend(
+            (task_name, priority) for task_name, _, priority in send_args
+        )
+        return [
+            types.SimpleNamespace(id=f"task-{i}")
+            for i in range(len(send_args))
+        ]
+
+    monkeypatch.setattr(main, "send_task_async", send_task_async)
+    monkeypatch.setattr(main, "send_batch_async", send_batch_async)
+    monkeypatch.setattr(main, "send_tasks_async", send_tasks_async)
+    monkeypatch.setattr(
+        main,
+        "task_history",
+        TaskHistory(tmp_path.joinpath("task_history.sqlite3")),
+    )
+    client = TestClient(main.app)
+    client.sent = sent
+    return client
+
+
+def use_backpressure(monkeypatch, stats, **kwargs):
+    """Статистика очередей задается в тесте, запрошенное количество задач
+    каждой проверки записывается в admitted"""
+    import main
+
+    backpressure = create_backpressure(stats, **kwargs)
+    admitted = []
+    admit = backpressure.admit
+
+    def admit_spy(queue, priority, n_tasks=1):
+        admitted.append((queue, n_tasks))
+        return admit(queue, priority, n_tasks)
+
+    backpressure.admit = admit_spy
+    monkeypatch.setattr(main, "backpressure", backpressure)
+    return admitted
+
+
+def test_task_rejected_with_retry_after(client, monkeypatch):
+    use_backpressure(
+        monkeypatch,
+        {"weather": {"messages": 4, "ack_rate": 2}},
+        reject_depth=4,
+    )
+    response = client.post(
+        "/weather_script", data={"dataset_date": "2020-01-01"}
+    )
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "2"
+    assert client.sent == []
+
+
+def test_task_demoted(client, monkeypatch):
+    use_backpressure(
+        monkeypatch,
+        {"weather": {"messages": 4}},
+        demote_depth=4,
+        demoted_priority=1,
+    )
+    response = client.post(
+        "/weather_script",
+        data={"dataset_date": "2020-01-01", "task_priority": 7},
+    )
+    assert response.status_code == 201
+    assert client.sent == [("run_weather_script", 1)]
+
+
+def test_range_counts_chunks(client, monkeypatch):
+    admitted = use_backpressure(
+        monkeypatch, {"weather": {"messages": 2}}, reject_depth=5
+    )
+    form = {"date_from": "2020-01-01", "date_to": "2020-01-10"}
+    # 10 дат по 3 даты на задачу - 4 задачи
+    response = client.post(
+        "/weather_script_range", data={**form, "dates_per_task": 3}
+    )
+    assert response.status_code == 429
+    response = client.post(
+        "/weather_script_range", data={**form, "dates_per_task": 5}
+    )
+    assert response.status_code == 201
+    assert admitted == [("weather", 4), ("weather", 2)]
+    assert client.sent == [("run_weather_script_batch", 5)]
+
+
+def test_bulk_counts_tasks_per_queue(client, monkeypatch):
+    admitted = use_backpressure(
+        monkeypatch,
+        {"sar": {"messages": 3}, "weather": {"messages": 0}},
+        reject_depth=4,
+    )
+    sar = {"dataset_date": "2020-01-01"}
+    response = client.post(
+        "/bulk_script",
+        json={"sar": [sar, sar], "pipeline": [sar], "weather": [sar]},
+    )
+    assert response.status_code == 429
+    # Задачи pipeline и weather идут в одну очередь
+    assert admitted[0] == ("sar", 2)
+    admitted.clear()
+    response = client.post(
+        "/bulk_script",
+        json={"sar": [sar], "pipeline": [sar], "weather": [sar]},
+    )
+    assert response.status_code == 201
+    assert admitted == [("sar", 1), ("weather", 2), ("weather", 2)]
+    assert len(client.sent) == 3
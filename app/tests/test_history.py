@@ -0,0 +1,82 @@
+from celery import states
+
+import history
+from history import EXPIRED, TaskHistory
+from worker import TaskItem, TaskState
+
+SUBMITTED = {
+    "queued": states.PENDING,
+    "running": states.PENDING,
+    "done": states.PENDING,
+    "expired": states.STARTED,
+}
+
+
+def create_history(tmp_path, monkeypatch, celery_states):
+    # Состояния задач в бэкенде celery
+    monkeypatch.setattr(
+        TaskItem,
+        "state",
+        property(lambda item: TaskState(name=celery_states[item.id])),
+    )
+    task_history = TaskHistory(tmp_path.joinpath("history.sqlite3"))
+    task_history.add(
+        TaskItem(
+            name="Sentinel SAR",
+            id=task_id,
+            kwargs={"dataset_date": f"2020010{i}"},
+        )
+        for i, task_id in enumerate(SUBMITTED)
+    )
+    with task_history._connect() as conn:
+        conn.executemany(
+            "UPDATE tasks SET state = ? WHERE id = ?",
+            [(state, task_id) for task_id, state in SUBMITTED.items()],
+        )
+    return task_history
+
+
+def test_refresh_states_keeps_queued_tasks(tmp_path, monkeypatch):
+    task_history = create_history(
+        tmp_path,
+        monkeypatch,
+        {
+            "queued": states.PENDING,
+            "running": states.STARTED,
+            "done": states.SUCCESS,
+            # Результат начатой задачи удален из бэкенда
+            "expired": states.PENDING,
+        },
+    )
+    assert [item.id for item in task_history.query(state="PENDING")] == [
+        "queued"
+    ]
+    assert [item.id for item in task_history.query(state="STARTED")] == [
+        "running"
+    ]
+    assert [item.id for item in task_history.query(state=EXPIRED)] == [
+        "expired"
+    ]
+    assert task_history.count(state=states.SUCCESS) == 1
+
+
+def test_refresh_states_by_filters(tmp_path, monkeypatch):
+    polled = []
+    celery_states = {task_id: states.SUCCESS for task_id in SUBMITTED}
+    task_history = create_history(tmp_path, monkeypatch, celery_states)
+    monkeypatch.setattr(
+        history.TaskHistory,
+        "_to_item",
+        staticmethod(
+            lambda task_id, *args: polled.append(task_id)
+            or TaskItem(name="Sentinel SAR", id=task_id, kwargs={})
+        ),
+    )
+    task_history.refresh_states(date="20200102")
+    assert polled == ["done"]
+    # Завершенные задачи больше не опрашиваются
+    task_history.refresh_states()
+    assert sorted(polled) == ["done", "expired", "queued", "running"]
+    polled.clear()
+    task_history.refresh_states()
+    assert polled == []
@@ -1,7 +1,12 @@
-from celery import Celery, states
+from celery import Celery, group, states
+from celery.result import AsyncResult, GroupResult
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pydantic import BaseModel
-from typing import ClassVar
+from typing import ClassVar, List, Optional
 from config import Settings
+from backpressure import Backpressure, amqp_fetcher, management_fetcher
+import asyncio
 
 settings = Settings()
 celery_app = Celery(
@@ -19,6 +24,54 @@ celery_app.conf.task_default_priority = 5
 celery_app.conf.worker_prefetch_multiplier = 1
 celery_app.conf.task_track_started = True
 celery_app.conf.update(result_extended=True)
+# Tasks are routed to the queues of their resource class
+celery_app.conf.task_routes = {
+    "run_sar_script": {"queue": settings.sar_queue},
+    "run_sar_script_batch": {"queue": settings.sar_queue},
+    "run_pipeline_script": {"queue": settings.weather_queue},
+    "run_weather_script": {"queue": settings.weather_queue},
+    "run_weather_script_batch": {"queue": settings.weather_queue},
+}
+# Broker connections are kept open and reused by the publishing threads
+celery_app.conf.broker_pool_limit = settings.publish_threads
+if settings.publish_confirms:
+    celery_app.conf.broker_transport_options = {"confirm_publish": True}
+
+# Queue depth is taken from the management API (if the plugin is enabled)
+# or from AMQP queue declaration
+backpressure = Backpressure(
+    [
+        management_fetcher(
+            f"http://{settings.rabbitmq_hostname}:"
+            + f"{settings.rabbitmq_management_port_number}",
+            settings.rabbitmq_username,
+            settings.rabbitmq_password,
+        ),
+        amqp_fetcher(celery_app),
+    ],
+    ttl=settings.queue_stats_ttl,
+    task_seconds=settings.expected_task_seconds,
+    demote_depth=settings.demote_depth,
+    demoted_priority=settings.demoted_priority,
+    reject_depth=settings.reject_depth,
+)
+
+
+def get_task_queue(task_name: str) -> str:
+    return celery_app.conf.task_routes[task_name]["queue"]
+
+
+def get_queues() -> List[str]:
+    return sorted(
+        set(route["queue"] for route in celery_app.conf.task_routes.values())
+    )
+
+
+# Tasks are published from own threads, so a slow broker does not block
+# the event loop and the default thread pool of the sync endpoints
+publish_executor = ThreadPoolExecutor(
+    max_workers=settings.publish_threads, thread_name_prefix="publisher"
+)
 
 
 class TaskItem(BaseModel):
@@ -34,6 +87,104 @@ class TaskItem(BaseModel):
         frozen = True
 
 
+class BatchItem(TaskItem):
+    # Batch of tasks (celery group), id is the group id
+    @property
+    def result(self) -> Optional[GroupResult]:
+        return GroupResult.restore(self.id, app=celery_app)
+
+    @property
+    def progress(self) -> dict:
+        result = self.result
+        task_states = (
+            [] if result is None else [r.state for r in result.results]
+        )
+        progress = {"total": len(task_states)}
+        progress.update(
+            {name: task_states.count(name) for name in set(task_states)}
+        )
+        return progress
+
+    @property
+    def state(self):
+        progress = self.progress
+        if progress.get(states.FAILURE, 0) > 0:
+            return TaskState(name=states.FAILURE)
+        if progress["total"] == 0:
+            return TaskState(name=states.PENDING)
+        if progress.get(states.SUCCESS, 0) == progress["total"]:
+            return TaskState(name=states.SUCCESS)
+        if progress.get(states.PENDING, 0) == progress["total"]:
+            return TaskState(name=states.PENDING)
+        return TaskState(name=states.STARTED)
+
+
+def send_batch(
+    task_name: str,
+    dataset_dates: List[str],
+    dates_per_task: int,
+    kwargs: dict,
+    priority: int,
+) -> GroupResult:
+    """Split dates into chunks of dates_per_task consecutive dates and send
+    one task per chunk, so per-worker setup is reused for all its dates.
+    Tasks are sent as a group, group result is saved to the backend"""
+    chunks = [
+        dataset_dates[i : i + dates_per_task]
+        for i in range(0, len(dataset_dates), dates_per_task)
+    ]
+    batch = group(
+        celery_app.signature(
+            task_name,
+            kwargs={**kwargs, "dataset_dates": chunk},
+            priority=priority,
+        )
+        for chunk in chunks
+    ).apply_async()
+    batch.save()
+    return batch
+
+
+def send_tasks(tasks: List[tuple]) -> List[AsyncResult]:
+    """Send tasks [(task_name, kwargs, priority), ...] with one producer,
+    so all of them are published over one broker connection and channel"""
+    with celery_app.producer_or_acquire() as producer:
+        return [
+            celery_app.send_task(
+                task_name,
+                kwargs=kwargs,
+                priority=priority,
+                producer=producer,
+            )
+            for task_name, kwargs, priority in tasks
+        ]
+
+
+async def publish(func, *args, **kwargs):
+    """Run blocking publishing function in publish_executor"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        publish_executor, partial(func, *args, **kwargs)
+    )
+
+
+async def send_task_async(
+    task_name: str, kwargs: dict, priority: int
+) -> AsyncResult:
+    return await publish(
+        celery_app.send_task, task_name, kwargs=kwargs, priority=priority
+    )
+
+
+async def send_tasks_async(tasks: List[tuple]) -> List[AsyncResult]:
+    return await publish(send_tasks, tasks)
+
+
+async def send_batch_async(*args, **kwargs) -> GroupResult:
+    """Same as send_batch"""
+    return await publish(send_batch, *args, **kwargs)
+
+
 class TaskState(BaseModel):
     name: str
     icon_mapping: ClassVar[dict] = {
@@ -41,12 +192,16 @@ class TaskState(BaseModel):
         states.STARTED: "history",
         states.PENDING: "hourglass",
         states.FAILURE: "times",
+        states.REVOKED: "ban",
+        "EXPIRED": "question",
     }
     state_class_mapping: ClassVar[dict] = {
         states.SUCCESS: "positive",
         states.STARTED: "warning",
         states.PENDING: "warning",
         states.FAILURE: "error",
+        states.REVOKED: "error",
+        "EXPIRED": "disabled",
     }
 
     @property
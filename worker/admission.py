@@ -0,0 +1,174 @@
+import fcntl
+import json
+import os
+import pathlib
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Dict
+from pydantic import DirectoryPath
+
+
+class MemoryBudget:
+    # Class is sharing memory budget of the node between worker processes.
+    # Reservations are kept in a file guarded by a file lock, so they are
+    # seen by all prefork children (and by workers sharing lock_dir).
+    # Each reservation has a lease which is renewed by a heartbeat thread of
+    # its process, reservations of killed processes (of any container)
+    # expire with their lease
+    def __init__(
+        self,
+        lock_dir: DirectoryPath,
+        budget: int,  # bytes
+        poll_interval: float = 1.0,
+        name: str = "memory",
+        lease: float = 60,  # seconds
+    ):
+        self._name = self.__class__.__name__
+        self.budget = budget
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self._host = socket.gethostname()
+        lock_dir = pathlib.Path(lock_dir)
+        lock_dir.mkdir(parents=True, exist_ok=True)
+        self.state_fp = lock_dir.joinpath(f"{name}.budget")
+        # Reservations of the current process, are renewed by the heartbeat
+        self._held = set()
+        self._held_lock = threading.Lock()
+        self._heartbeat_pid = None
+
+    def _is_alive(self, token: str, entry: Dict, now: float) -> bool:
+        # Token: host:pid:id, processes of the same host are checked at once,
+        # others are kept until their lease expires
+        if now - entry["heartbeat"] > self.lease:
+            return False
+        host, pid, _ = token.split(":")
+        if host != self._host:
+            return True
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    @contextmanager
+    def _locked_state(self):
+        with open(self.state_fp, "a+") as state_file:
+            fcntl.flock(state_file, fcntl.LOCK_EX)
+            try:
+                state_file.seek(0)
+                try:
+                    state: Dict[str, Dict] = json.loads(state_file.read())
+                except ValueError:
+                    state = {}
+                # Reservations of crashed processes are dropped
+                now = time.time()
+                state = {
+                    token: entry
+                    for token, entry in state.items()
+                    if isinstance(entry, dict)
+                    and self._is_alive(token, entry, now)
+                }
+                yield state
+                state_file.seek(0)
+                state_file.truncate()
+                state_file.write(json.dumps(state))
+                state_file.flush()
+            finally:
+                fcntl.flock(state_file, fcntl.LOCK_UN)
+
+    def _start_heartbeat(self) -> None:
+        # Threads are not inherited by forked processes, so each process
+        # starts its own heartbeat
+        if self._heartbeat_pid == os.getpid():
+            return
+        self._heartbeat_pid = os.getpid()
+        with self._held_lock:
+            self._held = set()
+        threading.Thread(
+            target=self._heartbeat, name=self._name, daemon=True
+        ).start()
+
+    def _heartbeat(self) -> None:
+        while True:
+            time.sleep(self.lease / 4)
+            with self._held_lock:
+                held = set(self._held)
+            if not held:
+                continue
+            with self._locked_state() as state:
+                for token in held & state.keys():
+                    state[token]["heartbeat"] = time.time()
+
+    def acquire(self, n_bytes: int) -> str:
+        """Wait until n_bytes are available and reserve them.
+        A reservation bigger than the budget is admitted alone: it is
+        marked as waiting, new reservations wait until it is admitted
+        and released, so it is not starved by smaller ones.
+        Returns token of the reservation"""
+        self._start_heartbeat()
+        token = f"{self._host}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        alone = n_bytes > self.budget
+        since = time.time()
+        waiting = False
+        while True:
+            with self._locked_state() as state:
+                now = time.time()
+                # Reservations bigger than the budget are admitted in order
+                # of their arrival
+                first_waiting = min(
+                    [
+                        (entry["waiting"], other)
+                        for other, entry in state.items()
+                        if entry.get("waiting") is not None
+                    ],
+                    default=None,
+                )
+                used = sum(entry["bytes"] for entry in state.values())
+                if alone:
+                    admitted = (used == 0) and (
+                        (first_waiting is None)
+                        or (first_waiting >= (since, token))
+                    )
+                else:
+                    admitted = (first_waiting is None) and (
+                        (used == 0) or (used + n_bytes <= self.budget)
+                    )
+                if admitted:
+                    state[token] = {"bytes": n_bytes, "heartbeat": now}
+                    with self._held_lock:
+                        self._held.add(token)
+                    return token
+                if alone:
+                    # The mark is renewed by each poll of the waiting process
+                    state[token] = {
+                        "bytes": 0,
+                        "heartbeat": now,
+                        "waiting": since,
+                    }
+            if not waiting:
+                print(
+                    f"{self._name}: waiting for {n_bytes / 2 ** 30:.1f} GB"
+                    + f" ({used / 2 ** 30:.1f}/{self.budget / 2 ** 30:.1f}"
+                    + " GB reserved)"
+                )
+                waiting = True
+            time.sleep(self.poll_interval)
+
+    def release(self, token: str) -> None:
+        with self._held_lock:
+            self._held.discard(token)
+        with self._locked_state() as state:
+            state.pop(token, None)
+
+    @contextmanager
+    def reserve(self, n_bytes: int):
+        token = self.acquire(n_bytes)
+        try:
+            yield
+        finally:
+            self.release(token)
@@ -0,0 +1,241 @@
+import fcntl
+import json
+import os
+import pathlib
+from contextlib import contextmanager
+from typing import Dict, Iterable, Optional
+from pydantic import DirectoryPath, FilePath
+
+
+def _mtime(path: str) -> Optional[int]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+
+def _listdir(path: str, stamp: Dict[str, Optional[int]]) -> list:
+    """List folder and save its mtime to stamp.
+    Hidden files are skipped the same way glob does"""
+    stamp[path] = _mtime(path)
+    if stamp[path] is None:
+        return []
+    try:
+        return sorted(n for n in os.listdir(path) if not n.startswith("."))
+    except NotADirectoryError:
+        return []
+
+
+def _is_current(stamp: Dict[str, Optional[int]]) -> bool:
+    return all(_mtime(path) == mtime for path, mtime in stamp.items())
+
+
+def index_rasters_date(date_dir: str) -> dict:
+    """
+    Resolve paths of all input files of a date folder with rasters.
+    Each folder is listed once instead of probing every file
+
+    Returns:
+    (dict): {"pols": {pol: {raster_fn: {file type: path or None}}},
+             "weather": path or None, "stamp": {folder: mtime}}
+    """
+    stamp = {}
+    _listdir(date_dir, stamp)
+    source_dir = os.path.join(date_dir, "source")
+    source = set(_listdir(source_dir, stamp))
+    weather_dir = os.path.join(date_dir, "weather")
+    weather = [
+        n for n in _listdir(weather_dir, stamp) if n.startswith("wrfout_d03")
+    ]
+    pols = {}
+    for pol in _listdir(os.path.join(date_dir, "rescaled"), stamp):
+        rescaled_dir = os.path.join(date_dir, "rescaled", pol)
+        textures_dir = os.path.join(date_dir, "textures", pol)
+        in_angle_dir = os.path.join(date_dir, "incidence_angles", pol)
+        mask_dir = os.path.join(date_dir, "masks", pol)
+        rescaled = _listdir(rescaled_dir, stamp)
+        textures = set(_listdir(textures_dir, stamp))
+        in_angles = set(_listdir(in_angle_dir, stamp))
+        masks = set(_listdir(mask_dir, stamp))
+
+        def resolve(folder, names, fn):
+            return os.path.join(folder, fn) if fn in names else None
+
+        scenes = {}
+        for raster_fn in rescaled:
+            raster_name, ext = os.path.splitext(raster_fn)
+            if ext != ".tif":
+                continue
+            scenes[raster_fn] = {
+                "rescaled": os.path.join(rescaled_dir, raster_fn),
+                "simple": resolve(
+                    textures_dir, textures, f"{raster_name}_simple{ext}"
+                ),
+                "advanced": resolve(
+                    textures_dir, textures, f"{raster_name}_advanced{ext}"
+                ),
+                "in_angle": resolve(in_angle_dir, in_angles, raster_fn),
+                "mask": resolve(mask_dir, masks, raster_fn),
+                "source": resolve(source_dir, source, f"{raster_name}.zip"),
+            }
+        pols[pol] = scenes
+    return {
+        "pols": pols,
+        "weather": os.path.join(weather_dir, weather[0]) if weather else None,
+        "stamp": stamp,
+    }
+
+
+def index_icemaps_date(date_dir: str) -> dict:
+    """
+    Resolve path of the marked icemap of a date folder with icemaps
+
+    Returns:
+    (dict): {"icemap": path or None, "stamp": {folder: mtime}}
+    """
+    stamp = {}
+    _listdir(date_dir, stamp)
+    _listdir(os.path.join(date_dir, "map"), stamp)
+    icemap_dir = os.path.join(date_dir, "map", "source")
+    icemaps = [
+        n for n in _listdir(icemap_dir, stamp) if n.endswith("_marked.shp")
+    ]
+    return {
+        "icemap": os.path.join(icemap_dir, icemaps[0]) if icemaps else None,
+        "stamp": stamp,
+    }
+
+
+class SourceCatalog:
+    # Class is indexing input files of multiple data sources by date.
+    # Index is kept on disk, so it is shared by worker processes and restarts
+    _indexers = {"rasters": index_rasters_date, "icemaps": index_icemaps_date}
+
+    def __init__(
+        self,
+        rasters_volumes_root: DirectoryPath,
+        icemaps_volumes_root: DirectoryPath,
+        index_fp: FilePath,
+        lock_dir: Optional[DirectoryPath] = None,
+    ):
+        """If lock_dir is set, updates of the index are serialized between
+        processes with a file lock, so they do not overwrite each other"""
+        self._name = self.__class__.__name__
+        self.volumes_roots = {
+            "rasters": pathlib.Path(rasters_volumes_root),
+            "icemaps": pathlib.Path(icemaps_volumes_root),
+        }
+        self.index_fp = pathlib.Path(index_fp)
+        self.index_fp.parent.mkdir(parents=True, exist_ok=True)
+        self.lock_dir = None if lock_dir is None else pathlib.Path(lock_dir)
+        if self.lock_dir is not None:
+            self.lock_dir.mkdir(parents=True, exist_ok=True)
+        self._index = {"rasters": {}, "icemaps": {}}
+        self._index_mtime = None
+        self._load()
+
+    def _load(self, force: bool = False) -> None:
+        # Index could be updated by another process. Unless forced, it is
+        # not read again while its mtime is unchanged (mtime can be as
+        # coarse as a second, so updates reload it under the lock)
+        mtime = _mtime(str(self.index_fp))
+        if (mtime is None) or ((mtime == self._index_mtime) and not force):
+            return
+        try:
+            with open(self.index_fp, "r") as f:
+                self._index = json.load(f)
+            self._index_mtime = mtime
+        except (OSError, ValueError):
+            print(f"{self._name}: index is broken, it will be rebuilt")
+
+    @contextmanager
+    def _locked(self):
+        if self.lock_dir is None:
+            yield
+            return
+        lock_fp = self.lock_dir.joinpath(f"{self.index_fp.stem}.catalog.lock")
+        with open(lock_fp, "a+") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _save(self) -> None:
+        # Index is replaced atomically, so readers never see a partial file
+        tmp_fp = self.index_fp.with_name(
+            f".{self.index_fp.name}.{os.getpid()}.tmp"
+        )
+        with open(tmp_fp, "w") as f:
+            json.dump(self._index, f, separators=(",", ":"))
+        os.replace(tmp_fp, self.index_fp)
+        self._index_mtime = _mtime(str(self.index_fp))
+
+    def _find_date_dir(self, kind: str, date: str) -> Optional[str]:
+        # If the date is provided by several volumes, the first one is used
+        for volume in sorted(self.volumes_roots[kind].iterdir()):
+            date_dir = volume.joinpath(date)
+            if date_dir.is_dir():
+                return str(date_dir)
+        return None
+
+    def _update_date(self, kind: str, date: str, date_dir: str) -> bool:
+        entry = self._index[kind].get(date)
+        if (
+            (entry is not None)
+            and (entry["dir"] == date_dir)
+            and _is_current(entry["stamp"])
+        ):
+            return False
+        entry = self._indexers[kind](date_dir)
+        entry["dir"] = date_dir
+        self._index[kind][date] = entry
+        print(f"{self._name}: {kind} {date} indexed ({date_dir})")
+        return True
+
+    def update(self, dates: Optional[Iterable[str]] = None) -> None:
+        """Index new and changed date folders of every source volume.
+        If dates are given, only these dates are checked"""
+        # Index is loaded, changed and saved under the lock, so changes
+        # made by other processes are not lost
+        with self._locked():
+            self._update(dates)
+
+    def _update(self, dates: Optional[Iterable[str]] = None) -> None:
+        self._load(force=True)
+        changed = False
+        for kind, volumes_root in self.volumes_roots.items():
+            if dates is None:
+                date_dirs = {}
+                for volume in sorted(volumes_root.iterdir()):
+                    for date_dir in volume.iterdir():
+                        if date_dir.is_dir():
+                            date_dirs.setdefault(date_dir.name, str(date_dir))
+                # Dates which were removed from all volumes
+                for date in set(self._index[kind]) - set(date_dirs):
+                    del self._index[kind][date]
+                    changed = True
+            else:
+                date_dirs = {
+                    date: self._find_date_dir(kind, date) for date in dates
+                }
+            for date, date_dir in date_dirs.items():
+                if date_dir is None:
+                    changed |= self._index[kind].pop(date, None) is not None
+                    continue
+                changed |= self._update_date(kind, date, date_dir)
+        if changed:
+            self._save()
+
+    def get_scenes(self, date: str) -> Dict[str, Dict[str, dict]]:
+        """Returns {pol: {raster_fn: {file type: path or None}}}"""
+        entry = self._index["rasters"].get(date)
+        return {} if entry is None else entry["pols"]
+
+    def get_weather(self, date: str) -> Optional[str]:
+        entry = self._index["rasters"].get(date)
+        return None if entry is None else entry["weather"]
+
+    def get_icemap(self, date: str) -> Optional[str]:
+        entry = self._index["icemaps"].get(date)
+        return None if entry is None else entry["icemap"]
@@ -1,10 +1,15 @@
-from celery import Celery
-from celery.signals import worker_shutdown
+from celery import Celery, states
+from celery.signals import worker_init, worker_shutdown
+from kombu import Queue
 from pydantic import BaseModel
 from pathlib import Path
-from typing import List
+from typing import List, Optional
 
+import admission
+import catalog
 import ds_arrays
+import gdal_profile
+import label_index
 import multisource
 from config import Settings
 
@@ -21,6 +26,10 @@ class BindMounts(BaseModel):
     land: Path = "/home/user/worker/land"
     # Output directory that will contain final datasets
     output: Path = "/home/user/worker/output"
+    # Lock files used to coordinate sources sync between worker processes
+    sync_locks: Path = "/home/user/worker/locks"
+    # Index of input files of all sources
+    catalog: Path = "/home/user/worker/catalog/index.json"
 
 
 mounts = BindMounts()
@@ -30,12 +39,16 @@ settings = Settings()
 def get_dg_app():
     # Create MultiDataGatherer app to collect and sync
     # required input data from multiple sources
-    dg_app = multisource.MultiDataGatherer()
+    dg_app = multisource.MultiDataGatherer(
+        lock_dir=mounts.sync_locks if settings.coordinated_sync else None,
+        freshness=settings.sync_freshness,
+    )
 
     rasters_dg = multisource.DataGatherer(
         mounts.rasters_volume,
         mounts.rasters,
         link_folders_only=settings.link_only_folders,
+        shared=settings.coordinated_sync,
     )
     dg_app.add_app("rasters", rasters_dg)
 
@@ -43,6 +56,7 @@ def get_dg_app():
         mounts.icemaps_volume,
         mounts.icemaps,
         link_folders_only=settings.link_only_folders,
+        shared=settings.coordinated_sync,
     )
     dg_app.add_app("icemaps", icemaps_dg)
 
@@ -51,6 +65,45 @@ def get_dg_app():
 
 dg_app = get_dg_app()
 
+# Date-indexed catalog of input files, it is used by tasks
+# instead of searching files in the gathering places
+sources_catalog = (
+    catalog.SourceCatalog(
+        mounts.rasters_volume,
+        mounts.icemaps_volume,
+        mounts.catalog,
+        lock_dir=mounts.sync_locks,
+    )
+    if settings.use_catalog
+    else None
+)
+
+# Land and recent icemaps loaded into memory of the worker process
+vector_cache = (
+    ds_arrays.VectorCache(max_icemaps=settings.vector_cache_icemaps)
+    if settings.vector_cache_icemaps > 0
+    else None
+)
+
+# Memory budget shared by the pool processes of all worker containers of
+# the node (locks volume), each scene waits for its estimated memory
+# before it is loaded
+memory_budget = (
+    admission.MemoryBudget(
+        mounts.sync_locks,
+        int(gdal_profile.get_memory_limit() * settings.memory_budget_fraction),
+    )
+    if settings.memory_budget_fraction > 0
+    else None
+)
+
+# Class fractions of the produced datasets, is queried by the app
+labels = (
+    label_index.LabelIndex(mounts.output.joinpath("label_index.sqlite3"))
+    if settings.label_index
+    else None
+)
+
 # Main Celery app
 celery_app = Celery(
     settings.celery_app_name,
@@ -67,11 +120,60 @@ celery_app.conf.task_default_priority = 5
 celery_app.conf.worker_prefetch_multiplier = 1
 celery_app.conf.task_track_started = True
 celery_app.conf.update(result_extended=True)
+# Each resource class of tasks has its own queue, so worker pools are
+# sized per queue (-Q, -c). Without -Q the worker consumes all queues
+celery_app.conf.task_queues = [
+    Queue(settings.sar_queue),
+    Queue(settings.weather_queue),
+    Queue(celery_app.conf.task_default_queue),
+]
+celery_app.conf.task_routes = {
+    "run_sar_script": {"queue": settings.sar_queue},
+    "run_sar_script_batch": {"queue": settings.sar_queue},
+    # SAR + weather task keeps weather arrays in memory
+    "run_pipeline_script": {"queue": settings.weather_queue},
+    "run_weather_script": {"queue": settings.weather_queue},
+    "run_weather_script_batch": {"queue": settings.weather_queue},
+}
+
+
+@worker_init.connect
+def on_init(sender=None, conf=None, **kwargs):
+    # GDAL options are set before the pool processes are forked
+    if settings.gdal_profile:
+        gdal_profile.apply_gdal_options(
+            gdal_profile.get_gdal_options(
+                num_workers=settings.celery_num_workers,
+                cache_fraction=settings.gdal_cache_fraction,
+                num_threads=settings.gdal_threads_per_worker,
+                cpu_fraction=settings.gdal_cpu_fraction,
+                vsi_cache_size=settings.gdal_vsi_cache_size,
+            )
+        )
+    # Watchers are started in the main worker process only,
+    # threads are not inherited by the forked pool processes
+    if settings.sync_watch_interval > 0:
+        dg_app.start_watcher(settings.sync_watch_interval)
+    # Index all sources once, tasks update only their dates later
+    if sources_catalog is not None:
+        sources_catalog.update()
 
 
 @worker_shutdown.connect
 def on_shutdown(sender=None, conf=None, **kwargs):
-    dg_app.prune()
+    dg_app.stop_watcher()
+    # Links of the shared gathering places may be used by other workers
+    if not settings.coordinated_sync:
+        dg_app.prune()
+
+
+def sync_sources(dataset_dates: List[str], apps: Optional[List[str]] = None):
+    # sync input sources (only apps if given) for dataset dates.
+    # Gathering places are synced in both modes (coordinated between
+    # processes), the catalog is used by tasks to locate input files
+    dg_app.sync(apps=apps)
+    if sources_catalog is not None:
+        sources_catalog.update(dates=dataset_dates)
 
 
 # Arguments expected and used by 'run_sar_script' task
@@ -84,20 +186,18 @@ class RunSarScriptTaskArguments(BaseModel):
     # Haralick texture features to add
     simple: List[str] = []
     advanced: List[str] = []
+    # Training patches store, 0 - disabled
+    patch_size: int = 0
+    patch_stride: int = 0  # 0 - equal to patch_size
+    patch_min_label_fraction: float = 0.0
 
 
-@celery_app.task(bind=True, name="run_sar_script", acks_late=True)
-def run_script(self, **kwargs):
-    # Filter input arguments by using model RunSarScriptTaskArguments
-    args = RunSarScriptTaskArguments(**kwargs).dict()
-    dg_app.sync()  # sync input all input sources fist
-
-    args["ice_params"] = (
-        "age " * args["age"]
-        + "concentrat " * args["concentrat"]
-        + "age_group" * args["age_group"]
-    )
-    print("task_id: " + self.request.id)
+def create_sar_ds(args: dict, with_weather: bool = False):
+    args["ice_params"] = [
+        ice_param
+        for ice_param in ["age", "concentrat", "age_group"]
+        if args[ice_param]
+    ]
     print(args)
 
     ds_arrays.create_ds_arrays(
@@ -109,8 +209,73 @@ def run_script(self, **kwargs):
         args["ice_params"],
         simple_band_nums=ds_arrays.get_band_nums(args["simple"]),
         advanced_band_nums=ds_arrays.get_band_nums(args["advanced"]),
+        catalog=sources_catalog,
+        weather_params=ds_arrays.weather_params if with_weather else None,
+        channel_types=(
+            ds_arrays.get_channel_types(settings.float16_textures)
+            if settings.compact_channels
+            else None
+        ),
+        crop=settings.crop_output,
+        tile_size=settings.tile_size,
+        min_valid_fraction=settings.min_tile_valid_fraction,
+        patch_size=args["patch_size"],
+        patch_stride=args["patch_stride"],
+        min_label_fraction=args["patch_min_label_fraction"],
+        patch_shard_size=settings.patch_shard_size,
+        patch_shuffle_shards=settings.patch_shuffle_shards,
+        simplify_vectors=settings.simplify_vectors,
+        vector_cache=vector_cache,
+        memory_budget=memory_budget,
+        pipeline_depth=settings.pipeline_depth,
+        pyramid_levels=settings.pyramid_levels,
+        ice_resampling=settings.pyramid_ice_resampling,
+        stats=settings.dataset_stats,
+        label_index=labels,
+        label_tile_size=settings.label_tile_size,
     )
 
+
+@celery_app.task(bind=True, name="run_sar_script", acks_late=True)
+def run_script(self, **kwargs):
+    # Filter input arguments by using model RunSarScriptTaskArguments
+    args = RunSarScriptTaskArguments(**kwargs).dict()
+    sync_sources([args["dataset_date"]])  # sync input all input sources fist
+
+    print("task_id: " + self.request.id)
+    create_sar_ds(args)
+
+    return True
+
+
+@celery_app.task(bind=True, name="run_sar_script_batch", acks_late=True)
+def run_sar_script_batch(self, dataset_dates: List[str], **kwargs):
+    # All dates of the batch are processed in one worker process,
+    # sources are synced once for all of them
+    sync_sources(dataset_dates)
+
+    print("task_id: " + self.request.id)
+    for i, dataset_date in enumerate(dataset_dates):
+        self.update_state(
+            state=states.STARTED,
+            meta={"done": i, "total": len(dataset_dates)},
+        )
+        kwargs["dataset_date"] = dataset_date
+        create_sar_ds(RunSarScriptTaskArguments(**kwargs).dict())
+
+    return True
+
+
+@celery_app.task(bind=True, name="run_pipeline_script", acks_late=True)
+def run_pipeline_script(self, **kwargs):
+    # SAR and weather datasets are created in one pass over the rasters,
+    # arguments are the same as for 'run_sar_script' task
+    args = RunSarScriptTaskArguments(**kwargs).dict()
+    sync_sources([args["dataset_date"]])  # sync input all input sources fist
+
+    print("task_id: " + self.request.id)
+    create_sar_ds(args, with_weather=True)
+
     return True
 
 
@@ -119,13 +284,7 @@ class RunWeatherScriptTaskArguments(BaseModel):
     dataset_date: str  # date in format: %Y%m%d
 
 
-@celery_app.task(bind=True, name="run_weather_script", acks_late=True)
-def run_weather_script(self, **kwargs):
-    # Filter input arguments by using model RunWeatherScriptTaskArguments
-    args = RunWeatherScriptTaskArguments(**kwargs).dict()
-    dg_app.rasters.sync()  # sync input raster sources fist
-
-    print("task_id: " + self.request.id)
+def create_weather_ds(args: dict):
     print(args)
 
     ds_arrays.create_weather_ds(
@@ -133,6 +292,38 @@ def run_weather_script(self, **kwargs):
         args["dataset_date"],
         mounts.output,
         ds_arrays.weather_params,
+        catalog=sources_catalog,
+        memory_budget=memory_budget,
+        pipeline_depth=settings.pipeline_depth,
     )
 
+
+@celery_app.task(bind=True, name="run_weather_script", acks_late=True)
+def run_weather_script(self, **kwargs):
+    # Filter input arguments by using model RunWeatherScriptTaskArguments
+    args = RunWeatherScriptTaskArguments(**kwargs).dict()
+    # sync input raster sources fist
+    sync_sources([args["dataset_date"]], apps=["rasters"])
+
+    print("task_id: " + self.request.id)
+    create_weather_ds(args)
+
+    return True
+
+
+@celery_app.task(bind=True, name="run_weather_script_batch", acks_late=True)
+def run_weather_script_batch(self, dataset_dates: List[str], **kwargs):
+    # All dates of the batch are processed in one worker process,
+    # sources are synced once for all of them
+    sync_sources(dataset_dates, apps=["rasters"])
+
+    print("task_id: " + self.request.id)
+    for i, dataset_date in enumerate(dataset_dates):
+        self.update_state(
+            state=states.STARTED,
+            meta={"done": i, "total": len(dataset_dates)},
+        )
+        kwargs["dataset_date"] = dataset_date
+        create_weather_ds(RunWeatherScriptTaskArguments(**kwargs).dict())
+
     return True
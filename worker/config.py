@@ -10,7 +10,66 @@ class Settings(BaseSettings):
     redis_password: str
     redis_hostname: str
     flower_port: str
+    celery_num_workers: int = 1
+    # Queues of CPU-heavy SAR tasks and memory-heavy weather tasks
+    sar_queue: str = "sar"
+    weather_queue: str = "weather"
     link_only_folders: bool = True  # is used by DataGatherer
+    # Interval (seconds) of DataGatherer background sync, 0 - disabled
+    sync_watch_interval: float = 0
+    # Coordinate DataGatherer sync between worker processes with file locks
+    coordinated_sync: bool = True
+    # Seconds during which a sync made by one process is reused by others
+    sync_freshness: float = 10
+    # Locate input files with the date-indexed catalog (is used by tasks)
+    use_catalog: bool = True
+    # Save datasets in the compact layout with a data type per channel
+    compact_channels: bool = False
+    # Store textures as float16 in the compact layout
+    float16_textures: bool = False
+    # Save only the bounding box of the valid data of each raster
+    crop_output: bool = False
+    # Save only tiles with enough valid data, 0 - disabled
+    tile_size: int = 0
+    min_tile_valid_fraction: float = 0.5
+    # Number of downsampled (2x, 4x, ...) copies of each dataset, 0 - disabled
+    pyramid_levels: int = 0
+    # Resampling of ice channels in the pyramid: mode or nearest
+    pyramid_ice_resampling: str = "mode"
+    # Save channel statistics and ice class histograms with each dataset
+    dataset_stats: bool = False
+    # Index class fractions of each dataset and of its tiles (label_tile_size
+    # if tile_size is 0) in output/label_index.sqlite3
+    label_index: bool = False
+    label_tile_size: int = 256
+    # Simplify icemap and land geometries to the scene resolution
+    simplify_vectors: bool = False
+    # Number of icemaps kept in memory by each worker process, 0 - disabled
+    vector_cache_icemaps: int = 2
+    # Number of patches in one shard of the training patches store
+    patch_shard_size: int = 256
+    # Patches are shuffled across scenes in a buffer of this many shards
+    patch_shuffle_shards: int = 8
+    # GDAL performance profile applied when the worker starts
+    gdal_profile: bool = True
+    # Fraction of the container memory for GDAL block caches of all workers
+    # of the service (services sharing the host split it, see docker-compose)
+    gdal_cache_fraction: float = 0.25
+    # Fraction of CPUs for GDAL threads of all workers of the service
+    gdal_cpu_fraction: float = 1.0
+    # GDAL threads of each worker, 0 - CPUs of the service divided between
+    # its workers
+    gdal_threads_per_worker: int = 0
+    # Read cache (bytes) of each opened file, 0 - disabled
+    gdal_vsi_cache_size: int = 25 * 2**20
+    # Fraction of the container memory limit (host memory without a limit)
+    # shared by scenes processed by all worker processes (admission control),
+    # 0 - disabled. The budget is shared through the locks folder, which is
+    # a volume common to the worker containers of the node
+    memory_budget_fraction: float = 0
+    # Number of scenes read ahead while the current one is processed
+    # (and of arrays waiting to be saved), 0 - sequential processing
+    pipeline_depth: int = 1
 
     class Config:
         env_file = ".env"
@@ -5,10 +5,18 @@ import zipfile
 import xml.etree.ElementTree as ET
 import numpy as np
 import gc
+import json
 import argparse
+import zlib
+from functools import lru_cache
 from scipy.interpolate import RectBivariateSpline
 from scipy.spatial import cKDTree
 
+from catalog import index_icemaps_date, index_rasters_date
+from patches import PatchShardWriter
+from pipeline import BackgroundWriter, Prefetcher
+from stats import CLASS_OFFSET, DateStats, add_channel_stats, class_counts
+
 # import gdal, osr
 
 
@@ -158,6 +166,142 @@ def get_geodata_from_raster(raster):
     return x_res, y_res, gt, gcp_list, spatial_ref_wkt
 
 
+def get_raster_footprint(raster):
+    """
+    Get bounding box of a raster from its geotransform or GCPs
+    (pixels are not read)
+
+    Parameters:
+    raster (gdal raster): Input raster
+
+    Returns:
+    x_min, y_min, x_max, y_max (tuple): Bounding box in the raster spatial reference
+    """
+    x_res, y_res, gt, gcp_list, _ = get_geodata_from_raster(raster)
+    if gt is not None:
+        corners = [(0, 0), (x_res, 0), (0, y_res), (x_res, y_res)]
+        xs = [gt[0] + px * gt[1] + py * gt[2] for px, py in corners]
+        ys = [gt[3] + px * gt[4] + py * gt[5] for px, py in corners]
+    else:
+        xs = [gcp.GCPX for gcp in gcp_list]
+        ys = [gcp.GCPY for gcp in gcp_list]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def icemap_covers(icemap, raster, ice_param_types):
+    """
+    Cheap check that the icemap can contain information for the raster:
+    for each ice parameter there is a feature with this parameter whose
+    envelope intersects the raster footprint. Note: check that the
+    projections of the icemap and the raster match
+
+    Parameters:
+    icemap (gdal vector dataset): Icemap
+    raster (gdal raster): Raster
+    ice_param_types (list): Ice parameters
+
+    Returns:
+    (bool): False if the raster certainly has no icemap coverage
+    """
+    layer = icemap.GetLayer()
+    x_min, y_min, x_max, y_max = get_raster_footprint(raster)
+    # Экстент слоя: (x_min, x_max, y_min, y_max)
+    l_x_min, l_x_max, l_y_min, l_y_max = layer.GetExtent()
+    if (
+        (x_max < l_x_min)
+        or (x_min > l_x_max)
+        or (y_max < l_y_min)
+        or (y_min > l_y_max)
+    ):
+        return False
+    layer.SetSpatialFilterRect(x_min, y_min, x_max, y_max)
+    try:
+        for ice_param_type in ice_param_types:
+            layer.SetAttributeFilter(f"{ice_param_type} IS NOT NULL")
+            if layer.GetFeatureCount() == 0:
+                return False
+    finally:
+        # Сброс фильтров
+        layer.SetAttributeFilter(None)
+        layer.SetSpatialFilter(None)
+    return True
+
+
+def clip_vector(in_ds, raster, simplify=False):
+    """
+    Copy features of a vector dataset that intersect the raster footprint
+    into an in-memory dataset. It is made once per scene and then burned
+    for each ice parameter instead of the whole source layer
+
+    Parameters:
+    in_ds (gdal vector dataset): Source dataset (icemap, land)
+    raster (gdal raster): Scene raster
+    simplify (bool): Simplify geometries with tolerance of half a pixel
+                     of the raster, so details finer than the raster
+                     resolution are not processed by gdal.Rasterize
+
+    Returns:
+    (gdal vector dataset): In-memory dataset
+    """
+    x_min, y_min, x_max, y_max = get_raster_footprint(raster)
+    options = []
+    if simplify:
+        pixel_size = min(
+            (x_max - x_min) / raster.RasterXSize,
+            (y_max - y_min) / raster.RasterYSize,
+        )
+        options = ["-simplify", str(pixel_size / 2)]
+    return gdal.VectorTranslate(
+        "",
+        in_ds,
+        options=gdal.VectorTranslateOptions(
+            options=options,
+            format="Memory",
+            spatFilter=[x_min, y_min, x_max, y_max],
+        ),
+    )
+
+
+class VectorCache:
+    # Class is keeping vector datasets (land, icemaps) loaded into memory,
+    # so each of them is read from disk once per worker process.
+    # Datasets are keyed by path and mtime, changed files are reloaded
+    def __init__(self, max_icemaps=2):
+        self._name = self.__class__.__name__
+        self.max_icemaps = max_icemaps
+        self._datasets = {}  # {path: (mtime, dataset)}
+        self._icemaps = []  # icemap paths, the most recently used is the last
+
+    def _load(self, fp):
+        mtime = os.stat(fp).st_mtime_ns
+        cached = self._datasets.get(fp)
+        if (cached is not None) and (cached[0] == mtime):
+            return cached[1]
+        ds = gdal.OpenEx(fp)
+        if ds is None:
+            return None
+        mem_ds = gdal.VectorTranslate("", ds, format="Memory")
+        self._datasets[fp] = (mtime, mem_ds)
+        print(f"{self._name}: {fp} loaded")
+        return mem_ds
+
+    def get_land(self, fp):
+        """Land dataset is kept while the process is running"""
+        return self._load(fp)
+
+    def get_icemap(self, fp):
+        """Only max_icemaps of the recently used icemaps are kept"""
+        ds = self._load(fp)
+        if fp in self._icemaps:
+            self._icemaps.remove(fp)
+        self._icemaps.append(fp)
+        while len(self._icemaps) > self.max_icemaps:
+            old_fp = self._icemaps.pop(0)
+            self._datasets.pop(old_fp, None)
+            print(f"{self._name}: {old_fp} evicted")
+        return ds
+
+
 def create_empty_raster(
     x_res,
     y_res,
@@ -289,10 +433,18 @@ def burn(
         target_band = target.GetRasterBand(1)
         target_band.WriteArray(base_array)
     layer = in_ds.GetLayer()
+    # Прожигаются только объекты, пересекающие экстент снимка
+    layer.SetSpatialFilterRect(*get_raster_footprint(target))
     # Если необходимо прожечь значения из колонки геофайла
     if burn_param is not None:
         # Проверка наличия требуемого параметра в in_ds
-        if burn_param not in in_ds.GetLayer()[0].keys():
+        layer_defn = layer.GetLayerDefn()
+        field_names = [
+            layer_defn.GetFieldDefn(i).GetName()
+            for i in range(layer_defn.GetFieldCount())
+        ]
+        if burn_param not in field_names:
+            layer.SetSpatialFilter(None)
             raise RuntimeError(f"{burn_param} not in in_ds")
         # Все фичи в слое фильтруются, чтобы не было пустых значений, т.к. при их наличии они будут прожжены 1  независимо от no_data_value
         layer.SetAttributeFilter(f"{burn_param} IS NOT NULL")
@@ -306,8 +458,9 @@ def burn(
         )
     # Непостредственно прожиг
     gdal.Rasterize(target, in_ds, options=rasterizeOptions)
-    # Сброс фильтра
+    # Сброс фильтров
     layer.SetAttributeFilter(None)
+    layer.SetSpatialFilter(None)
     return target
 
 
@@ -319,6 +472,7 @@ def create_ice_mask(
     param_type="age_group",
     land_value=-99,
     na_value=-99,
+    mask_arr=None,
 ):
     ice_raster = burn(
         icemap,
@@ -334,7 +488,9 @@ def create_ice_mask(
         no_data_value=na_value,
     )
     ice_arr = ice_raster.ReadAsArray()
-    ice_arr[mask_raster.ReadAsArray() == 1] = na_value
+    if mask_arr is None:
+        mask_arr = mask_raster.ReadAsArray()
+    ice_arr[mask_arr == 1] = na_value
     return ice_arr
 
 
@@ -349,8 +505,12 @@ def select_textures(textures_raster, band_nums=None):
             raise RuntimeError(
                 f"Band numbers must be less than {textures_raster.RasterCount}"
             )
-    textures_arr = textures_raster.ReadAsArray()
-    return [textures_arr[band_num, :, :] for band_num in band_nums]
+    # Читаются только выбранные каналы и по одному, чтобы в памяти
+    # не держать весь многоканальный растр текстур
+    return (
+        textures_raster.GetRasterBand(band_num + 1).ReadAsArray()
+        for band_num in band_nums
+    )
 
 
 def equal_size(
@@ -377,6 +537,73 @@ def equal_size(
     return True
 
 
+def get_channel_types(float16_textures=False):
+    """
+    Returns data types of the channels for the compact (typed) dataset layout
+
+    Parameters:
+    float16_textures (bool): Store textures as float16 (scaled to [0, 1] per channel)
+
+    Returns:
+    (dict): {channel kind: numpy data type name}
+    """
+    textures_type = "float16" if float16_textures else "float32"
+    return {
+        "rescaled": "float32",
+        "in_angle": "float32",
+        "simple": textures_type,
+        "advanced": textures_type,
+        # Категориальные значения льда (0-10) и na_value (-99)
+        "ice": "int8",
+    }
+
+
+def get_channel_names(
+    simple_textures_raster,
+    advanced_textures_raster,
+    ice_param_types,
+    simple_band_nums=None,
+    advanced_band_nums=None,
+):
+    """
+    Returns kinds and names of all channels of the stacked array in order
+
+    Returns:
+    (list): [(channel kind, channel name), ...]
+    """
+    if simple_band_nums is None:
+        simple_band_nums = range(simple_textures_raster.RasterCount)
+    if advanced_band_nums is None:
+        advanced_band_nums = range(advanced_textures_raster.RasterCount)
+    return (
+        [("rescaled", "rescaled"), ("in_angle", "in_angle")]
+        + [("simple", f"simple_{i}") for i in simple_band_nums]
+        + [("advanced", f"advanced_{i}") for i in advanced_band_nums]
+        + [("ice", ice_param_type) for ice_param_type in ice_param_types]
+    )
+
+
+def write_channel(stacked, channel, arr, na_value=-99):
+    """
+    Write channel array to the typed stacked array, converting it to the
+    channel data type. float16 channels are scaled to [0, 1] by their valid
+    (not na_value) values, scale and offset are saved to channel
+    (original = stored * scale + offset), na_value is stored as NaN
+    """
+    name = channel["name"]
+    if channel["dtype"] == "float16":
+        valid = (arr != na_value) & ~np.isnan(arr)
+        offset, scale = 0.0, 1.0
+        if valid.any():
+            offset = float(arr[valid].min())
+            scale = float(arr[valid].max()) - offset
+            scale = scale if scale > 0 else 1.0
+        channel.update({"scale": scale, "offset": offset, "nodata": "nan"})
+        stacked[name] = np.where(valid, (arr - offset) / scale, np.nan)
+    else:
+        stacked[name] = arr
+
+
 def create_stacked(
     rescaled_raster,
     in_angle_raster,
@@ -390,7 +617,33 @@ def create_stacked(
     advanced_band_nums=None,
     land_value=-99,
     na_value=-99,
+    channel_types=None,
+    simplify_vectors=False,
+    arrays=None,
+    clip_vectors=True,
+    stats=False,
 ):
+    """
+    Stack scene rasters and ice parameters into one array
+
+    If channel_types is None, all channels are stacked into (y, x, channel)
+    array of a common data type. Otherwise the array is structured (y, x)
+    with a field for each channel, each channel is converted to its data type
+    (see get_channel_types) when it is written.
+    Icemap and land are clipped to the scene once for all ice parameters
+    (see clip_vector), simplify_vectors is passed to it. If clip_vectors is
+    False, icemap and land are expected to be clipped already.
+    If arrays are given (see read_scene_arrays), pixels are taken from them
+    instead of the rasters.
+    If stats is True, statistics of each channel (class histograms for ice
+    channels) ignoring na_value are added to channels while the channel is
+    written (see stats.add_channel_stats).
+
+    Returns:
+    stacked, channels (tuple):
+      stacked (np.ndarray): Stacked array
+      channels (list): [{"name", "kind", "dtype", "scale", "offset"}, ...]
+    """
     if not equal_size(
         rescaled_raster,
         in_angle_raster,
@@ -400,18 +653,84 @@ def create_stacked(
     ):
         print("The arrays are not the same size")
         return
-    stack = [rescaled_raster.ReadAsArray(), in_angle_raster.ReadAsArray()]
+    channel_names = get_channel_names(
+        simple_textures_raster,
+        advanced_textures_raster,
+        ice_param_types,
+        simple_band_nums=simple_band_nums,
+        advanced_band_nums=advanced_band_nums,
+    )
+    channels = [
+        {
+            "name": name,
+            "kind": kind,
+            "dtype": None if channel_types is None else channel_types[kind],
+            "scale": 1.0,
+            "offset": 0.0,
+        }
+        for kind, name in channel_names
+    ]
+    stack = []
+    stacked = None
+    if channel_types is not None:
+        stacked = np.empty(
+            (rescaled_raster.RasterYSize, rescaled_raster.RasterXSize),
+            dtype=[(c["name"], c["dtype"]) for c in channels],
+        )
+    channels_iter = iter(channels)
+
+    def read(name, read_func):
+        # Прочитанные заранее массивы освобождаются по мере использования
+        if arrays is not None:
+            return arrays.pop(name)
+        return read_func()
+
+    def add_channels(arrs):
+        # Каналы пишутся в итоговый массив сразу с приведением типа
+        for arr in arrs:
+            channel = next(channels_iter)
+            if stats:
+                add_channel_stats(channel, arr, na_value=na_value)
+            if stacked is None:
+                stack.append(arr)
+            else:
+                write_channel(stacked, channel, arr, na_value=na_value)
+
+    add_channels(
+        [
+            read("rescaled", rescaled_raster.ReadAsArray),
+            read("in_angle", in_angle_raster.ReadAsArray),
+        ]
+    )
     print("Add rescaled, in_angle")
     if (simple_band_nums is None) or (len(simple_band_nums) != 0):
-        stack += select_textures(
-            simple_textures_raster, band_nums=simple_band_nums
+        add_channels(
+            read(
+                "simple",
+                lambda: select_textures(
+                    simple_textures_raster, band_nums=simple_band_nums
+                ),
+            )
         )
         print("Add simple textures")
     if (advanced_band_nums is None) or (len(advanced_band_nums) != 0):
-        stack += select_textures(
-            advanced_textures_raster, band_nums=advanced_band_nums
+        add_channels(
+            read(
+                "advanced",
+                lambda: select_textures(
+                    advanced_textures_raster, band_nums=advanced_band_nums
+                ),
+            )
         )
         print("Add advanced textures")
+    if clip_vectors:
+        icemap = clip_vector(
+            icemap, rescaled_raster, simplify=simplify_vectors
+        )
+        land_ds = clip_vector(
+            land_ds, rescaled_raster, simplify=simplify_vectors
+        )
+    mask_arr = read("mask", mask_raster.ReadAsArray)
     for ice_param_type in ice_param_types:
         ice_mask = create_ice_mask(
             rescaled_raster,
@@ -421,125 +740,506 @@ def create_stacked(
             param_type=ice_param_type,
             land_value=land_value,
             na_value=na_value,
+            mask_arr=mask_arr,
         )
         if np.all(ice_mask == -99):
             print("The raster does not contain information from the ice map")
             return
-        stack.append(ice_mask)
+        add_channels([ice_mask])
         print(f"Add {ice_param_type}")
     del ice_mask
+    if stacked is not None:
+        return stacked, channels
     print("Concatenate")
-    return np.dstack(stack)
+    stacked = np.dstack(stack)
+    for channel in channels:
+        channel["dtype"] = stacked.dtype.name
+    return stacked, channels
+
 
+def read_scene_arrays(
+    rescaled_raster,
+    in_angle_raster,
+    mask_raster,
+    simple_textures_raster,
+    advanced_textures_raster,
+    simple_band_nums=None,
+    advanced_band_nums=None,
+):
+    """
+    Read pixels of the scene rasters that are used by create_stacked,
+    so the scene can be read ahead of its processing
 
-def get_pols(date_dir):
+    Returns:
+    (dict): {"rescaled", "in_angle", "mask": array, "simple", "advanced": [array, ...]}
     """
-    Determination of all polarizations in sars in one day
+    arrays = {
+        "rescaled": rescaled_raster.ReadAsArray(),
+        "in_angle": in_angle_raster.ReadAsArray(),
+        "mask": mask_raster.ReadAsArray(),
+    }
+    if (simple_band_nums is None) or (len(simple_band_nums) != 0):
+        arrays["simple"] = list(
+            select_textures(simple_textures_raster, band_nums=simple_band_nums)
+        )
+    if (advanced_band_nums is None) or (len(advanced_band_nums) != 0):
+        arrays["advanced"] = list(
+            select_textures(
+                advanced_textures_raster, band_nums=advanced_band_nums
+            )
+        )
+    return arrays
+
+
+def estimate_stacked_memory(
+    rescaled_raster,
+    channel_names,
+    channel_types=None,
+    pyramid_levels=0,
+    stats=False,
+    label_index=False,
+):
+    """
+    Estimate peak memory (bytes) of create_stacked and of the processing of
+    its result without reading pixels
 
     Parameters:
-    date_dir (str): The path to the folder containing rasters and other information for a specific date
+    rescaled_raster (gdal raster): Rescaled raster of the scene
+    channel_names (list): Result of get_channel_names
+    channel_types (dict): Data types of channels (see get_channel_types)
+    pyramid_levels (int): Number of pyramid levels (see create_pyramid_level)
+    stats (bool): Channel statistics are computed (see stats.add_channel_stats)
+    label_index (bool): Class fractions are computed (see get_label_fractions)
+
+    Returns:
+    (int): Bytes
+    """
+    n_pixels = rescaled_raster.RasterXSize * rescaled_raster.RasterYSize
+    if channel_types is None:
+        # Каналы хранятся списком и копируются в общий массив (float64)
+        stacked_bytes = 2 * 8 * len(channel_names)
+    else:
+        stacked_bytes = sum(
+            np.dtype(channel_types[kind]).itemsize for kind, _ in channel_names
+        )
+    # Прожиг параметра льда (int32 растр и массив), маска, валидные пиксели
+    pixel_bytes = stacked_bytes + 16
+    if pyramid_levels > 0:
+        # Уровни (1/4 + 1/16 + ... < 1/3 массива) ждут сохранения вместе с
+        # массивом, канал уменьшается через float32 копию блоков, маску
+        # валидных пикселей и их сумму
+        pixel_bytes += stacked_bytes / 3 + 9
+    if label_index:
+        # Копия канала льда, разбитого на тайлы
+        pixel_bytes += 1
+    n_bytes = n_pixels * pixel_bytes
+    if stats or label_index:
+        # Статистики считаются по частям: 1024 строки (float64 и маска) и
+        # 2 ** 20 кодов классов (int64)
+        n_bytes += rescaled_raster.RasterXSize * 1024 * 9 + 2**20 * 16
+    return int(n_bytes)
+
+
+def estimate_weather_memory(annotation, n_params):
+    """
+    Estimate peak memory (bytes) of create_weather_stacked by the image size
+    from the annotation (see get_annotation)
+
+    Returns:
+    (int): Bytes
+    """
+    n_lines, n_samples = get_image_shape(annotation)
+    n_pixels = n_lines * n_samples
+    # Координаты снимка (lat, lon и их стек), результаты поиска ближайших
+    # пикселей погоды для 3 типов координат, параметры списком и после
+    # np.dstack (float64)
+    return n_pixels * (32 + 3 * 16 + 2 * 8 * n_params)
+
+
+def acquire_memory(memory_budget, n_bytes):
+    """Reserve n_bytes of memory_budget (see admission.MemoryBudget).
+    Returns token of the reservation"""
+    if memory_budget is None:
+        return None
+    return memory_budget.acquire(n_bytes)
+
+
+def release_memory(memory_budget, token):
+    if (memory_budget is None) or (token is None):
+        return
+    memory_budget.release(token)
+
+
+def save_array(save_fp, arr, meta=None, memory_budget=None, token=None):
+    """Save dataset array (and its description), then release memory
+    reserved for it. Is used as a job of pipeline.BackgroundWriter"""
+    try:
+        print(f"Save: {save_fp}")
+        np.save(save_fp, arr)
+        if meta is not None:
+            save_meta(save_fp, meta)
+    finally:
+        release_memory(memory_budget, token)
+
+
+def save_meta(save_fp, meta):
+    """Save dataset description (channels, crop, ...) next to the dataset array (.json)"""
+    meta_fp = f"{os.path.splitext(save_fp)[0]}.json"
+    with open(meta_fp, "w") as f:
+        json.dump(meta, f)
+
+
+def get_channel(stacked, channels, name):
+    """Returns 2D array of the channel for both dense and typed layouts"""
+    if stacked.dtype.names is not None:
+        return stacked[name]
+    return stacked[..., [c["name"] for c in channels].index(name)]
+
+
+def get_valid_mask(stacked, channels, na_value=-99):
+    """
+    Returns mask of the valid pixels: not masked, not land and covered by the
+    icemap (at least one of the ice parameters is not na_value)
+    """
+    valid = np.zeros(stacked.shape[:2], dtype=bool)
+    for channel in channels:
+        if channel["kind"] == "ice":
+            valid |= (
+                get_channel(stacked, channels, channel["name"]) != na_value
+            )
+    return valid
+
+
+def crop_to_valid(stacked, valid):
+    """
+    Crop the stacked array to the bounding box of the valid pixels
 
     Returns:
-    (list): Polarization list
+    cropped, crop (tuple):
+      cropped (np.ndarray): Cropped array (view) or None if there are no valid pixels
+      crop (dict): Offsets and size of the crop in the source array
     """
-    search_path = os.path.join(date_dir, "rescaled", "*")
-    return [os.path.basename(p) for p in glob.glob(search_path)]
+    rows = np.flatnonzero(valid.any(axis=1))
+    cols = np.flatnonzero(valid.any(axis=0))
+    if len(rows) == 0:
+        return None, None
+    y0, y1, x0, x1 = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+    crop = {
+        "y": int(y0),
+        "x": int(x0),
+        "height": int(y1 - y0),
+        "width": int(x1 - x0),
+    }
+    return stacked[y0:y1, x0:x1], crop
 
 
-def get_texture_feature(date_dir, pol, raster_fn, texture_type):
+def select_valid_tiles(stacked, valid, tile_size, min_valid_fraction=0.5):
     """
-    Returns the texture
+    Split the stacked array into tile_size x tile_size tiles and keep only
+    tiles whose fraction of valid pixels is not less than min_valid_fraction.
+    Incomplete tiles at the right and bottom borders are dropped
 
-    Parameters:
-    date_dir (str): The path to the folder containing rasters and other information for a specific date
-    pol (str): Polarization
-    raster_fn (str): The name of the raster for which the texture is searched
-    texture_type (str): Texture type
+    Returns:
+    tiles, offsets (tuple):
+      tiles (np.ndarray): (tile, y, x, ...) array or None if no tile is kept
+      offsets (list): [[y, x], ...] offsets of the kept tiles
+    """
+    n_y = valid.shape[0] // tile_size
+    n_x = valid.shape[1] // tile_size
+    # Доля валидных пикселей в каждом тайле
+    valid_fraction = (
+        valid[: n_y * tile_size, : n_x * tile_size]
+        .reshape(n_y, tile_size, n_x, tile_size)
+        .mean(axis=(1, 3))
+    )
+    offsets = [
+        [int(i * tile_size), int(j * tile_size)]
+        for i, j in zip(*np.nonzero(valid_fraction >= min_valid_fraction))
+    ]
+    if len(offsets) == 0:
+        return None, offsets
+    tiles = np.stack(
+        [stacked[y : y + tile_size, x : x + tile_size] for y, x in offsets]
+    )
+    return tiles, offsets
+
+
+def pool_blocks(arr, factor):
+    """
+    Split the last two (spatial) axes of arr into factor x factor blocks,
+    incomplete blocks at the right and bottom borders are dropped
 
     Returns:
-    (gdal raster dataset): Texture
+    (np.ndarray): (..., height // factor, width // factor, factor * factor) array
     """
-    raster_name, ext = os.path.splitext(raster_fn)
-    texture_fp = os.path.join(
-        date_dir, "textures", pol, f"{raster_name}_{texture_type}{ext}"
+    height = arr.shape[-2] // factor * factor
+    width = arr.shape[-1] // factor * factor
+    blocks = arr[..., :height, :width].reshape(
+        *arr.shape[:-2], height // factor, factor, width // factor, factor
     )
-    if not os.path.exists(texture_fp):
-        print(
-            f"  Not found {texture_type} for {raster_fn}\n {texture_fp} does not exist"
+    return np.moveaxis(blocks, -3, -2).reshape(
+        *arr.shape[:-2], height // factor, width // factor, factor * factor
+    )
+
+
+def get_channel_nodata(channel, na_value=-99):
+    """Returns the value of the missing pixels of the stored channel: NaN for
+    channels declaring "nodata": "nan" (scaled float16), na_value otherwise"""
+    if channel.get("nodata") == "nan":
+        return np.nan
+    return na_value
+
+
+def downsample_channel(
+    arr, factor, kind, na_value=-99, ice_resampling="mode", nodata=None
+):
+    """
+    Downsample the channel by factor. Continuous channels are mean pooled
+    ignoring na_value and NaN, ice channels (categorical) take the most
+    frequent labeled value of the block (mode) or its central pixel
+    (nearest). Blocks without valid pixels are filled with nodata
+    (na_value by default)
+    """
+    if nodata is None:
+        nodata = na_value
+    if kind == "ice":
+        if ice_resampling == "nearest":
+            center = factor // 2
+            height = arr.shape[-2] // factor * factor
+            width = arr.shape[-1] // factor * factor
+            return arr[..., center:height:factor, center:width:factor]
+        blocks = pool_blocks(arr, factor)
+        # Частоты считаются по одному классу с хранением текущего максимума,
+        # так что в памяти только счетчики одного класса
+        counts = class_counts(
+            arr.reshape(-1, arr.shape[-1]), na_value=na_value
+        ).sum(axis=0)
+        pooled = np.full(blocks.shape[:-1], nodata, dtype=arr.dtype)
+        best = np.zeros(blocks.shape[:-1], dtype=np.int32)
+        for code in np.flatnonzero(counts):
+            value_counts = (blocks == code - CLASS_OFFSET).sum(
+                axis=-1, dtype=np.int32
+            )
+            better = value_counts > best
+            pooled[better] = code - CLASS_OFFSET
+            best[better] = value_counts[better]
+        return pooled
+    blocks = pool_blocks(arr, factor).astype("float32")
+    valid = (blocks != na_value) & ~np.isnan(blocks)
+    n_valid = valid.sum(axis=-1)
+    total = np.where(valid, blocks, 0).sum(axis=-1)
+    pooled = np.full(n_valid.shape, nodata, dtype="float32")
+    np.divide(total, n_valid, out=pooled, where=n_valid > 0)
+    return pooled.astype(arr.dtype)
+
+
+def create_pyramid_level(
+    stacked, channels, factor, na_value=-99, ice_resampling="mode"
+):
+    """
+    Downsample the saved dataset array (full, cropped or tiles) by factor
+    keeping its layout (dense or typed, see create_stacked)
+
+    Returns:
+    (np.ndarray): Downsampled array
+    """
+    downsampled = [
+        downsample_channel(
+            # Пространственные оси канала - последние
+            get_channel(stacked, channels, channel["name"]),
+            factor,
+            channel["kind"],
+            na_value=na_value,
+            ice_resampling=ice_resampling,
+            nodata=get_channel_nodata(channel, na_value=na_value),
         )
-        return
-    return gdal.Open(texture_fp)
+        for channel in channels
+    ]
+    if stacked.dtype.names is None:
+        return np.stack(downsampled, axis=-1)
+    level = np.empty(downsampled[0].shape, dtype=stacked.dtype)
+    for channel, arr in zip(channels, downsampled):
+        level[channel["name"]] = arr
+    return level
+
 
+def get_label_fractions(stacked, channels, valid, tile_size, na_value=-99):
+    """
+    Fractions of the ice classes of the scene and of its tile_size x tile_size
+    tiles (the grid of select_valid_tiles). A class fraction is taken from
+    the labeled (not na_value) pixels of the ice parameter, tiles without
+    valid pixels are skipped
 
-def get_in_angle(date_dir, pol, raster_fn):
-    in_angle_fp = os.path.join(date_dir, "incidence_angles", pol, raster_fn)
-    if not os.path.exists(in_angle_fp):
-        print(
-            f"  Not found incidence angle for {raster_fn}\n {in_angle_fp} does not exist"
+    Returns:
+    fractions, tiles (tuple):
+      fractions (dict): {"valid": valid fraction, "classes": {ice parameter: {class: fraction}}}
+      tiles (list): [{"y", "x", "valid", "classes"}, ...] with the same fields
+    """
+    valid_blocks = pool_blocks(valid, tile_size).mean(axis=-1)
+    tile_ys, tile_xs = np.nonzero(valid_blocks > 0)
+    fractions = {"valid": float(valid.mean()), "classes": {}}
+    tiles = [
+        {
+            "y": int(i * tile_size),
+            "x": int(j * tile_size),
+            "valid": float(valid_blocks[i, j]),
+            "classes": {},
+        }
+        for i, j in zip(tile_ys, tile_xs)
+    ]
+    for channel in channels:
+        if channel["kind"] != "ice":
+            continue
+        name = channel["name"]
+        arr = get_channel(stacked, channels, name)
+        counts = class_counts(arr, na_value=na_value).sum(axis=0)
+        n_labeled = counts.sum()
+        if n_labeled == 0:
+            continue
+        fractions["classes"][name] = {
+            int(code) - CLASS_OFFSET: float(counts[code] / n_labeled)
+            for code in np.flatnonzero(counts)
+        }
+        # Классы каждого тайла считаются одним bincount по строкам тайлов
+        tile_counts = class_counts(
+            pool_blocks(arr, tile_size)[tile_ys, tile_xs], na_value=na_value
         )
-        return
-    return gdal.Open(in_angle_fp)
+        for tile, counts in zip(tiles, tile_counts):
+            n_labeled = counts.sum()
+            if n_labeled == 0:
+                continue
+            tile["classes"][name] = {
+                int(code) - CLASS_OFFSET: float(counts[code] / n_labeled)
+                for code in np.flatnonzero(counts)
+            }
+    return fractions, tiles
 
 
-def get_mask(date_dir, pol, raster_fn):
+def open_scene_file(scene_files, file_type, raster_fn):
     """
-    Returns the mask for a raster
+    Returns the raster of the scene
 
     Parameters:
-    date_dir (str): The path to the folder containing rasters and other information for a specific date
-    pol (str): Polarization
-    raster_fn (str): The name of the raster for which the mask is searched
+    scene_files (dict): Paths to the scene files from the sources index (see catalog.index_rasters_date)
+    file_type (str): One of rescaled, simple, advanced, in_angle, mask
+    raster_fn (str): The name of the raster
 
     Returns:
-    (gdal raster dataset): Raster mask
+    (gdal raster dataset): Raster
     """
-    mask_fp = os.path.join(date_dir, "masks", pol, raster_fn)
-    if not os.path.exists(mask_fp):
-        print(f"  Not found mask for {raster_fn}\n {mask_fp} does not exist")
+    file_fp = scene_files.get(file_type)
+    if file_fp is None:
+        print(f"  Not found {file_type} for {raster_fn}")
         return
-    return gdal.Open(mask_fp)
+    return gdal.Open(file_fp)
 
 
-def get_marked_icemap(icemap_dir):
+def get_date_sources(date, rasters_root, icemaps_root=None, catalog=None):
     """
-    Returns the icemap
+    Returns paths to all input files for a specific date
 
     Parameters:
-    icemap_dir (str): Path to the folder containing ice maps for the day
+    date (str): Date in format %Y%m%d
+    rasters_root (str): Directory containing rasters by dates
+    icemaps_root (str): Directory containing ice maps by dates. If None, icemap is not searched
+    catalog (catalog.SourceCatalog): Index of the sources. If None, date folders are listed directly
 
     Returns:
-    (gdal vector dataset): Icemap
+    scenes, weather_fp, icemap_fp (tuple):
+      scenes (dict): {pol: {raster_fn: {file type: path or None}}}
+      weather_fp (str): Path to wrfout file or None
+      icemap_fp (str): Path to marked icemap or None
     """
-    # search_path = os.path.join(icemap_dir, 'marked', '*_marked.shp')
-    search_path = os.path.join(icemap_dir, "map", "source", "*_marked.shp")
-    marked_icemap_fp = glob.glob(search_path)
-    if len(marked_icemap_fp) == 0:
-        print(f"  Not found marked icemap (regex: {search_path})")
-        return
-    return gdal.OpenEx(marked_icemap_fp[0])
+    if catalog is not None:
+        return (
+            catalog.get_scenes(date),
+            catalog.get_weather(date),
+            catalog.get_icemap(date),
+        )
+    rasters_index = index_rasters_date(os.path.join(rasters_root, date))
+    icemap_fp = None
+    if icemaps_root is not None:
+        icemap_fp = index_icemaps_date(os.path.join(icemaps_root, date))[
+            "icemap"
+        ]
+    return rasters_index["pols"], rasters_index["weather"], icemap_fp
+
+
+class WeatherReader:
+    # Class is reading wrfout (NetCDF) file that is opened once with GDAL
+    # multidimensional API. Variables are read as typed arrays, the header
+    # (variables, dimensions, attributes) is parsed once
+    def __init__(self, weather_fp):
+        self.weather_fp = weather_fp
+        self._ds = gdal.OpenEx(weather_fp, gdal.OF_MULTIDIM_RASTER)
+        if self._ds is None:
+            raise RuntimeError(f"Can not open {weather_fp}")
+        self._root = self._ds.GetRootGroup()
+        self.names = set(self._root.GetMDArrayNames())
+        self._arrays = {}
+
+    def get_array(self, name):
+        if name not in self.names:
+            return None
+        if name not in self._arrays:
+            self._arrays[name] = self._root.OpenMDArray(name)
+        return self._arrays[name]
+
+    def get_shape(self, name):
+        """Shape of the variable, e.g. (Time, bottom_top, south_north, west_east)"""
+        return tuple(d.GetSize() for d in self.get_array(name).GetDimensions())
+
+    def get_coords(self, name):
+        """Names of longitude and latitude variables of the variable grid"""
+        array = self.get_array(name)
+        attr = None if array is None else array.GetAttribute("coordinates")
+        if attr is None:
+            return None
+        return tuple(attr.ReadAsString().split(" ")[:2])
+
+    def read(self, name, start=None, count=None):
+        """Read hyperslab of the variable (whole variable by default)"""
+        return self.get_array(name).ReadAsArray(
+            array_start_idx=start, count=count
+        )
 
+    def read_bands(self, name, band_start, band_stop):
+        """
+        Read 2D slices [band_start, band_stop) of the variable. Slices are
+        numbered over all leading dimensions (as bands of a GDAL raster of
+        the variable), only the range of the first dimension containing
+        them is read
+        """
+        shape = self.get_shape(name)
+        inner = int(np.prod(shape[1:-2]))
+        first = band_start // inner
+        last = (band_stop - 1) // inner + 1
+        arrs = self.read(
+            name,
+            start=[first] + [0] * (len(shape) - 1),
+            count=[last - first] + list(shape[1:]),
+        ).reshape((-1,) + shape[-2:])
+        offset = first * inner
+        return arrs[band_start - offset : band_stop - offset]
+
+
+def get_coords_types(weather, weather_params):
+    """
+    Group weather parameters by their coordinate grids
 
-def get_coords_types(weather_map_fp, weather_params):
-    weather = gdal.Open(weather_map_fp)
-    # Формирование списка уникальных координатных сеток
-    coord_groups = []
-    coord_keys = [
-        k for k in weather.GetMetadata_Dict().keys() if "_coordinates" in k
-    ]
-    for k in coord_keys:
-        coord_grid = tuple(weather.GetMetadata_Dict()[k].split(" ")[:2])
-        if coord_grid not in coord_groups:
-            coord_groups.append(coord_grid)
+    Parameters:
+    weather (WeatherReader): Opened wrfout file
+    weather_params (list): Weather parameters
+
+    Returns:
+    (dict): {('XLONG', 'XLAT'): [param1,  param2], (...), [...]}
+    """
     # Формирование словаря, где ключ - тип координатной сетки, значение - список параметров с такой сеткой
-    metadata = weather.GetMetadata_Dict()
     coords_types = {}
     for weather_param in weather_params:
-        try:
-            coords_type = tuple(
-                metadata[f"{weather_param}_coordinates"].split(" ")[:2]
-            )
-        except:
-            print(f"Invalid name {weather_param} ({weather_map_fp})")
+        coords_type = weather.get_coords(weather_param)
+        if coords_type is None:
+            print(f"Invalid name {weather_param} ({weather.weather_fp})")
             continue
         if coords_type not in coords_types.keys():
             coords_types.update({coords_type: [weather_param]})
@@ -548,6 +1248,81 @@ def get_coords_types(weather_map_fp, weather_params):
     return coords_types
 
 
+@lru_cache(maxsize=16)
+def _open_zip(source_fp, mtime_ns, size, pid):
+    # Архив открывается один раз в каждом процессе: смещение в файле
+    # не делится с другими процессами после fork
+    return zipfile.ZipFile(source_fp, "r")
+
+
+def open_zip(source_fp):
+    """
+    Returns opened zip (zipfile.ZipFile), its central directory is read once
+    while the file is not changed, so the archive is listed once for all
+    polarizations and tasks of the worker process
+    """
+    stat = os.stat(source_fp)
+    return _open_zip(source_fp, stat.st_mtime_ns, stat.st_size, os.getpid())
+
+
+def read_zip_index(source_fp):
+    """Returns members of the zip ({name: ZipInfo}) from its cached central
+    directory (see open_zip)"""
+    return {info.filename: info for info in open_zip(source_fp).infolist()}
+
+
+def read_zip_member(source_fp, info):
+    """Read the zip member by its cached ZipInfo, only the member bytes are
+    read (no scan of the central directory). CRC, encryption and data
+    descriptor of the member are checked by zipfile"""
+    try:
+        with open_zip(source_fp).open(info) as member:
+            return member.read()
+    except (zipfile.BadZipFile, zlib.error, RuntimeError) as e:
+        raise zipfile.BadZipFile(
+            f"Can't read {info.filename} from {source_fp}: {e}"
+        ) from e
+
+
+def find_zip_member(source_fp, folder, extension, pol):
+    """Returns ZipInfo of the file of the polarization in the folder of the
+    zip, FileNotFoundError is raised if there is no such file"""
+    # Файл ищется непосредственно в папке: папка annotation содержит
+    # подпапки calibration и rfi с файлами той же поляризации
+    for name, info in read_zip_index(source_fp).items():
+        if (
+            (os.path.basename(os.path.dirname(name)) == folder)
+            and (extension in name)
+            and (pol.lower() in name)
+        ):
+            return info
+    raise FileNotFoundError(
+        f"Not found {folder}/*{extension} of {pol} in {source_fp}"
+    )
+
+
+def get_annotation(source_fp, pol):
+    """
+    Returns annotation xml (ElementTree) of the polarization. Only the
+    annotation member of the SAR zip is read, the measurement raster is not
+    opened (see open_zip)
+    """
+    info = find_zip_member(source_fp, "annotation", ".xml", pol)
+    return ET.ElementTree(ET.fromstring(read_zip_member(source_fp, info)))
+
+
+def get_image_shape(annotation):
+    """Returns shape (lines, samples) of the measurement raster from the
+    imageInformation of the annotation"""
+    image_information = annotation.find("imageAnnotation").find(
+        "imageInformation"
+    )
+    return (
+        int(image_information.find("numberOfLines").text),
+        int(image_information.find("numberOfSamples").text),
+    )
+
+
 def get_files(source_fp, pol):
     """Getting rasters (as gdal dataset) and a list of support files for SAR (as xml): measurement; annotation; calibration; noise; manifest
 
@@ -557,26 +1332,12 @@ def get_files(source_fp, pol):
        rasters (dict) contains rasters (gdal dataset) by polarizations
        sar_files (dict) contains xmls () for each polarizations
     """
-
-    with zipfile.ZipFile(source_fp, "r") as zip_ref:
-        files = zip_ref.namelist()
-        for file in files:
-            if (
-                ("measurement" in file)
-                and (".tiff" in file)
-                and (pol.lower() in file)
-            ):
-                mds_full_path = os.path.join(source_fp, file)
-                raster = gdal.Open(f"/vsizip/{mds_full_path}")
-            # Папка annotation содержит подпапку calibration, поэтому calibration не должно присутвовать в искомом файле
-            if (
-                ("annotation" in file)
-                and ("calibration" not in file)
-                and (".xml" in file)
-                and (pol.lower() in file)
-            ):
-                annotation = ET.parse(zip_ref.open(file))
-    return raster, annotation
+    mds_full_path = os.path.join(
+        source_fp,
+        find_zip_member(source_fp, "measurement", ".tiff", pol).filename,
+    )
+    raster = gdal.Open(f"/vsizip/{mds_full_path}")
+    return raster, get_annotation(source_fp, pol)
 
 
 def get_geolocation_grid_point(annotation_tree):
@@ -629,24 +1390,16 @@ def resize_coords(geolocation_grid_point, rasters_shape, coord_type):
     )
 
 
-def get_lat_lon_arr(raster, annotation):
+def get_lat_lon_arr(annotation, rasters_shape=None):
     geolocation_grid_point = get_geolocation_grid_point(annotation)
-    rasters_shape = (raster.RasterYSize, raster.RasterXSize)
+    # Размер снимка берется из аннотации, без открытия растра
+    if rasters_shape is None:
+        rasters_shape = get_image_shape(annotation)
     lat_arr = resize_coords(geolocation_grid_point, rasters_shape, "lat")
     lon_arr = resize_coords(geolocation_grid_point, rasters_shape, "lon")
     return lat_arr, lon_arr
 
 
-def get_source_raster_path(date_dir, raster_fn):
-    source_fp = os.path.join(date_dir, "source", f"{raster_fn}.zip")
-    if not os.path.exists(source_fp):
-        print(
-            f"  Not found source for {raster_fn}. {source_fp} does not exist"
-        )
-        return
-    return source_fp
-
-
 def get_weather_param_id(weather_rasters, weather_param):
     # В метаданных хранится словарь с указанием индексов каждого погодного параметра
     param_indx = weather_rasters.GetMetadata().get(weather_param, None)
@@ -674,30 +1427,20 @@ def get_weather_param_array(weather_rasters, param):
     return weather_rasters.GetRasterBand(param_id).ReadAsArray()
 
 
-def get_coord_arr(weather_fp, coord):
-    coord_raster = gdal.Open(f'NETCDF:"{weather_fp}"://{coord}')
-    return coord_raster.GetRasterBand(1).ReadAsArray()
+def get_coord_arr(weather, coord):
+    # Координаты первого момента времени
+    return weather.read_bands(coord, 0, 1)[0]
 
 
-def get_weather_coords_tree(weather_fp, coords_type):
-    weather_lat_arr = get_coord_arr(weather_fp, coords_type[1])
-    weather_lon_arr = get_coord_arr(weather_fp, coords_type[0])
+def get_weather_coords_tree(weather, coords_type):
+    weather_lat_arr = get_coord_arr(weather, coords_type[1])
+    weather_lon_arr = get_coord_arr(weather, coords_type[0])
     weather_coords_arr = np.stack(
         (weather_lon_arr.flatten(), weather_lat_arr.flatten()), axis=-1
     )
     return cKDTree(weather_coords_arr)
 
 
-def get_weather_source_path(date_dir):
-    weather_source_fp = glob.glob(
-        os.path.join(date_dir, "weather", "wrfout_d03*")
-    )
-    if len(weather_source_fp) == 0:
-        print(f"  Not found weather")
-        return
-    return weather_source_fp[0]
-
-
 # def create_weather_ds(rasters_root, date, ds_root, weather_params, weather_step=0.08):
 #   date_dir = os.path.join(rasters_root, date)
 #   ds_dir = os.path.join(ds_root, date, 'weather')
@@ -764,12 +1507,13 @@ def get_weather_source_path(date_dir):
 #       np.save(save_fp, weather_stacked)
 
 
-def median_by_z(weather_arrs, n_rasters):
+def median_by_z(read_bands, n_rasters):
+    # Слои читаются частями, в памяти одновременно только одна часть
     z_count = int(n_rasters / 25)
     time_arrs = []
     for i in range(0, n_rasters, z_count + 1):
         time_arrs.append(
-            np.median(weather_arrs[i : i + z_count, :, :], axis=0)
+            np.median(read_bands(i, min(i + z_count, n_rasters)), axis=0)
         )
     return np.array(time_arrs)
 
@@ -778,111 +1522,225 @@ def median_by_time(weather_arrs):
     return np.median(weather_arrs, axis=0)
 
 
-def create_weather_arr(weather_fp, param):
+def create_weather_arr(weather, param):
     print(param)
-    try:
-        param_map = gdal.Open(f'NETCDF:"{weather_fp}"://{param}')
-    except:
+    if weather.get_array(param) is None:
         print(f"  Not found {param}")
         return
-    param_arrs = param_map.ReadAsArray()
-    if param_map.RasterCount > 25:
-        param_arrs = median_by_z(param_arrs, param_map.RasterCount)
+    shape = weather.get_shape(param)
+    # Количество 2D слоев по всем измерениям, кроме пространственных
+    n_rasters = int(np.prod(shape[:-2]))
+    if n_rasters > 25:
+        param_arrs = median_by_z(
+            lambda start, stop: weather.read_bands(param, start, stop),
+            n_rasters,
+        )
+    else:
+        param_arrs = weather.read(param)
+        if param_arrs.ndim > 3:
+            param_arrs = param_arrs.reshape((n_rasters,) + shape[-2:])
     return median_by_time(param_arrs)
 
 
-def create_weather_ds(
-    rasters_root, date, ds_root, weather_params, weather_step=0.08
-):
-    date_dir = os.path.join(rasters_root, date)
-    weather_ds_dir = os.path.join(ds_root, date, "weather")
-    os.makedirs(weather_ds_dir, exist_ok=True)
-    pols = get_pols(date_dir)
+def get_pol_groups(pols):
     pol_groups = [
         ("HH", "HV") * ("HH" in pols and "HV" in pols),
         ("VH", "VV") * ("VV" in pols and "VH" in pols),
     ]
-    pol_groups = [pol_group for pol_group in pol_groups if len(pol_group) != 0]
-    weather_fp = get_weather_source_path(date_dir)
-    if weather_fp is None:
-        return
+    return [pol_group for pol_group in pol_groups if len(pol_group) != 0]
+
+
+def load_weather(weather_fp, weather_params):
+    """
+    Load weather data that is common for all rasters of the date
+
+    Parameters:
+    weather_fp (str): Path to wrfout file
+    weather_params (list): Weather parameters to load
+
+    Returns:
+    coords_types, weather_arrs, weather_coords_trees (tuple):
+      coords_types (dict): {('XLONG', 'XLAT'): [param1,  param2], (...), [...]}
+      weather_arrs (dict): {weather param: array}
+      weather_coords_trees (dict): {('XLONG', 'XLAT'): cKDTree, (...), ...}
+    """
+    # Файл открывается один раз для всех параметров и координат
+    weather = WeatherReader(weather_fp)
     # Словарь типа: {('XLONG', 'XLAT'): [param1,  param2], (...), [...]}
-    coords_types = get_coords_types(weather_fp, weather_params)
+    coords_types = get_coords_types(weather, weather_params)
     # Все данные про погоду общие, поэтому будут загружены единожды
     print("Load weather rasters")
     # Словарь типа: {погодный параметр: массив}
     weather_arrs = {
-        param: create_weather_arr(weather_fp, param)
-        for param in weather_params
+        param: create_weather_arr(weather, param) for param in weather_params
     }
     # Словарь типа: {('XLONG', 'XLAT'): cKDTree, (...), ...}, содержит деревья с координатами, по которым будет искаться ближайший
     weather_coords_trees = {
-        coords_type: get_weather_coords_tree(weather_fp, coords_type)
+        coords_type: get_weather_coords_tree(weather, coords_type)
         for coords_type in coords_types
     }
-    for pol_group in pol_groups:
-        pol = pol_group[0]
-        # Растры для одной поляризации
-        ds_dir = os.path.join(ds_root, date, pol)
-        if not os.path.exists(ds_dir):
-            print(f"  Not found datasets ({ds_dir})")
-            return
-        raster_fps = glob.glob(os.path.join(ds_dir, "*.npy*"))
-        print(f"{pol_group} ({pol}) | {len(raster_fps)} rasters")
-        if len(raster_fps) == 0:
+    return coords_types, weather_arrs, weather_coords_trees
+
+
+def create_weather_stacked(
+    source_fp,
+    pol,
+    weather,
+    weather_params,
+    weather_step=0.08,
+    annotation=None,
+):
+    """
+    Create weather array for a raster
+
+    Parameters:
+    source_fp (str): Path to the source zip of the raster
+    pol (str): Polarization
+    weather (tuple): Result of load_weather
+    weather_params (list): Weather parameters to add
+    weather_step (float): Step of the weather coordinate grid
+    annotation (ElementTree): Result of get_annotation if it is already read
+
+    Returns:
+    (np.ndarray): Weather parameters stacked by the last axis
+    """
+    coords_types, weather_arrs, weather_coords_trees = weather
+    if annotation is None:
+        annotation = get_annotation(source_fp, pol)
+    rasters_shape = get_image_shape(annotation)
+    lat_arr, lon_arr = get_lat_lon_arr(annotation, rasters_shape)
+    raster_coords_arr = np.stack(
+        (lon_arr.flatten(), lat_arr.flatten()), axis=-1
+    )
+    # Словарь типа: {('XLONG', 'XLAT'): (dist, idx), (...), ...}, содержит расстояние и индекс ближайшего пикселя в погоде к пикселю растра
+    query_result = {
+        coords_type: weather_coords_trees[coords_type].query(
+            raster_coords_arr, k=1
+        )
+        for coords_type in coords_types
+    }
+    weather_by_raster_arrs = []
+    n_params = len(weather_params)
+    for i, weather_param in enumerate(weather_params):
+        if i % 10 == 1:
+            print(f"{i}/{n_params}")
+        if weather_param in ["U", "V"]:
+            ctype = (f"XLONG_{weather_param}", f"XLAT_{weather_param}")
+        else:
+            ctype = ("XLONG", "XLAT")
+        param_arr = weather_arrs[weather_param]
+        if param_arr is None:
             continue
-        for raster_fp in raster_fps:
-            print(f"{raster_fp}")
-            raster_fn = os.path.basename(raster_fp).split(".")[0]
-            source_fp = get_source_raster_path(date_dir, raster_fn)
-            raster, annotation = get_files(source_fp, pol)
-            lat_arr, lon_arr = get_lat_lon_arr(raster, annotation)
-            raster_coords_arr = np.stack(
-                (lon_arr.flatten(), lat_arr.flatten()), axis=-1
-            )
-            # Словарь типа: {('XLONG', 'XLAT'): (dist, idx), (...), ...}, содержит расстояние и индекс ближайшего пикселя в погоде к пикселю растра
-            query_result = {
-                coords_type: weather_coords_trees[coords_type].query(
-                    raster_coords_arr, k=1
-                )
-                for coords_type in coords_types
+        param_flatten_arr = param_arr.flatten()
+        # Отбор только ближайших к растру пикселей погоды
+        weather_by_raster_flatten_arr = param_flatten_arr[
+            query_result[ctype][1]
+        ]
+        # Фильтрация по расстоянию: если найденный погодный пиксель дальше,ч ем шаг координтаной сетки у погоды, то значит, что в этом месте погода и растр не пересекаются, а значит данное значение не будет использовано (и будет заменено на nan)
+        weather_by_raster_flatten_arr[
+            query_result[ctype][0] > weather_step
+        ] = np.nan
+        # Приведение к размеру растра
+        weather_by_raster_arr = weather_by_raster_flatten_arr.reshape(
+            rasters_shape
+        )
+        if i == 0:
+            if np.all(weather_by_raster_arr == -99):
+                print("There is no weather for this zone")
+                continue
+        weather_by_raster_arrs.append(weather_by_raster_arr)
+    return np.dstack(weather_by_raster_arrs)
+
+
+def create_weather_ds(
+    rasters_root,
+    date,
+    ds_root,
+    weather_params,
+    weather_step=0.08,
+    catalog=None,
+    memory_budget=None,
+    pipeline_depth=1,
+):
+    """
+    Create weather arrays for the rasters of the date that are already
+    in ds_root. If memory_budget is given, each raster waits for its
+    estimated memory (see estimate_weather_memory).
+    Sources of the next pipeline_depth rasters are opened and the arrays
+    are saved in background threads (see pipeline), 0 - sequentially
+    """
+    weather_ds_dir = os.path.join(ds_root, date, "weather")
+    os.makedirs(weather_ds_dir, exist_ok=True)
+    scenes, weather_fp, _ = get_date_sources(
+        date, rasters_root, catalog=catalog
+    )
+    pol_groups = get_pol_groups(list(scenes.keys()))
+    if weather_fp is None:
+        print(f"  Not found weather")
+        return
+    weather = load_weather(weather_fp, weather_params)
+
+    def iter_rasters():
+        for pol_group in pol_groups:
+            pol = pol_group[0]
+            # Словарь типа: {имя снимка без расширения: путь к исходнику}
+            source_fps = {
+                os.path.splitext(raster_fn)[0]: scene_files["source"]
+                for raster_fn, scene_files in scenes[pol].items()
             }
-            weather_by_raster_arrs = []
-            n_params = len(weather_params)
-            for i, weather_param in enumerate(weather_params):
-                if i % 10 == 1:
-                    print(f"{i}/{n_params}")
-                if weather_param in ["U", "V"]:
-                    ctype = (f"XLONG_{weather_param}", f"XLAT_{weather_param}")
-                else:
-                    ctype = ("XLONG", "XLAT")
-                param_arr = weather_arrs[weather_param]
-                if param_arr is None:
+            # Растры для одной поляризации
+            ds_dir = os.path.join(ds_root, date, pol)
+            if not os.path.exists(ds_dir):
+                print(f"  Not found datasets ({ds_dir})")
+                return
+            raster_fps = glob.glob(os.path.join(ds_dir, "*.npy*"))
+            print(f"{pol_group} ({pol}) | {len(raster_fps)} rasters")
+            for raster_fp in raster_fps:
+                print(f"{raster_fp}")
+                raster_fn = os.path.basename(raster_fp).split(".")[0]
+                source_fp = source_fps.get(raster_fn)
+                if source_fp is None:
+                    print(f"  Not found source for {raster_fn}")
                     continue
-                param_flatten_arr = param_arr.flatten()
-                # Отбор только ближайших к растру пикселей погоды
-                weather_by_raster_flatten_arr = param_flatten_arr[
-                    query_result[ctype][1]
-                ]
-                # Фильтрация по расстоянию: если найденный погодный пиксель дальше,ч ем шаг координтаной сетки у погоды, то значит, что в этом месте погода и растр не пересекаются, а значит данное значение не будет использовано (и будет заменено на nan)
-                weather_by_raster_flatten_arr[
-                    query_result[ctype][0] > weather_step
-                ] = np.nan
-                # Приведение к размеру растра
-                weather_by_raster_arr = weather_by_raster_flatten_arr.reshape(
-                    (raster.RasterYSize, raster.RasterXSize)
+                yield pol_group, raster_fn, source_fp
+
+    def load_source(item):
+        pol_group, _, source_fp = item
+        annotation = get_annotation(source_fp, pol_group[0])
+        n_bytes = estimate_weather_memory(annotation, len(weather_params))
+        return annotation, acquire_memory(memory_budget, n_bytes)
+
+    def discard(loaded):
+        release_memory(memory_budget, loaded[1])
+
+    with BackgroundWriter(pipeline_depth) as writer, Prefetcher(
+        load_source, iter_rasters(), pipeline_depth, discard=discard
+    ) as sources:
+        for (pol_group, raster_fn, source_fp), (annotation, token) in sources:
+            try:
+                weather_stacked = create_weather_stacked(
+                    source_fp,
+                    pol_group[0],
+                    weather,
+                    weather_params,
+                    weather_step,
+                    annotation=annotation,
                 )
-                if i == 0:
-                    if np.all(weather_by_raster_arr == -99):
-                        print("There is no weather for this zone")
-                        continue
-                weather_by_raster_arrs.append(weather_by_raster_arr)
-            weather_stacked = np.dstack(weather_by_raster_arrs)
-            save_fp = os.path.join(
-                weather_ds_dir, f'{raster_fn}_{"_".join(pol_group)}.npy'
-            )
-            print(f"Save: {save_fp}")
-            np.save(save_fp, weather_stacked)
+                save_fp = os.path.join(
+                    weather_ds_dir, f'{raster_fn}_{"_".join(pol_group)}.npy'
+                )
+                # Память освобождается после сохранения массива
+                writer.submit(
+                    save_array,
+                    save_fp,
+                    weather_stacked,
+                    memory_budget=memory_budget,
+                    token=token,
+                )
+                token = None
+                del weather_stacked
+            finally:
+                release_memory(memory_budget, token)
 
 
 def create_ds_arrays(
@@ -891,79 +1749,371 @@ def create_ds_arrays(
     rasters_root,
     ds_root,
     land_fp,
-    weather_fp,
     ice_param_types=["age_group", "age", "concentrat"],
     simple_band_nums=None,
     advanced_band_nums=None,
     land_value=-99,
     na_value=-99,
+    catalog=None,
+    weather_params=None,
+    weather_step=0.08,
+    channel_types=None,
+    crop=False,
+    tile_size=None,
+    min_valid_fraction=0.5,
+    patch_size=None,
+    patch_stride=None,
+    min_label_fraction=0.0,
+    patch_shard_size=256,
+    patch_shuffle_shards=8,
+    simplify_vectors=False,
+    vector_cache=None,
+    memory_budget=None,
+    pipeline_depth=1,
+    pyramid_levels=0,
+    ice_resampling="mode",
+    stats=False,
+    label_index=None,
+    label_tile_size=256,
 ):
-    icemap = get_marked_icemap(os.path.join(icemaps_root, date))
-    if icemap is None:
+    """
+    Create dataset arrays for all rasters of the date.
+    If weather_params are given, weather arrays are created in the same
+    pass over the rasters (as create_weather_ds does).
+    If channel_types are given, arrays are saved in the compact typed layout
+    (see create_stacked).
+    If crop is True, only the bounding box of the valid pixels is saved.
+    If tile_size is given, only tiles with at least min_valid_fraction of
+    valid pixels are saved (see select_valid_tiles).
+    Offsets are saved to the .json description of the dataset.
+    If patch_size is given, patches with more than min_label_fraction of
+    labeled pixels are also written to the shuffled shard store
+    ds_root/date/patches/pol (see patches.PatchShardWriter), patches are
+    shuffled across scenes in a buffer of patch_shuffle_shards shards.
+    If simplify_vectors is True, icemap and land geometries are simplified
+    to the scene resolution before rasterization (see clip_vector).
+    If vector_cache is given, icemap and land are taken from it
+    (see VectorCache) instead of being opened from disk.
+    If memory_budget is given, each raster waits for its estimated memory
+    (with its pyramid levels, statistics and weather array, see
+    estimate_stacked_memory and estimate_weather_memory) before its pixels
+    are read, the memory is released when its arrays are saved.
+    Pixels of the next pipeline_depth rasters are read while the current
+    one is stacked and arrays are saved in a background thread
+    (see pipeline), 0 - sequentially.
+    If pyramid_levels are given, the saved array is also downsampled by
+    2, 4, ... (see create_pyramid_level) and saved to
+    ds_root/date/pyramid/x{factor}/pol, ice channels are resampled by
+    ice_resampling (mode or nearest). Shape, offsets and tile size in the
+    description of a level are kept at the full resolution.
+    If stats is True, channel statistics and ice class histograms of each
+    raster are saved to its .json description (see create_stacked) and
+    aggregated by polarizations to ds_root/date/stats.json.
+    If label_index is given, class fractions of each raster and of its tiles
+    (tile_size or label_tile_size) are added to it (see
+    label_index.LabelIndex and get_label_fractions)
+    """
+    # Пути ко всем входным файлам определяются заранее (по индексу каталога
+    # или одним листингом папок), без проверки существования каждого файла
+    scenes, weather_fp, icemap_fp = get_date_sources(
+        date, rasters_root, icemaps_root, catalog=catalog
+    )
+    if icemap_fp is None:
+        print(f"  Not found marked icemap for {date}")
         return
-    land_ds = gdal.OpenEx(land_fp)
-    date_dir = os.path.join(rasters_root, date)
+    if vector_cache is not None:
+        icemap = vector_cache.get_icemap(icemap_fp)
+        land_ds = vector_cache.get_land(land_fp)
+    else:
+        icemap = gdal.OpenEx(icemap_fp)
+        land_ds = gdal.OpenEx(land_fp)
     ds_dir = os.path.join(ds_root, date)
-    pols = get_pols(date_dir)
+    # Хранилища патчей для каждой поляризации
+    patch_writers = {}
+    # Погода собирается для первой поляризации каждой группы
+    # Словарь типа: {'HH': ('HH', 'HV'), ...}
+    weather_pol_groups = {}
+    weather = None
+    if weather_params is not None:
+        if weather_fp is None:
+            print(f"  Not found weather")
+        else:
+            weather_pol_groups = {
+                pol_group[0]: pol_group
+                for pol_group in get_pol_groups(list(scenes.keys()))
+            }
+            weather = load_weather(weather_fp, weather_params)
+            os.makedirs(os.path.join(ds_dir, "weather"), exist_ok=True)
     # Сбор производится для каждой поляризации по отдельности
-    print(f"Pols: {pols}")
-    for pol in pols:
+    print(f"Pols: {list(scenes.keys())}")
+    scene_items = []
+    date_stats = DateStats()
+    for pol, pol_scenes in scenes.items():
         # Растры для одной поляризации
-        raster_fps = glob.glob(
-            os.path.join(date_dir, "rescaled", pol, "*.tif")
-        )
-        print(f"{pol} | {len(raster_fps)} rasters")
-        if len(raster_fps) == 0:
+        print(f"{pol} | {len(pol_scenes)} rasters")
+        if len(pol_scenes) == 0:
             continue
         os.makedirs(os.path.join(ds_dir, pol), exist_ok=True)
-        # Для каждого растра собирается массив: масштабированные значения снимка + угол + симпл характеристики + адвансед характеристики + параметры льда + маска для снимка
-        for raster_fp in raster_fps:
-            print(f"{pol} | {raster_fp}")
-            raster_fn = os.path.basename(raster_fp)
-            # масштабированные значения снимка
-            rescaled_raster = gdal.Open(raster_fp)
-            # текстуры
-            simple_textures_raster = get_texture_feature(
-                date_dir, pol, raster_fn, "simple"
-            )
-            if simple_textures_raster is None:
-                continue
-            advanced_textures_raster = get_texture_feature(
-                date_dir, pol, raster_fn, "advanced"
-            )
-            if advanced_textures_raster is None:
-                continue
-            # угол
-            in_angle_raster = get_in_angle(date_dir, pol, raster_fn)
-            if in_angle_raster is None:
-                continue
-            # маска
-            mask_raster = get_mask(date_dir, pol, raster_fn)
-            if mask_raster is None:
-                continue
-            # Непосредственно склейка данных в один мега массив
-            full_arr = create_stacked(
-                rescaled_raster,
-                in_angle_raster,
-                mask_raster,
+        scene_items.extend(
+            (pol, raster_fn, scene_files)
+            for raster_fn, scene_files in pol_scenes.items()
+        )
+
+    def load_scene(item):
+        # Выполняется в потоке чтения: общие icemap и land используются
+        # только здесь, обработке передаются вырезанные по снимку копии
+        pol, raster_fn, scene_files = item
+        print(f"{pol} | {scene_files['rescaled']}")
+        # масштабированные значения снимка
+        rescaled_raster = open_scene_file(scene_files, "rescaled", raster_fn)
+        # Снимки без покрытия картой льда отсеиваются до чтения пикселей
+        if not icemap_covers(icemap, rescaled_raster, ice_param_types):
+            print("The raster does not contain information from the ice map")
+            return None
+        # текстуры
+        simple_textures_raster = open_scene_file(
+            scene_files, "simple", raster_fn
+        )
+        if simple_textures_raster is None:
+            return None
+        advanced_textures_raster = open_scene_file(
+            scene_files, "advanced", raster_fn
+        )
+        if advanced_textures_raster is None:
+            return None
+        # угол
+        in_angle_raster = open_scene_file(scene_files, "in_angle", raster_fn)
+        if in_angle_raster is None:
+            return None
+        # маска
+        mask_raster = open_scene_file(scene_files, "mask", raster_fn)
+        if mask_raster is None:
+            return None
+        n_bytes = estimate_stacked_memory(
+            rescaled_raster,
+            get_channel_names(
                 simple_textures_raster,
                 advanced_textures_raster,
-                icemap,
-                land_ds,
-                ice_param_types=ice_param_types,
+                ice_param_types,
                 simple_band_nums=simple_band_nums,
                 advanced_band_nums=advanced_band_nums,
-                land_value=land_value,
-                na_value=na_value,
+            ),
+            channel_types=channel_types,
+            pyramid_levels=pyramid_levels,
+            stats=stats,
+            label_index=label_index is not None,
+        )
+        rasters = (
+            rescaled_raster,
+            in_angle_raster,
+            mask_raster,
+            simple_textures_raster,
+            advanced_textures_raster,
+        )
+        # Память погоды резервируется вместе со снимком одной резервацией:
+        # обработка не ждет бюджет, пока поток чтения держит следующий снимок
+        annotation = None
+        if (pol in weather_pol_groups) and (scene_files["source"]):
+            annotation = get_annotation(scene_files["source"], pol)
+            n_bytes += estimate_weather_memory(annotation, len(weather_params))
+        token = acquire_memory(memory_budget, n_bytes)
+        try:
+            scene_icemap = clip_vector(
+                icemap, rescaled_raster, simplify=simplify_vectors
             )
-            if full_arr is None:
-                continue
-            save_fp = os.path.join(
-                ds_dir, pol, f"{os.path.splitext(raster_fn)[0]}.npy"
+            scene_land_ds = clip_vector(
+                land_ds, rescaled_raster, simplify=simplify_vectors
             )
-            print(f"Save: {save_fp}")
-            np.save(save_fp, full_arr)
+            arrays = read_scene_arrays(
+                *rasters,
+                simple_band_nums=simple_band_nums,
+                advanced_band_nums=advanced_band_nums,
+            )
+        except BaseException:
+            release_memory(memory_budget, token)
+            raise
+        return (
+            rasters,
+            scene_icemap,
+            scene_land_ds,
+            arrays,
+            annotation,
+            token,
+        )
+
+    def discard(loaded):
+        release_memory(memory_budget, loaded[-1])
+
+    with BackgroundWriter(pipeline_depth) as writer, Prefetcher(
+        load_scene, scene_items, pipeline_depth, discard=discard
+    ) as loaded_scenes:
+        # Для каждого растра собирается массив: масштабированные значения снимка + угол + симпл характеристики + адвансед характеристики + параметры льда + маска для снимка
+        for (pol, raster_fn, scene_files), loaded in loaded_scenes:
+            if loaded is None:
+                continue
+            (
+                rasters,
+                scene_icemap,
+                scene_land_ds,
+                arrays,
+                annotation,
+                token,
+            ) = loaded
+            del loaded
+            try:
+                # Непосредственно склейка данных в один мега массив
+                result = create_stacked(
+                    *rasters,
+                    scene_icemap,
+                    scene_land_ds,
+                    ice_param_types=ice_param_types,
+                    simple_band_nums=simple_band_nums,
+                    advanced_band_nums=advanced_band_nums,
+                    land_value=land_value,
+                    na_value=na_value,
+                    channel_types=channel_types,
+                    arrays=arrays,
+                    clip_vectors=False,
+                    stats=stats,
+                )
+                del arrays
+                if result is None:
+                    continue
+                full_arr, channels = result
+                meta = {
+                    "channels": channels,
+                    "shape": list(full_arr.shape[:2]),
+                }
+                valid = None
+                if crop or tile_size or patch_size or label_index:
+                    valid = get_valid_mask(
+                        full_arr, channels, na_value=na_value
+                    )
+                # Доли классов льда по снимку и тайлам (из полного массива)
+                if label_index is not None:
+                    fractions, label_tiles = get_label_fractions(
+                        full_arr,
+                        channels,
+                        valid,
+                        tile_size or label_tile_size,
+                        na_value=na_value,
+                    )
+                    writer.submit(
+                        label_index.add,
+                        date,
+                        pol,
+                        os.path.splitext(raster_fn)[0],
+                        fractions,
+                        label_tiles,
+                        meta["shape"],
+                        tile_size or label_tile_size,
+                    )
+                    del fractions, label_tiles
+                # Нарезка патчей для обучения (из полного массива)
+                if patch_size:
+                    if pol not in patch_writers:
+                        patch_writers[pol] = PatchShardWriter(
+                            os.path.join(ds_dir, "patches", pol),
+                            patch_size,
+                            stride=patch_stride,
+                            shard_size=patch_shard_size,
+                            shuffle_shards=patch_shuffle_shards,
+                        )
+                    patch_writers[pol].add(
+                        full_arr,
+                        valid,
+                        os.path.splitext(raster_fn)[0],
+                        channels,
+                        min_label_fraction=min_label_fraction,
+                    )
+                # Сохраняется только область с валидными данными
+                if crop or tile_size:
+                    if tile_size:
+                        full_arr, meta["tiles"] = select_valid_tiles(
+                            full_arr, valid, tile_size, min_valid_fraction
+                        )
+                        meta["tile_size"] = tile_size
+                    else:
+                        full_arr, meta["crop"] = crop_to_valid(full_arr, valid)
+                    if full_arr is None:
+                        print("The raster does not contain valid data")
+                        continue
+                save_fp = os.path.join(
+                    ds_dir, pol, f"{os.path.splitext(raster_fn)[0]}.npy"
+                )
+                # Уровни пирамиды строятся последовательно из предыдущего
+                level_arr = full_arr
+                for level in range(1, pyramid_levels + 1):
+                    level_arr = create_pyramid_level(
+                        level_arr,
+                        channels,
+                        2,
+                        na_value=na_value,
+                        ice_resampling=ice_resampling,
+                    )
+                    level_dir = os.path.join(
+                        ds_dir, "pyramid", f"x{2 ** level}", pol
+                    )
+                    os.makedirs(level_dir, exist_ok=True)
+                    writer.submit(
+                        save_array,
+                        os.path.join(level_dir, os.path.basename(save_fp)),
+                        level_arr,
+                        {**meta, "pyramid_factor": 2**level},
+                    )
+                del level_arr
+                if stats:
+                    date_stats.add(
+                        pol, os.path.splitext(raster_fn)[0], channels
+                    )
+                # Память снимка освобождается после сохранения массива
+                # (или погоды, если она собирается для снимка)
+                writer.submit(
+                    save_array,
+                    save_fp,
+                    full_arr,
+                    meta,
+                    memory_budget=memory_budget,
+                    token=token if annotation is None else None,
+                )
+                if annotation is None:
+                    token = None
+                del full_arr, valid
+                if pol in weather_pol_groups:
+                    source_fp = scene_files["source"]
+                    if source_fp is None:
+                        print(f"  Not found source for {raster_fn}")
+                    else:
+                        weather_stacked = create_weather_stacked(
+                            source_fp,
+                            pol,
+                            weather,
+                            weather_params,
+                            weather_step,
+                            annotation=annotation,
+                        )
+                        save_fp = os.path.join(
+                            ds_dir,
+                            "weather",
+                            f"{os.path.splitext(raster_fn)[0]}_"
+                            + f'{"_".join(weather_pol_groups[pol])}.npy',
+                        )
+                        writer.submit(
+                            save_array,
+                            save_fp,
+                            weather_stacked,
+                            memory_budget=memory_budget,
+                            token=token,
+                        )
+                        token = None
+                        del weather_stacked
+            finally:
+                release_memory(memory_budget, token)
             gc.collect()
+    for patch_writer in patch_writers.values():
+        patch_writer.close()
+    if stats:
+        date_stats.save(os.path.join(ds_dir, "stats.json"))
 
 
 def get_band_nums(x):
@@ -0,0 +1,165 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+from typing import Dict
+
+from catalog import index_rasters_date
+
+
+def get_physical_memory() -> int:
+    """Physical memory of the host (node) in bytes"""
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def get_memory_limit() -> int:
+    """Memory available to the container (cgroup limit) in bytes.
+    If there is no limit, physical memory of the host is returned"""
+    physical = get_physical_memory()
+    for limit_fp in [
+        "/sys/fs/cgroup/memory.max",  # cgroup v2
+        "/sys/fs/cgroup/memory/memory.limit_in_bytes",  # cgroup v1
+    ]:
+        try:
+            with open(limit_fp, "r") as f:
+                limit = f.read().strip()
+        except OSError:
+            continue
+        # Without a limit v2 contains 'max' and v1 a huge number
+        if limit.isdigit() and (int(limit) < physical):
+            return int(limit)
+    return physical
+
+
+def get_gdal_options(
+    num_workers: int = 1,
+    cache_fraction: float = 0.25,
+    num_threads: int = 0,
+    cpu_fraction: float = 1.0,
+    vsi_cache_size: int = 25 * 2**20,
+    disable_readdir: bool = True,
+) -> Dict[str, str]:
+    """
+    GDAL config options of one worker process. Block cache and threads are
+    divided between num_workers processes, so together they do not take
+    more than cache_fraction of the container memory and cpu_fraction of
+    CPUs. Worker services sharing the host get their own fractions
+
+    Parameters:
+    num_workers (int): Number of worker processes (CELERY_NUM_WORKERS)
+    cache_fraction (float): Fraction of the memory for GDAL block caches
+    num_threads (int): GDAL_NUM_THREADS, 0 - CPUs divided between workers
+    cpu_fraction (float): Fraction of CPUs for GDAL threads of all workers
+    vsi_cache_size (int): Size (bytes) of the read cache of each opened
+                          file, it is also read-ahead for /vsizip/ sources.
+                          0 - disabled
+    disable_readdir (bool): Do not list the folder of each opened raster
+                            looking for sidecar files
+
+    Returns:
+    (dict): {option: value}
+    """
+    num_workers = max(num_workers, 1)
+    cache_mb = int(get_memory_limit() * cache_fraction / num_workers / 2**20)
+    if num_threads <= 0:
+        n_cpus = int((os.cpu_count() or 1) * cpu_fraction)
+        num_threads = max(n_cpus // num_workers, 1)
+    options = {
+        "GDAL_CACHEMAX": str(max(cache_mb, 16)),  # megabytes
+        "GDAL_NUM_THREADS": str(num_threads),
+    }
+    if vsi_cache_size > 0:
+        options["VSI_CACHE"] = "TRUE"
+        options["VSI_CACHE_SIZE"] = str(vsi_cache_size)
+    if disable_readdir:
+        options["GDAL_DISABLE_READDIR_ON_OPEN"] = "EMPTY_DIR"
+    return options
+
+
+def apply_gdal_options(options: Dict[str, str]) -> None:
+    """GDAL reads config options from the environment, so options are
+    applied before any dataset is opened and are inherited by forked
+    processes. Options that are already set in the environment are kept"""
+    for option, value in options.items():
+        os.environ.setdefault(option, value)
+        print(f"GDAL: {option}={os.environ[option]}")
+
+
+def read_date_rasters(rasters_root: str, date: str) -> int:
+    """Read all bands of the rasters of the date the same way as
+    create_ds_arrays does. Returns number of read bytes"""
+    from osgeo import gdal
+
+    index = index_rasters_date(os.path.join(rasters_root, date))
+    n_bytes = 0
+    for scenes in index["pols"].values():
+        for scene_files in scenes.values():
+            for file_type in ["rescaled", "simple", "advanced", "in_angle"]:
+                if scene_files[file_type] is None:
+                    continue
+                raster = gdal.Open(scene_files[file_type])
+                for band_num in range(raster.RasterCount):
+                    band = raster.GetRasterBand(band_num + 1)
+                    n_bytes += band.ReadAsArray().nbytes
+    return n_bytes
+
+
+def benchmark(
+    rasters_root: str, date: str, num_workers: int, profile: bool
+) -> None:
+    if profile:
+        apply_gdal_options(get_gdal_options(num_workers=num_workers))
+    start = time.perf_counter()
+    n_bytes = read_date_rasters(rasters_root, date)
+    elapsed = time.perf_counter() - start
+    print(
+        f"{'profile' if profile else 'default'}: {n_bytes / 2 ** 20:.0f} MB"
+        + f" in {elapsed:.1f} s ({n_bytes / 2 ** 20 / elapsed:.1f} MB/s)"
+    )
+
+
+if __name__ == "__main__":
+    # Compare read throughput of GDAL defaults and the profile.
+    # Each run is a separate process, so GDAL caches are not shared.
+    # Note: OS page cache is warmed by the first run, drop it between runs
+    # (or repeat the benchmark) to compare reads from disk
+    argparser = argparse.ArgumentParser(
+        description="Benchmark of GDAL performance profile"
+    )
+    argparser.add_argument("date", type=str, help="Date (%%Y%%m%%d)")
+    argparser.add_argument(
+        "rasters_root", type=str, help="Directory with rasters by dates"
+    )
+    argparser.add_argument(
+        "--num_workers", type=int, default=1, help="Number of workers"
+    )
+    argparser.add_argument(
+        "--run",
+        choices=["default", "profile"],
+        default=None,
+        help="Run only one mode in the current process",
+    )
+    args = argparser.parse_args()
+    if args.run is not None:
+        benchmark(
+            args.rasters_root,
+            args.date,
+            args.num_workers,
+            profile=args.run == "profile",
+        )
+        sys.exit(0)
+    for run in ["default", "profile"]:
+        subprocess.run(
+            [
+                sys.executable,
+                __file__,
+                args.date,
+                args.rasters_root,
+                "--num_workers",
+                str(args.num_workers),
+                "--run",
+                run,
+            ],
+            check=True,
+        )
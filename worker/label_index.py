@@ -0,0 +1,112 @@
+import pathlib
+import sqlite3
+from contextlib import contextmanager
+from typing import Dict, List
+
+# Schema is shared with app/labels.py, which queries the index
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS scenes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        date TEXT NOT NULL,
+        pol TEXT NOT NULL,
+        scene TEXT NOT NULL,
+        height INTEGER NOT NULL,
+        width INTEGER NOT NULL,
+        tile_size INTEGER NOT NULL,
+        valid_fraction REAL NOT NULL,
+        UNIQUE (date, pol, scene)
+    );
+    CREATE TABLE IF NOT EXISTS tiles (
+        scene_id INTEGER NOT NULL,
+        tile INTEGER NOT NULL,
+        y INTEGER NOT NULL,
+        x INTEGER NOT NULL,
+        valid_fraction REAL NOT NULL,
+        PRIMARY KEY (scene_id, tile)
+    );
+    CREATE TABLE IF NOT EXISTS fractions (
+        scene_id INTEGER NOT NULL,
+        tile INTEGER NOT NULL,
+        param TEXT NOT NULL,
+        class INTEGER NOT NULL,
+        fraction REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS scenes_date ON scenes (date, pol);
+    CREATE INDEX IF NOT EXISTS fractions_class
+        ON fractions (param, class, fraction);
+    CREATE INDEX IF NOT EXISTS fractions_scene ON fractions (scene_id, tile);
+"""
+
+
+class LabelIndex:
+    # Class is keeping class fractions of the ice parameters of each scene
+    # and of its tiles in SQLite (WAL), so datasets can be selected without
+    # reading them. The file is shared by all worker processes
+    def __init__(self, db_fp: pathlib.Path):
+        self._name = self.__class__.__name__
+        self.db_fp = pathlib.Path(db_fp)
+        self.db_fp.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_fp, timeout=60)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        try:
+            with conn:  # commit or rollback
+                yield conn
+        finally:
+            conn.close()
+
+    def add(
+        self,
+        date: str,
+        pol: str,
+        scene: str,
+        fractions: Dict,
+        tiles: List[Dict],
+        shape: List[int],
+        tile_size: int,
+    ) -> None:
+        """
+        Add the scene to the index, the previous entry of the scene is
+        replaced (see ds_arrays.get_label_fractions for fractions and tiles)
+        """
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT id FROM scenes"
+                + " WHERE date = ? AND pol = ? AND scene = ?",
+                (date, pol, scene),
+            ).fetchone()
+            if row is not None:
+                for table in ["scenes", "tiles", "fractions"]:
+                    key = "id" if table == "scenes" else "scene_id"
+                    conn.execute(
+                        f"DELETE FROM {table} WHERE {key} = ?", (row[0],)
+                    )
+            scene_id = conn.execute(
+                "INSERT INTO scenes (date, pol, scene, height, width,"
+                + " tile_size, valid_fraction) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (date, pol, scene, *shape, tile_size, fractions["valid"]),
+            ).lastrowid
+            conn.executemany(
+                "INSERT INTO tiles (scene_id, tile, y, x, valid_fraction)"
+                + " VALUES (?, ?, ?, ?, ?)",
+                [
+                    (scene_id, tile_num, tile["y"], tile["x"], tile["valid"])
+                    for tile_num, tile in enumerate(tiles)
+                ],
+            )
+            # Fractions of the whole scene are written with tile -1
+            conn.executemany(
+                "INSERT INTO fractions (scene_id, tile, param, class,"
+                + " fraction) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (scene_id, tile_num, param, int(value), fraction)
+                    for tile_num, entry in [(-1, fractions), *enumerate(tiles)]
+                    for param, classes in entry["classes"].items()
+                    for value, fraction in classes.items()
+                ],
+            )
@@ -1,5 +1,9 @@
+import fcntl
 import os
 import pathlib
+import threading
+import time
+from typing import Dict, List, Optional, Set, Tuple
 from pydantic import DirectoryPath
 
 
@@ -10,57 +14,158 @@ class DataGatherer:
         volumes_root: DirectoryPath,  # folder in which each source data is located in subfolder
         gathering_place: DirectoryPath,
         link_folders_only: bool = False,
+        shared: bool = False,  # gathering_place is used by several processes
     ):
         self._name = self.__class__.__name__
         self.link_folders_only = link_folders_only
+        self.shared = shared
         self.volumes_root = pathlib.Path(volumes_root)
         self.gathering_place = pathlib.Path(gathering_place)
+        # Snapshot of each volume state: {volume: (mtime_ns, entry names)}
+        self._snapshots: Dict[pathlib.Path, Tuple[int, Set[str]]] = {}
         # Enshure that required folders exist
         self.volumes_root.mkdir(parents=True, exist_ok=True)
         self.gathering_place.mkdir(parents=True, exist_ok=True)
-        # Clear self.gathering_place folder before creating new symlinks
+        # Clear self.gathering_place folder before creating new symlinks.
+        # Shared folder may contain links which are used by other processes
+        # right now, so only broken links are removed from it
         print(f"{self._name}: clearing old links")
-        self.prune()
+        self.prune(only_broken=self.shared)
 
-    def _link_volume(self, volume: pathlib.Path) -> None:
+    def _scan_volume(self, volume: pathlib.Path) -> Set[str]:
+        entries = set()
         for child in volume.iterdir():
             if self.link_folders_only and (not child.is_dir()):
                 continue
-            link = self.gathering_place.joinpath(child.name)
-            try:
-                link.symlink_to(child, target_is_directory=True)
-                print(f"{self._name}: link created: {link} -> {child}")
-            except FileExistsError:
-                pass
+            entries.add(child.name)
+        return entries
+
+    def _link(
+        self, volume: pathlib.Path, name: str, replace: bool = False
+    ) -> None:
+        child = volume.joinpath(name)
+        link = self.gathering_place.joinpath(name)
+        if replace:
+            # Temporary link is renamed over the existing one,
+            # so readers never see a missing link
+            tmp_link = self.gathering_place.joinpath(
+                f".{name}.{os.getpid()}.tmp"
+            )
+            tmp_link.unlink(missing_ok=True)
+            tmp_link.symlink_to(child, target_is_directory=True)
+            os.replace(tmp_link, link)
+            print(f"{self._name}: link replaced: {link} -> {child}")
+            return
+        try:
+            link.symlink_to(child, target_is_directory=True)
+            print(f"{self._name}: link created: {link} -> {child}")
+        except FileExistsError:
+            pass
 
-    def sync(self) -> None:
+    def _unlink(self, volume: pathlib.Path, name: str) -> None:
+        link = self.gathering_place.joinpath(name)
+        try:
+            target = pathlib.Path(os.readlink(link))
+        except OSError:
+            return
+        # The same name can be provided by several volumes,
+        # only the link that points to this volume is removed
+        if target != volume.joinpath(name):
+            return
+        # If another volume still provides the name, the link is swapped
+        for other_volume, (_, entries) in self._snapshots.items():
+            if (other_volume != volume) and (name in entries):
+                self._link(other_volume, name, replace=True)
+                return
+        link.unlink(missing_ok=True)
+        print(f"{self._name}: link removed: {link} -> X")
+
+    def _update_volume(self, volume: pathlib.Path, entries: Set[str]) -> None:
+        """Add and remove links for entries that changed since the last
+        snapshot of the volume"""
+        old_entries = self._snapshots.get(volume, (None, set()))[1]
+        for name in old_entries - entries:
+            self._unlink(volume, name)
+        for name in entries - old_entries:
+            self._link(volume, name)
+
+    def _restore_links(self) -> None:
+        """Create links for snapshot entries which are missing in the
+        gathering place (e.g. removed by another process or by hand while
+        mtime of the volume did not change)"""
+        names = set(os.listdir(self.gathering_place))
+        for volume, (_, entries) in sorted(self._snapshots.items()):
+            for name in entries - names:
+                self._link(volume, name)
+                names.add(name)
+
+    def sync(self, full: bool = False) -> None:
         """Synchronizing data between
-        self.volumes_root folder and self.gathering_place folder"""
-        print(f"{self._name}: synchronizing data")
-        self.prune(only_broken=True)
-        for volume in self.volumes_root.iterdir():
-            self._link_volume(volume)
+        self.volumes_root folder and self.gathering_place folder
+        Only volumes which mtime has changed since the last sync are scanned,
+        links of the other volumes are checked against the gathering place.
+        If full is True, forget snapshots and rescan every volume"""
+        if full:
+            print(f"{self._name}: synchronizing data")
+            self.prune(only_broken=True)
+            self._snapshots.clear()
+        volumes = list(self.volumes_root.iterdir())
+        for volume in volumes:
+            mtime = volume.stat().st_mtime_ns
+            snapshot = self._snapshots.get(volume)
+            if (snapshot is not None) and (snapshot[0] == mtime):
+                continue
+            entries = self._scan_volume(volume)
+            self._update_volume(volume, entries)
+            self._snapshots[volume] = (mtime, entries)
+        # Volumes which were removed from self.volumes_root
+        for volume in set(self._snapshots) - set(volumes):
+            self._update_volume(volume, set())
+            del self._snapshots[volume]
+        # Snapshots are kept by each process, while links are shared
+        self._restore_links()
 
     def prune(self, only_broken: bool = False) -> None:
         """Remove symlinks from self.gathering_place folder
         If only_broken is True, remove only links that have no target"""
         for child in self.gathering_place.iterdir():
-            remove = True
+            if not child.is_symlink():
+                continue
             if only_broken:
                 # Using os package here because Path.readlink() method available
                 # only for python >= 3.9
-                remove = not os.path.exists(os.readlink(child))
-            if child.is_symlink() and remove:
-                child.unlink(missing_ok=True)
-                print(f"{self._name}: link removed: {child} -> X")
+                try:
+                    target = os.readlink(child)
+                except FileNotFoundError:
+                    # Link has been removed by another process
+                    continue
+                if os.path.exists(target):
+                    continue
+            child.unlink(missing_ok=True)
+            print(f"{self._name}: link removed: {child} -> X")
+        if not only_broken:
+            self._snapshots.clear()
 
 
 class MultiDataGatherer:
     # Class to manage multiple DataGatherer apps
-    def __init__(self):
+    def __init__(
+        self,
+        lock_dir: Optional[DirectoryPath] = None,
+        freshness: float = 0,
+    ):
+        """If lock_dir is set, sync of each app is coordinated between
+        processes with a file lock: only one process scans the volumes,
+        others reuse its result if it is not older than freshness seconds"""
         self._name = self.__class__.__name__
         # storege for names of all added apps for fast access
         self._apps = []
+        self.lock_dir = None if lock_dir is None else pathlib.Path(lock_dir)
+        self.freshness = freshness
+        self._watcher: Optional[threading.Thread] = None
+        self._watcher_stop = threading.Event()
+        if self.lock_dir is not None:
+            self.lock_dir.mkdir(parents=True, exist_ok=True)
 
     def add_app(self, name: str, app: DataGatherer):
         if name in self._apps:
@@ -68,7 +173,7 @@ class MultiDataGatherer:
             return
         self.__setattr__(name, app)
         self._apps.append(name)
-        self.__getattribute__(name).sync()
+        self._sync_app(name)
 
     def remove_app(self, name: str):
         try:
@@ -78,10 +183,72 @@ class MultiDataGatherer:
         except AttributeError:
             print(f"{self._name}: app '{name}' is not found")
 
-    def sync(self):
-        for app in self._apps:
-            self.__getattribute__(app).sync()
+    def _sync_app(self, name: str, full: bool = False):
+        app = self.__getattribute__(name)
+        if self.lock_dir is None:
+            app.sync(full=full)
+            return
+        # Lock file contains sync generation counter,
+        # its modification time is the time of the last sync
+        lock_fp = self.lock_dir.joinpath(f"{name}.lock")
+        with open(lock_fp, "a+") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                lock_file.seek(0)
+                generation = int(lock_file.read() or 0)
+                synced_ago = (
+                    time.time() - os.fstat(lock_file.fileno()).st_mtime
+                )
+                if (
+                    (not full)
+                    and (generation > 0)
+                    and (synced_ago < self.freshness)
+                ):
+                    return
+                app.sync(full=full)
+                lock_file.seek(0)
+                lock_file.truncate()
+                lock_file.write(str(generation + 1))
+                lock_file.flush()
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def sync(self, full: bool = False, apps: Optional[List[str]] = None):
+        for app in self._apps if apps is None else apps:
+            self._sync_app(app, full=full)
 
     def prune(self):
         for app in self._apps:
             self.__getattribute__(app).prune()
+
+    def start_watcher(self, interval: float) -> None:
+        """Start background thread that keeps gathering places current
+        by syncing every interval seconds. Only mtimes of the volumes are
+        checked between changes, so polling is cheap even on network mounts
+        (where inotify events are not delivered)"""
+        if (self._watcher is not None) and self._watcher.is_alive():
+            return
+        self._watcher_stop.clear()
+        self._watcher = threading.Thread(
+            target=self._watch,
+            args=(interval,),
+            name=f"{self._name}-watcher",
+            daemon=True,
+        )
+        self._watcher.start()
+        print(f"{self._name}: watcher started (interval: {interval}s)")
+
+    def stop_watcher(self) -> None:
+        if self._watcher is None:
+            return
+        self._watcher_stop.set()
+        self._watcher.join()
+        self._watcher = None
+        print(f"{self._name}: watcher stopped")
+
+    def _watch(self, interval: float) -> None:
+        while not self._watcher_stop.wait(interval):
+            try:
+                self.sync()
+            except OSError as e:
+                print(f"{self._name}: watcher sync failed: {e}")
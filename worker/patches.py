@@ -0,0 +1,140 @@
+import json
+import os
+import pathlib
+from typing import List, Optional
+import numpy as np
+from pydantic import DirectoryPath
+
+
+def get_patch_offsets(
+    valid: np.ndarray,
+    patch_size: int,
+    stride: Optional[int] = None,
+    min_label_fraction: float = 0.0,
+) -> List[List[int]]:
+    """
+    Returns offsets [[y, x], ...] of patch_size x patch_size patches taken
+    with the stride whose fraction of valid (labeled) pixels is greater than
+    min_label_fraction. By default patches without labels are skipped
+    """
+    stride = stride or patch_size
+    height, width = valid.shape
+    if (height < patch_size) or (width < patch_size):
+        return []
+    # Integral image gives the number of valid pixels of any patch in O(1)
+    integral = np.zeros((height + 1, width + 1), dtype=np.int64)
+    integral[1:, 1:] = valid.cumsum(axis=0).cumsum(axis=1)
+    ys = np.arange(0, height - patch_size + 1, stride)
+    xs = np.arange(0, width - patch_size + 1, stride)
+    y0, x0 = np.meshgrid(ys, xs, indexing="ij")
+    y1, x1 = y0 + patch_size, x0 + patch_size
+    n_valid = integral[y1, x1] - integral[y0, x1] - integral[y1, x0]
+    n_valid += integral[y0, x0]
+    label_fraction = n_valid / (patch_size * patch_size)
+    keep = label_fraction > min_label_fraction
+    return [[int(y), int(x)] for y, x in zip(y0[keep], x0[keep])]
+
+
+class PatchShardWriter:
+    # Class is writing patches into large contiguous shard files.
+    # Patches are kept in a shuffle buffer of shuffle_shards shards that
+    # spans scenes, each shard is a random sample of the buffer, so shards
+    # mix patches of several scenes. index.json describes every shard
+    def __init__(
+        self,
+        store_dir: DirectoryPath,
+        patch_size: int,
+        stride: Optional[int] = None,
+        shard_size: int = 256,
+        seed: Optional[int] = None,
+        shuffle_shards: int = 8,
+    ):
+        self._name = self.__class__.__name__
+        self.store_dir = pathlib.Path(store_dir)
+        self.patch_size = patch_size
+        self.stride = stride or patch_size
+        self.shard_size = shard_size
+        self.buffer_size = shard_size * max(shuffle_shards, 1)
+        self._rng = np.random.default_rng(seed)
+        self._buffer = []  # patches waiting to be written
+        self._buffer_index = []  # [scene, y, x] of each buffered patch
+        self._index = {
+            "patch_size": self.patch_size,
+            "stride": self.stride,
+            "scenes": {},
+            "shards": [],
+        }
+        # Old store is replaced by the new one
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        for old_fp in self.store_dir.glob("shard_*.npy"):
+            old_fp.unlink()
+        self.store_dir.joinpath("index.json").unlink(missing_ok=True)
+
+    def add(
+        self,
+        stacked: np.ndarray,
+        valid: np.ndarray,
+        scene: str,
+        channels: list,
+        min_label_fraction: float = 0.0,
+    ) -> int:
+        """Cut patches of the scene and add them to the store.
+        Returns number of added patches"""
+        offsets = get_patch_offsets(
+            valid, self.patch_size, self.stride, min_label_fraction
+        )
+        self._index["scenes"][scene] = channels
+        for y, x in offsets:
+            # Patch is copied, so the scene array is not kept in memory
+            self._buffer.append(
+                stacked[
+                    y : y + self.patch_size, x : x + self.patch_size
+                ].copy()
+            )
+            self._buffer_index.append([scene, y, x])
+            if len(self._buffer) >= self.buffer_size:
+                self._flush()
+        print(f"{self._name}: {scene} | {len(offsets)} patches")
+        return len(offsets)
+
+    def _flush(self) -> None:
+        """Write a shard of randomly chosen patches of the buffer"""
+        if len(self._buffer) == 0:
+            return
+        order = self._rng.choice(
+            len(self._buffer),
+            min(self.shard_size, len(self._buffer)),
+            replace=False,
+        )
+        shard_fn = f"shard_{len(self._index['shards']):05d}.npy"
+        np.save(
+            self.store_dir.joinpath(shard_fn),
+            np.stack([self._buffer[i] for i in order]),
+        )
+        self._index["shards"].append(
+            {
+                "file": shard_fn,
+                "count": len(order),
+                "patches": [self._buffer_index[i] for i in order],
+            }
+        )
+        print(f"{self._name}: save {shard_fn} ({len(order)} patches)")
+        written = set(order.tolist())
+        self._buffer = [
+            patch for i, patch in enumerate(self._buffer) if i not in written
+        ]
+        self._buffer_index = [
+            item
+            for i, item in enumerate(self._buffer_index)
+            if i not in written
+        ]
+
+    def close(self) -> None:
+        """Write the remaining patches and the index of the store"""
+        while self._buffer:
+            self._flush()
+        index_fp = self.store_dir.joinpath("index.json")
+        tmp_fp = self.store_dir.joinpath(f".index.json.{os.getpid()}.tmp")
+        with open(tmp_fp, "w") as f:
+            json.dump(self._index, f)
+        os.replace(tmp_fp, index_fp)
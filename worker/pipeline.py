@@ -0,0 +1,162 @@
+import queue
+import threading
+from typing import Callable, Iterable, Optional
+
+_DONE = object()
+
+
+class Prefetcher:
+    # Class is loading next items in a background thread, so reading of the
+    # next scene overlaps with processing of the current one.
+    # At most depth loaded items are waiting in the queue
+    def __init__(
+        self,
+        load: Callable,
+        items: Iterable,
+        depth: int = 1,
+        discard: Optional[Callable] = None,  # called for not used results
+    ):
+        self._name = self.__class__.__name__
+        self.load = load
+        self.items = items
+        self.depth = depth
+        self.discard = discard
+        self._thread = None
+        self._stop = threading.Event()
+        if self.depth > 0:
+            self._queue = queue.Queue(maxsize=self.depth)
+            self._thread = threading.Thread(
+                target=self._run, name=self._name, daemon=True
+            )
+            self._thread.start()
+
+    def _put(self, value) -> bool:
+        while not self._stop.is_set():
+            try:
+                self._queue.put(value, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self) -> None:
+        try:
+            for item in self.items:
+                if self._stop.is_set():
+                    return
+                result = self.load(item)
+                if not self._put((item, result, None)):
+                    self._discard(result)
+                    return
+        except BaseException as e:
+            self._put((None, None, e))
+        self._put(_DONE)
+
+    def _discard(self, result) -> None:
+        if (self.discard is not None) and (result is not None):
+            self.discard(result)
+
+    def __iter__(self):
+        if self._thread is None:
+            # Without prefetching items are loaded in the current thread
+            for item in self.items:
+                yield item, self.load(item)
+            return
+        while True:
+            value = self._queue.get()
+            if value is _DONE:
+                return
+            item, result, error = value
+            if error is not None:
+                raise error
+            yield item, result
+
+    def close(self) -> None:
+        """Stop loading, results which were not used are discarded"""
+        if self._thread is None:
+            return
+        self._stop.set()
+        # Waiting results are discarded while the thread is stopping: the
+        # load can wait for resources held by them (e.g. memory budget)
+        while True:
+            self._thread.join(timeout=0.1)
+            stopped = not self._thread.is_alive()
+            while True:
+                try:
+                    value = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if value is not _DONE:
+                    self._discard(value[1])
+            if stopped:
+                break
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class BackgroundWriter:
+    # Class is running write jobs in a background thread, so saving of the
+    # current scene overlaps with processing of the next one.
+    # At most depth jobs are waiting in the queue
+    def __init__(self, depth: int = 1):
+        self._name = self.__class__.__name__
+        self.depth = depth
+        self._error = None
+        self._thread = None
+        if self.depth > 0:
+            self._queue = queue.Queue(maxsize=self.depth)
+            self._thread = threading.Thread(
+                target=self._run, name=self._name, daemon=True
+            )
+            self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            job = self._queue.get()
+            if job is _DONE:
+                return
+            func, args, kwargs = job
+            # Every job is run (e.g. to release resources),
+            # the first error is raised in the main thread
+            try:
+                func(*args, **kwargs)
+            except BaseException as e:
+                if self._error is None:
+                    self._error = e
+
+    def _raise(self) -> None:
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def submit(self, func: Callable, *args, **kwargs) -> None:
+        if self._thread is None:
+            func(*args, **kwargs)
+            return
+        self._raise()
+        self._queue.put((func, args, kwargs))
+
+    def close(self) -> None:
+        """Wait until all jobs are done"""
+        if self._thread is None:
+            return
+        self._queue.put(_DONE)
+        self._thread.join()
+        self._thread = None
+        self._raise()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        # Error of the main thread is not replaced by the writer error
+        if exc_type is None:
+            self.close()
+        elif self._thread is not None:
+            self._queue.put(_DONE)
+            self._thread.join()
+            self._thread = None
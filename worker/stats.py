@@ -0,0 +1,144 @@
+import json
+import math
+import pathlib
+from typing import Dict, List, Optional
+import numpy as np
+
+
+def merge_stats(a: Optional[dict], b: Optional[dict]) -> Optional[dict]:
+    """
+    Merge statistics of two parts of the data (parallel algorithm of Chan
+    et al.), so mean and std do not need a second pass over the data
+    """
+    if (a is None) or (a["count"] == 0):
+        return b
+    if (b is None) or (b["count"] == 0):
+        return a
+    count = a["count"] + b["count"]
+    delta = b["mean"] - a["mean"]
+    m2 = (
+        a["std"] ** 2 * a["count"]
+        + b["std"] ** 2 * b["count"]
+        + delta**2 * a["count"] * b["count"] / count
+    )
+    return {
+        "count": count,
+        "min": min(a["min"], b["min"]),
+        "max": max(a["max"], b["max"]),
+        "mean": a["mean"] + delta * b["count"] / count,
+        "std": math.sqrt(m2 / count),
+    }
+
+
+def channel_stats(
+    arr: np.ndarray, na_value: float = -99, chunk_rows: int = 1024
+) -> dict:
+    """
+    Count, min, max, mean and std of the channel ignoring na_value and NaN.
+    The channel is processed by chunks of rows, so only a chunk is copied
+    """
+    stats = {"count": 0}
+    for y in range(0, arr.shape[0], chunk_rows):
+        chunk = arr[y : y + chunk_rows]
+        values = chunk[(chunk != na_value) & ~np.isnan(chunk)].astype(
+            "float64"
+        )
+        if values.size == 0:
+            continue
+        stats = merge_stats(
+            stats,
+            {
+                "count": int(values.size),
+                "min": float(values.min()),
+                "max": float(values.max()),
+                "mean": float(values.mean()),
+                "std": float(values.std()),
+            },
+        )
+    return stats
+
+
+# Ice classes are int8 codes, they are shifted to non-negative bins
+CLASS_OFFSET = 128
+N_CLASSES = 256
+
+
+def class_counts(
+    arr: np.ndarray, na_value: float = -99, chunk_size: int = 2**20
+) -> np.ndarray:
+    """
+    Number of pixels of each class in each row of the 2D array of int8
+    codes (na_value is not counted), one np.bincount per chunk of rows.
+    Returns (rows, N_CLASSES) array, index of a class is value + CLASS_OFFSET
+    """
+    n_rows = arr.shape[0]
+    counts = np.empty((n_rows, N_CLASSES), dtype=np.int64)
+    row_size = int(np.prod(arr.shape[1:]))
+    chunk_rows = max(chunk_size // max(row_size, 1), 1)
+    for y in range(0, n_rows, chunk_rows):
+        chunk = arr[y : y + chunk_rows].reshape(
+            min(chunk_rows, n_rows - y), -1
+        )
+        # Номер строки сдвигает коды, так что все строки считаются за раз
+        bins = chunk.astype(np.int64) + CLASS_OFFSET
+        bins += np.arange(len(chunk))[:, None] * N_CLASSES
+        counts[y : y + len(chunk)] = np.bincount(
+            bins.ravel(), minlength=len(chunk) * N_CLASSES
+        ).reshape(len(chunk), N_CLASSES)
+    counts[:, int(na_value) + CLASS_OFFSET] = 0
+    return counts
+
+
+def class_histogram(arr: np.ndarray, na_value: float = -99) -> Dict[str, int]:
+    """Number of pixels of each class of the ice channel without na_value"""
+    counts = class_counts(arr, na_value=na_value).sum(axis=0)
+    return {
+        str(int(code) - CLASS_OFFSET): int(counts[code])
+        for code in np.flatnonzero(counts)
+    }
+
+
+def merge_histograms(a: Dict[str, int], b: Dict[str, int]) -> Dict[str, int]:
+    merged = dict(a)
+    for value, count in b.items():
+        merged[value] = merged.get(value, 0) + count
+    return merged
+
+
+def add_channel_stats(channel: dict, arr: np.ndarray, na_value: float = -99):
+    """Add statistics of the channel array (before its type conversion) to
+    the channel description: class histogram for ice channels, channel
+    statistics for the others"""
+    if channel["kind"] == "ice":
+        channel["histogram"] = class_histogram(arr, na_value=na_value)
+    else:
+        channel["stats"] = channel_stats(arr, na_value=na_value)
+
+
+class DateStats:
+    # Class is aggregating statistics of the datasets of a date by
+    # polarizations, the aggregate is saved next to the datasets
+    def __init__(self):
+        self._name = self.__class__.__name__
+        self.pols = {}
+
+    def add(self, pol: str, scene: str, channels: List[dict]) -> None:
+        pol_stats = self.pols.setdefault(
+            pol, {"scenes": [], "channels": {}, "histograms": {}}
+        )
+        pol_stats["scenes"].append(scene)
+        for channel in channels:
+            name = channel["name"]
+            if "stats" in channel:
+                pol_stats["channels"][name] = merge_stats(
+                    pol_stats["channels"].get(name), channel["stats"]
+                )
+            if "histogram" in channel:
+                pol_stats["histograms"][name] = merge_histograms(
+                    pol_stats["histograms"].get(name, {}),
+                    channel["histogram"],
+                )
+
+    def save(self, stats_fp: pathlib.Path) -> None:
+        with open(stats_fp, "w") as f:
+            json.dump({"pols": self.pols}, f)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Modules of the worker are imported as top-level modules (as in celery_app)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
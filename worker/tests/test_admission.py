@@ -0,0 +1,53 @@
+import json
+import threading
+import time
+
+from admission import MemoryBudget
+
+
+def test_stale_reservation_of_other_host_expires(tmp_path):
+    budget = MemoryBudget(tmp_path, 100, poll_interval=0.01, lease=1)
+    # Резервация контейнера, убитого OOM, с устаревшим heartbeat
+    budget.state_fp.write_text(
+        json.dumps(
+            {"other-host:1:dead": {"bytes": 100, "heartbeat": time.time() - 2}}
+        )
+    )
+    token = budget.acquire(60)
+    assert list(json.loads(budget.state_fp.read_text())) == [token]
+    budget.release(token)
+
+
+def test_held_reservation_is_renewed(tmp_path):
+    budget = MemoryBudget(tmp_path, 100, poll_interval=0.01, lease=0.2)
+    token = budget.acquire(60)
+    time.sleep(0.5)
+    state = json.loads(budget.state_fp.read_text())
+    assert time.time() - state[token]["heartbeat"] < 0.2
+    budget.release(token)
+
+
+def test_oversized_reservation_is_admitted_alone(tmp_path):
+    budget = MemoryBudget(tmp_path, 100, poll_interval=0.01)
+    small = budget.acquire(60)
+    admitted = []
+    big = threading.Thread(target=lambda: admitted.append(budget.acquire(150)))
+    big.start()
+    time.sleep(0.1)
+    # Новые резервации ждут, пока ожидает резервация больше бюджета
+    newcomer = threading.Thread(
+        target=lambda: admitted.append(budget.acquire(10))
+    )
+    newcomer.start()
+    time.sleep(0.1)
+    assert admitted == []
+    budget.release(small)
+    big.join(timeout=5)
+    assert len(admitted) == 1
+    time.sleep(0.1)
+    assert len(admitted) == 1
+    budget.release(admitted[0])
+    newcomer.join(timeout=5)
+    assert len(admitted) == 2
+    budget.release(admitted[1])
+    assert json.loads(budget.state_fp.read_text()) == {}
@@ -0,0 +1,57 @@
+import json
+import multiprocessing
+import os
+
+from catalog import SourceCatalog
+
+
+def update_dates(roots, dates):
+    source_catalog = SourceCatalog(*roots, lock_dir=roots[0].parent / "locks")
+    for date in dates:
+        source_catalog.update(dates=[date])
+
+
+def test_concurrent_updates_are_kept(tmp_path):
+    dates = [f"202001{day:02d}" for day in range(1, 21)]
+    for kind in ["sar", "icemap"]:
+        for date in dates:
+            tmp_path.joinpath(kind, "source1", date).mkdir(parents=True)
+    roots = (
+        tmp_path.joinpath("sar"),
+        tmp_path.joinpath("icemap"),
+        tmp_path.joinpath("catalog", "index.json"),
+    )
+    # Каждый процесс индексирует свои даты в общий индекс
+    processes = [
+        multiprocessing.Process(target=update_dates, args=(roots, dates[i::4]))
+        for i in range(4)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+    index = json.loads(roots[2].read_text())
+    assert sorted(index["rasters"]) == dates
+    assert sorted(index["icemaps"]) == dates
+
+
+def test_update_reloads_index_with_same_mtime(tmp_path):
+    for kind in ["sar", "icemap"]:
+        for date in ["20200101", "20200102"]:
+            tmp_path.joinpath(kind, "source1", date).mkdir(parents=True)
+    roots = (
+        tmp_path.joinpath("sar"),
+        tmp_path.joinpath("icemap"),
+        tmp_path.joinpath("catalog", "index.json"),
+    )
+    first = SourceCatalog(*roots, lock_dir=tmp_path / "locks")
+    second = SourceCatalog(*roots, lock_dir=tmp_path / "locks")
+    first.update(dates=["20200101"])
+    second.update(dates=["20200102"])
+    # Файловая система с грубым mtime: запись второго процесса не меняет его
+    os.utime(roots[2], ns=(first._index_mtime, first._index_mtime))
+    tmp_path.joinpath("sar", "source1", "20200103").mkdir()
+    first.update(dates=["20200103"])
+    index = json.loads(roots[2].read_text())
+    assert sorted(index["rasters"]) == ["20200101", "20200102", "20200103"]
@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("scipy")
+
+import ds_arrays
+
+
+def test_write_channel_float16_ignores_na_value():
+    stacked = np.zeros(4, dtype=[("simple_0", "float16")])
+    channel = {"name": "simple_0", "dtype": "float16"}
+    arr = np.array([-99, 0.5, 1, 2], dtype="float32")
+    ds_arrays.write_channel(stacked, channel, arr, na_value=-99)
+    assert channel["offset"] == 0.5
+    assert channel["scale"] == 1.5
+    assert np.isnan(stacked["simple_0"][0])
+    restored = stacked["simple_0"][1:] * channel["scale"] + channel["offset"]
+    assert np.allclose(restored, arr[1:], atol=1e-3)
+
+
+def test_class_histogram_ignores_na_value():
+    from stats import class_histogram
+
+    arr = np.array([[0, 3, -99], [3, 10, -99]], dtype="int8")
+    assert class_histogram(arr, na_value=-99) == {"0": 1, "3": 2, "10": 1}
+    # Плотный формат хранит классы во float
+    assert class_histogram(arr.astype("float32")) == {"0": 1, "3": 2, "10": 1}
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("scipy")
+
+import ds_arrays
+from label_index import LabelIndex
+
+
+def create_stacked():
+    channels = [
+        {"name": "rescaled", "kind": "rescaled"},
+        {"name": "age_group", "kind": "ice"},
+    ]
+    stacked = np.zeros((8, 8), dtype=[("rescaled", "f4"), ("age_group", "i1")])
+    stacked["age_group"] = -99
+    stacked["age_group"][:4, :4] = 3
+    stacked["age_group"][:4, 4:] = 1
+    stacked["age_group"][4:, :2] = 3
+    return stacked, channels
+
+
+def test_get_label_fractions():
+    stacked, channels = create_stacked()
+    valid = ds_arrays.get_valid_mask(stacked, channels)
+    fractions, tiles = ds_arrays.get_label_fractions(
+        stacked, channels, valid, 4
+    )
+    assert fractions == {
+        "valid": 0.625,
+        "classes": {"age_group": {1: 0.4, 3: 0.6}},
+    }
+    # Тайл без валидных пикселей (4, 4) пропускается
+    assert [(tile["y"], tile["x"], tile["valid"]) for tile in tiles] == [
+        (0, 0, 1.0),
+        (0, 4, 1.0),
+        (4, 0, 0.5),
+    ]
+    assert tiles[2]["classes"] == {"age_group": {3: 1.0}}
+
+
+def test_label_index_replaces_scene(tmp_path):
+    stacked, channels = create_stacked()
+    valid = ds_arrays.get_valid_mask(stacked, channels)
+    fractions, tiles = ds_arrays.get_label_fractions(
+        stacked, channels, valid, 4
+    )
+    label_index = LabelIndex(tmp_path.joinpath("label_index.sqlite3"))
+    for _ in range(2):
+        label_index.add("20200101", "HH", "s1", fractions, tiles, [8, 8], 4)
+    with label_index._connect() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM scenes").fetchone()[0] == 1
+        assert conn.execute("SELECT COUNT(*) FROM tiles").fetchone()[0] == 3
+        # 2 класса снимка и по одному классу в каждом тайле
+        assert (
+            conn.execute("SELECT COUNT(*) FROM fractions").fetchone()[0] == 5
+        )
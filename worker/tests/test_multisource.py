@@ -0,0 +1,92 @@
+import multiprocessing
+
+from multisource import DataGatherer, MultiDataGatherer
+
+
+def create_volumes(root, volumes):
+    for volume, names in volumes.items():
+        for name in names:
+            root.joinpath("volumes", volume, name).mkdir(parents=True)
+    return root.joinpath("volumes"), root.joinpath("place")
+
+
+def test_sync_restores_removed_link(tmp_path):
+    volumes_root, place = create_volumes(
+        tmp_path, {"source1": ["20200101", "20200102"]}
+    )
+    data_gatherer = DataGatherer(volumes_root, place, shared=True)
+    data_gatherer.sync()
+    # Ссылка удалена извне, mtime тома не изменился
+    place.joinpath("20200101").unlink()
+    data_gatherer.sync()
+    assert sorted(p.name for p in place.iterdir()) == ["20200101", "20200102"]
+    assert place.joinpath("20200101").resolve() == volumes_root.joinpath(
+        "source1", "20200101"
+    )
+
+
+def sync_changes(root, volume, n_changes):
+    dg_app = MultiDataGatherer(lock_dir=root.joinpath("locks"))
+    dg_app.add_app(
+        "rasters",
+        DataGatherer(
+            root.joinpath("volumes"), root.joinpath("place"), shared=True
+        ),
+    )
+    for i in range(n_changes):
+        # Новые даты тома и удаление общих дат (ссылка переключается
+        # на другой том)
+        root.joinpath("volumes", volume, f"new_{i:02d}").mkdir()
+        shared = root.joinpath("volumes", volume, f"shared_{i:02d}")
+        if shared.exists():
+            shared.rmdir()
+        dg_app.sync()
+
+
+def test_concurrent_sync_keeps_links(tmp_path):
+    shared = [f"shared_{i:02d}" for i in range(10)]
+    volumes = {"source1": shared, "source2": shared, "source3": shared}
+    volumes_root, place = create_volumes(tmp_path, volumes)
+    # Каждый процесс меняет свой том и синхронизирует общее место сбора
+    processes = [
+        multiprocessing.Process(
+            target=sync_changes, args=(tmp_path, volume, 10)
+        )
+        for volume in ["source1", "source2"]
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+    names = sorted(p.name for p in place.iterdir())
+    expected = sorted(
+        {p.name for volume in volumes_root.iterdir() for p in volume.iterdir()}
+    )
+    assert names == expected
+    for name in names:
+        assert place.joinpath(name).resolve().is_dir()
+    # Ссылки на общие даты ведут на единственный оставшийся том
+    assert place.joinpath("shared_00").resolve().parent.name == "source3"
+
+
+def test_fresh_sync_is_reused(tmp_path):
+    volumes_root, place = create_volumes(tmp_path, {"source1": ["20200101"]})
+    dg_apps = []
+    for _ in range(2):
+        dg_app = MultiDataGatherer(
+            lock_dir=tmp_path.joinpath("locks"), freshness=60
+        )
+        dg_app.add_app(
+            "rasters", DataGatherer(volumes_root, place, shared=True)
+        )
+        dg_apps.append(dg_app)
+    lock_fp = tmp_path.joinpath("locks", "rasters.lock")
+    # Второй процесс использует свежую синхронизацию первого
+    assert lock_fp.read_text() == "1"
+    volumes_root.joinpath("source1", "20200102").mkdir()
+    dg_apps[1].sync()
+    assert not place.joinpath("20200102").exists()
+    dg_apps[1].sync(full=True)
+    assert lock_fp.read_text() == "2"
+    assert place.joinpath("20200102").is_symlink()
@@ -0,0 +1,27 @@
+import json
+
+import numpy as np
+
+from patches import PatchShardWriter
+
+
+def test_shards_mix_scenes(tmp_path):
+    writer = PatchShardWriter(
+        tmp_path, patch_size=2, shard_size=4, seed=0, shuffle_shards=4
+    )
+    valid = np.ones((4, 8), dtype=bool)
+    scenes = [f"scene_{i}" for i in range(4)]
+    for i, scene in enumerate(scenes):
+        # 8 патчей 2 x 2 на снимок, значение - номер снимка
+        writer.add(np.full((4, 8), i), valid, scene, channels=[])
+    writer.close()
+    index = json.loads(tmp_path.joinpath("index.json").read_text())
+    shards = index["shards"]
+    assert sum(shard["count"] for shard in shards) == 32
+    assert all(shard["count"] == 4 for shard in shards)
+    # Первый шард собирается из буфера нескольких снимков
+    assert len({patch[0] for patch in shards[0]["patches"]}) > 1
+    for shard in shards:
+        patches = np.load(tmp_path.joinpath(shard["file"]))
+        for patch, (scene, _, _) in zip(patches, shard["patches"]):
+            assert np.all(patch == scenes.index(scene))
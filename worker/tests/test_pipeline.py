@@ -0,0 +1,165 @@
+import json
+import types
+
+import numpy as np
+import pytest
+
+pytest.importorskip("scipy")
+
+import ds_arrays
+from admission import MemoryBudget
+
+DATE = "20200101"
+RASTERS = ["a.tif", "b.tif", "c.tif"]
+
+
+class FailOn:
+    # Заглушка загрузчика: возвращает value, для failed вызывает ошибку
+    def __init__(self, value, failed=None):
+        self.value = value
+        self.failed = failed
+
+    def __call__(self, *args, **kwargs):
+        if (self.failed is not None) and (self.failed in args):
+            raise OSError(f"{self.failed} is broken")
+        return self.value
+
+
+def reserved(budget):
+    return json.loads(budget.state_fp.read_text())
+
+
+@pytest.fixture
+def budget(tmp_path):
+    return MemoryBudget(tmp_path.joinpath("locks"), 100, poll_interval=0.01)
+
+
+@pytest.fixture
+def sources(tmp_path, monkeypatch):
+    scenes = {
+        pol: {
+            raster_fn: {"source": f"{raster_fn}.zip", "rescaled": raster_fn}
+            for raster_fn in RASTERS
+        }
+        for pol in ["HH", "HV"]
+    }
+    monkeypatch.setattr(
+        ds_arrays,
+        "get_date_sources",
+        lambda *args, **kwargs: (scenes, "wrfout", "icemap"),
+    )
+    monkeypatch.setattr(ds_arrays, "load_weather", FailOn(None))
+    monkeypatch.setattr(ds_arrays, "estimate_weather_memory", FailOn(40))
+    monkeypatch.setattr(
+        ds_arrays, "create_weather_stacked", FailOn(np.zeros((2, 2, 1)))
+    )
+    # Снимки уже собраны
+    ds_dir = tmp_path.joinpath("ds", DATE, "HH")
+    ds_dir.mkdir(parents=True)
+    for raster_fn in RASTERS:
+        np.save(ds_dir.joinpath(raster_fn.replace(".tif", ".npy")), [0])
+    return tmp_path.joinpath("ds")
+
+
+def create_weather_ds(ds_root, budget, pipeline_depth):
+    ds_arrays.create_weather_ds(
+        "rasters",
+        DATE,
+        str(ds_root),
+        ["T2"],
+        memory_budget=budget,
+        pipeline_depth=pipeline_depth,
+    )
+
+
+@pytest.mark.parametrize("pipeline_depth", [0, 1, 2])
+def test_weather_reader_error(sources, budget, monkeypatch, pipeline_depth):
+    monkeypatch.setattr(
+        ds_arrays, "get_annotation", FailOn("annotation", "b.tif.zip")
+    )
+    with pytest.raises(OSError, match="b.tif.zip is broken"):
+        create_weather_ds(sources, budget, pipeline_depth)
+    assert reserved(budget) == {}
+
+
+@pytest.mark.parametrize("pipeline_depth", [0, 1, 2])
+def test_weather_writer_error(sources, budget, monkeypatch, pipeline_depth):
+    monkeypatch.setattr(ds_arrays, "get_annotation", FailOn("annotation"))
+
+    def save(save_fp, arr):
+        if "b_HH_HV" in str(save_fp):
+            raise OSError("disk is full")
+
+    monkeypatch.setattr(ds_arrays.np, "save", save)
+    with pytest.raises(OSError, match="disk is full"):
+        create_weather_ds(sources, budget, pipeline_depth)
+    assert reserved(budget) == {}
+
+
+class VectorCache:
+    def get_icemap(self, fp):
+        return None
+
+    def get_land(self, fp):
+        return None
+
+
+def create_ds_arrays(ds_root, budget, pipeline_depth):
+    ds_arrays.create_ds_arrays(
+        DATE,
+        "icemaps",
+        "rasters",
+        str(ds_root),
+        "land",
+        vector_cache=VectorCache(),
+        memory_budget=budget,
+        pipeline_depth=pipeline_depth,
+    )
+
+
+@pytest.fixture
+def scene_loaders(monkeypatch):
+    monkeypatch.setattr(ds_arrays, "icemap_covers", FailOn(True))
+    monkeypatch.setattr(
+        ds_arrays,
+        "open_scene_file",
+        lambda scene_files, file_type, raster_fn: types.SimpleNamespace(
+            name=raster_fn, RasterXSize=2, RasterYSize=2
+        ),
+    )
+    monkeypatch.setattr(ds_arrays, "get_channel_names", FailOn([]))
+    monkeypatch.setattr(ds_arrays, "estimate_stacked_memory", FailOn(60))
+    monkeypatch.setattr(ds_arrays, "clip_vector", FailOn(None))
+    monkeypatch.setattr(ds_arrays, "read_scene_arrays", FailOn({}))
+    monkeypatch.setattr(
+        ds_arrays, "create_stacked", FailOn((np.zeros((2, 2, 1)), []))
+    )
+
+
+@pytest.mark.parametrize("pipeline_depth", [0, 1, 2])
+def test_sar_reader_error(
+    sources, budget, scene_loaders, monkeypatch, pipeline_depth
+):
+    def read_scene_arrays(rescaled_raster, *args, **kwargs):
+        if rescaled_raster.name == "b.tif":
+            raise OSError(f"{rescaled_raster.name} is broken")
+        return {}
+
+    monkeypatch.setattr(ds_arrays, "read_scene_arrays", read_scene_arrays)
+    with pytest.raises(OSError, match="is broken"):
+        create_ds_arrays(sources, budget, pipeline_depth)
+    assert reserved(budget) == {}
+
+
+@pytest.mark.parametrize("pipeline_depth", [0, 1, 2])
+def test_sar_writer_error(
+    sources, budget, scene_loaders, monkeypatch, pipeline_depth
+):
+    def save(save_fp, arr):
+        if save_fp.endswith("b.npy"):
+            raise OSError("disk is full")
+
+    monkeypatch.setattr(ds_arrays.np, "save", save)
+    with pytest.raises(OSError, match="disk is full"):
+        create_ds_arrays(sources, budget, pipeline_depth)
+    assert reserved(budget) == {}
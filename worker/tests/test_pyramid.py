@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("scipy")
+
+import ds_arrays
+
+
+def test_pyramid_level_fills_scaled_channel_with_nan():
+    stacked = np.zeros(
+        (4, 4), dtype=[("simple_0", "float16"), ("age", "int8")]
+    )
+    channels = [
+        {"name": "simple_0", "kind": "simple", "dtype": "float16"},
+        {"name": "age", "kind": "ice", "dtype": "int8"},
+    ]
+    simple = np.full((4, 4), -99, dtype="float32")
+    simple[:2, :2] = [[0.5, 1], [1.5, -99]]
+    simple[0, 2] = 2
+    ds_arrays.write_channel(stacked, channels[0], simple)
+    stacked["age"] = -99
+    stacked["age"][:2, :2] = [[3, 3], [5, -99]]
+    stacked["age"][2:, :2] = [[5, -99], [-99, -99]]
+    level = ds_arrays.create_pyramid_level(stacked, channels, 2)
+    restored = level["simple_0"] * channels[0]["scale"] + channels[0]["offset"]
+    assert np.allclose(restored[0], [1, 2], atol=1e-2)
+    assert np.isnan(level["simple_0"][1]).all()
+    # Мода по размеченным пикселям, пустые блоки - na_value
+    assert level["age"].tolist() == [[3, -99], [5, -99]]
+
+
+def test_downsample_ice_mode_takes_first_of_equal_classes():
+    arr = np.array([[2, 1, 0, 0], [1, 2, 0, 7]], dtype="float32")
+    pooled = ds_arrays.downsample_channel(arr, 2, "ice")
+    assert pooled.tolist() == [[1, 0]]
@@ -0,0 +1,104 @@
+import xml.etree.ElementTree as ET
+import zipfile
+
+import numpy as np
+import pytest
+
+pytest.importorskip("scipy")
+from scipy.spatial import cKDTree
+
+import ds_arrays
+
+N_LINES, N_SAMPLES = 6, 8
+
+
+def create_annotation(n_lines=N_LINES, n_samples=N_SAMPLES):
+    """Annotation with imageInformation and a 4 x 4 geolocation grid, lat
+    grows with lines and lon with pixels"""
+    points = "".join(
+        f"<geolocationGridPoint><line>{line}</line><pixel>{pixel}</pixel>"
+        + f"<latitude>{70 + line * 0.01}</latitude>"
+        + f"<longitude>{30 + pixel * 0.01}</longitude></geolocationGridPoint>"
+        for line in np.linspace(0, n_lines - 1, 4).astype(int)
+        for pixel in np.linspace(0, n_samples - 1, 4).astype(int)
+    )
+    return ET.ElementTree(
+        ET.fromstring(
+            "<product><imageAnnotation><imageInformation>"
+            + f"<numberOfLines>{n_lines}</numberOfLines>"
+            + f"<numberOfSamples>{n_samples}</numberOfSamples>"
+            + "</imageInformation></imageAnnotation>"
+            + f"<geolocationGrid><geolocationGridPointList>{points}"
+            + "</geolocationGridPointList></geolocationGrid></product>"
+        )
+    )
+
+
+def create_weather(step=0.01):
+    lon, lat = np.meshgrid(
+        np.arange(29.9, 30.2, step), np.arange(69.9, 70.2, step)
+    )
+    coords_type = ("XLONG", "XLAT")
+    tree = cKDTree(np.stack((lon.flatten(), lat.flatten()), axis=-1))
+    return [coords_type], {"T2": lat * 100}, {coords_type: tree}
+
+
+def test_get_image_shape():
+    assert ds_arrays.get_image_shape(create_annotation()) == (
+        N_LINES,
+        N_SAMPLES,
+    )
+
+
+def test_create_weather_stacked():
+    weather_stacked = ds_arrays.create_weather_stacked(
+        None,
+        "HH",
+        create_weather(),
+        ["T2"],
+        weather_step=0.08,
+        annotation=create_annotation(),
+    )
+    assert weather_stacked.shape == (N_LINES, N_SAMPLES, 1)
+    # Ближайший пиксель погоды берется по широте снимка
+    expected = np.round((70 + np.arange(N_LINES) * 0.01) * 100)
+    assert np.allclose(np.round(weather_stacked[:, 0, 0]), expected)
+
+
+def create_safe_zip(zip_fp, annotation_xml):
+    prefix = "S1A_EW_GRDM.SAFE"
+    with zipfile.ZipFile(zip_fp, "w", zipfile.ZIP_DEFLATED) as zip_ref:
+        # Подпапка calibration содержит файл той же поляризации
+        zip_ref.writestr(
+            f"{prefix}/annotation/calibration/calibration-s1a-ew-grd-hh.xml",
+            "<calibration/>",
+        )
+        zip_ref.writestr(
+            f"{prefix}/annotation/s1a-ew-grd-hh.xml", annotation_xml
+        )
+
+
+def test_get_annotation_from_zip(tmp_path):
+    zip_fp = str(tmp_path.joinpath("scene.zip"))
+    create_safe_zip(
+        zip_fp, ET.tostring(create_annotation().getroot(), encoding="unicode")
+    )
+    annotation = ds_arrays.get_annotation(zip_fp, "HH")
+    assert ds_arrays.get_image_shape(annotation) == (N_LINES, N_SAMPLES)
+    with pytest.raises(FileNotFoundError, match="annotation.*HV.*scene.zip"):
+        ds_arrays.get_annotation(zip_fp, "HV")
+
+
+def test_read_zip_member_checks_crc(tmp_path):
+    zip_fp = str(tmp_path.joinpath("scene.zip"))
+    annotation_xml = "<product>" + "0" * 100 + "</product>"
+    create_safe_zip(zip_fp, annotation_xml)
+    info = ds_arrays.find_zip_member(zip_fp, "annotation", ".xml", "HH")
+    # Поврежденные данные члена архива
+    data = bytearray(open(zip_fp, "rb").read())
+    offset = info.header_offset + 30 + len(info.filename) + len(info.extra)
+    data[offset + info.compress_size // 2] ^= 0xFF
+    with open(zip_fp, "wb") as f:
+        f.write(bytes(data))
+    with pytest.raises(zipfile.BadZipFile, match="s1a-ew-grd-hh.xml"):
+        ds_arrays.get_annotation(zip_fp, "HH")